@@ -1,14 +1,25 @@
-from datetime import timedelta
+import asyncio
+from time import perf_counter
 
 from telegram import CallbackQuery, Update, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import CallbackQueryHandler, ExtBot
 
+from callbacks import ACTION_CODES, CallbackCodec
 from data import *
+from keyboards import KeyboardCache, CityKeyboards
+from metrics import ACTION_DURATION, ACTION_ERRORS
+from photos import PhotoLibrary
+from render import MessageRenderer, CityTexts
+from state import StateStore
 from weather import *
 
 
 class AbstractAction:
+    # whether the action may run alongside the next actions of the same callback
+    runs_concurrently = False
+
     def __init__(self, bot, action_key: str):
         self.bot = bot
         self.action_key = action_key
@@ -17,6 +28,34 @@ class AbstractAction:
         data_loader: DataLoader = self.bot.data_loader
         return data_loader.get_city_model(_id)
 
+    def get_city_texts(self, _id: str) -> CityTexts:
+        renderer: MessageRenderer = self.bot.renderer
+        return renderer.get_city_texts(_id)
+
+    def get_city_keyboards(self, _id: str) -> CityKeyboards:
+        keyboards: KeyboardCache = self.bot.keyboards
+        return keyboards.get_city_keyboards(_id)
+
+    async def edit_message(self, query: CallbackQuery, text: str, reply_markup, parse_mode=ParseMode.MARKDOWN_V2):
+        renderer: MessageRenderer = self.bot.renderer
+
+        if query.inline_message_id is not None:
+            message_key = query.inline_message_id
+        else:
+            message_key = (query.message.chat_id, query.message.message_id)
+
+        if not renderer.remember_content(message_key, text, reply_markup):
+            return
+
+        try:
+            await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+        except Exception as error:
+            if isinstance(error, BadRequest) and 'message is not modified' in error.message.lower():
+                return
+            # the message may have stayed as it was, so the same content has to be sent again next time
+            renderer.forget_content(message_key)
+            raise
+
     async def handle(self, args: list, update: Update, ctx):
         print(f"Execution code for action '{self.action_key}' isn't implemented!")
 
@@ -26,6 +65,13 @@ class CallbackHandler(CallbackQueryHandler):
         super().__init__(self.handle_callback)
         self.bot = bot
 
+        # opcode -> action, compiled once from the registered actions
+        self.dispatch_table = [None] * 256
+        for action_key, action in bot.registered_actions.items():
+            opcode = ACTION_CODES.get(action_key)
+            if opcode is not None:
+                self.dispatch_table[opcode] = action
+
     def register(self):
         self.bot.app.add_handler(self)
 
@@ -34,29 +80,56 @@ class CallbackHandler(CallbackQueryHandler):
         print(f'[Callback] Received callback action from @{username}.')
 
         query = update.callback_query
-        await query.answer()
+        codec: CallbackCodec = self.bot.callback_codec
 
-        data = query.data
+        try:
+            commands = codec.unpack(query.data)
+        except (ValueError, IndexError, UnicodeDecodeError):
+            print(f"[Callback] Received malformed callback data '{query.data}'!")
+            commands = list()
 
-        for line in data.split('\n'):
-            if line.startswith('#'):
-                command_line = line[1:]
-                args = command_line.split(' ')
-                command = args.pop(0)
+        if commands is None:
+            await query.answer('⌛ Эта кнопка устарела')
+            return
+
+        await query.answer()
 
-                action = None
+        concurrent_tasks = list()
 
-                if command in self.bot.registered_actions.keys():
-                    action = self.bot.registered_actions[command]
+        for opcode, args in commands:
+            action = self.dispatch_table[opcode]
 
-                if action is None:
-                    print(f"[Callback] Invoked unknown action '{command}'!")
+            if action is None:
+                print(f"[Callback] Invoked unknown action #{opcode}!")
+                if query.message is not None:
                     await self.bot.get().send_message(query.message.chat_id, '😡 Не тыкайся...')
-                else:
-                    await action.handle(args, update, ctx)
+            elif action.runs_concurrently:
+                concurrent_tasks.append(asyncio.create_task(self.run_action(action, list(args), update, ctx)))
+            else:
+                await self.run_action(action, list(args), update, ctx)
+
+        if len(concurrent_tasks) != 0:
+            await asyncio.gather(*concurrent_tasks)
+
+    @staticmethod
+    async def run_action(action: AbstractAction, args: list, update: Update, ctx):
+        started_at = perf_counter()
+        try:
+            await action.handle(args, update, ctx)
+        except Exception:
+            ACTION_ERRORS.inc(action.action_key)
+            raise
+        finally:
+            ACTION_DURATION.observe(perf_counter() - started_at, action.action_key)
 
 
 class ActionDeleteMessages(AbstractAction):
+    runs_concurrently = True
+
+    # Bot API accepts up to 100 message ids in a single deleteMessages call
+    BULK_DELETE_LIMIT = 100
+    MAX_PARALLEL_DELETES = 10
+
     def __init__(self, bot):
         super().__init__(bot, 'delete')
 
@@ -69,47 +142,66 @@ class ActionDeleteMessages(AbstractAction):
             print(f'[Callback] Failed: there are no message_id argument(s) received!')
             return
 
-        bot: ExtBot = self.bot.get()
         chat_id = int(args.pop(0))
-        coroutines = list()
+        message_ids = [int(message_id) for message_id in args]
 
-        for message_id in args:
-            message_id = int(message_id)
-            coroutines.append(bot.delete_message(chat_id, message_id))
+        failures = await self.delete_messages(chat_id, message_ids)
+        for message_ids, error in failures:
+            print(f'[Callback] Failed to delete messages {message_ids} in chat {chat_id}: {error}')
 
-        for coroutine in coroutines:
-            await coroutine
+    async def delete_messages(self, chat_id: int, message_ids: list) -> list:
+        bot: ExtBot = self.bot.get()
+
+        if hasattr(bot, 'delete_messages'):
+            limit = ActionDeleteMessages.BULK_DELETE_LIMIT
+            chunks = [message_ids[i:i + limit] for i in range(0, len(message_ids), limit)]
+            results = await asyncio.gather(
+                *[bot.delete_messages(chat_id, chunk) for chunk in chunks],
+                return_exceptions=True
+            )
+            return [(chunk, result) for chunk, result in zip(chunks, results) if isinstance(result, Exception)]
+
+        semaphore = asyncio.Semaphore(ActionDeleteMessages.MAX_PARALLEL_DELETES)
+
+        async def delete_message(message_id: int):
+            async with semaphore:
+                await bot.delete_message(chat_id, message_id)
+
+        results = await asyncio.gather(
+            *[delete_message(message_id) for message_id in message_ids],
+            return_exceptions=True
+        )
+        return [([message_id], result) for message_id, result in zip(message_ids, results) if isinstance(result, Exception)]
 
 
 class ActionShowCities(AbstractAction):
     def __init__(self, bot):
         super().__init__(bot, 'show_cities')
 
-        buttons = [model.as_inline_button() for model in bot.data_loader.city_models.values()]
-
-        self.keyboard = InlineKeyboardMarkup([
-            [buttons[0], buttons[1]],
-            [buttons[2], buttons[3]],
-            [buttons[4], buttons[5]]
-        ])
+    def get_keyboard(self, page: int) -> InlineKeyboardMarkup:
+        keyboards: KeyboardCache = self.bot.keyboards
+        return keyboards.get_city_list(page)
 
     async def handle(self, args: list, update: Update, ctx):
+        page = int(args[0]) if len(args) != 0 and args[0].isdigit() else 0
+
         query = update.callback_query
-        await self.show_cities(query.message.message_id, query.message.chat_id, query.inline_message_id)
+        await self.edit_message(query, '🏘 Выберите город из списка:', self.get_keyboard(page), parse_mode=None)
 
-    async def show_cities(self, message_id, chat_id, inline_message_id):
+    async def show_cities(self, message_id, chat_id, inline_message_id, page: int = 0):
         if message_id is None and inline_message_id is None:
             await self.bot.get().send_message(
                 chat_id,
                 '🏘 Выберите город из списка:',
-                reply_markup=self.keyboard
+                reply_markup=self.get_keyboard(page)
             )
         else:
             await self.bot.get().edit_message_text(
                 '🏘 Выберите город из списка:',
                 message_id=message_id,
                 chat_id=chat_id,
-                reply_markup=self.keyboard
+                inline_message_id=inline_message_id,
+                reply_markup=self.get_keyboard(page)
             )
 
 
@@ -122,47 +214,22 @@ class ActionSelectCity(AbstractAction):
             print(f'[Callback] Failed: there are no city_id argument received!')
             return
 
-        city = self.get_city(args[0])
+        texts = self.get_city_texts(args[0])
+        keyboards = self.get_city_keyboards(args[0])
         query: CallbackQuery = update.callback_query
 
-        await query.edit_message_text(
-            f"""
-*Выберите действие с городом*
-            
-{city.emoji} Город: `{city.name}`
-🌍 Страна: `{city.country}`
-            """,
-            parse_mode=ParseMode.MARKDOWN_V2,
-            reply_markup=ActionSelectCity.construct_keyboard(args[0])
-        )
+        state_store: StateStore = self.bot.state_store
+        state_store.set_last_city(update.effective_user.id, args[0])
 
-    @staticmethod
-    def construct_keyboard(city_id: str) -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton('📚 Открыть справочник', callback_data=f'#show_city_info {city_id}')
-            ],
-            [
-                InlineKeyboardButton('📷 Фото', callback_data=f'#show_photos {city_id}'),
-                InlineKeyboardButton('🌤 Погода', callback_data=f'#show_weather {city_id}')
-            ],
-            [
-                InlineKeyboardButton('🏘 Выбрать другой город', callback_data=f'#show_cities')
-            ]
-        ])
+        await self.edit_message(query, texts.select_city, keyboards.select_city)
 
 
 class AbstractCityAction(AbstractAction):
     def __init__(self, bot, action_key: str):
         super().__init__(bot, action_key)
 
-    @staticmethod
-    def construct_keyboard(city_id: str) -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton('🎲 Вернуться к выбору действия', callback_data=f'#select_city {city_id}')
-            ]
-        ])
+    def get_back_keyboard(self, city_id: str) -> InlineKeyboardMarkup:
+        return self.get_city_keyboards(city_id).back
 
 
 class ActionShowCityInfo(AbstractCityAction):
@@ -175,23 +242,11 @@ class ActionShowCityInfo(AbstractCityAction):
             return
 
         city_id = args[0]
-        city = self.get_city(city_id)
+        texts = self.get_city_texts(city_id)
 
         query: CallbackQuery = update.callback_query
 
-        await query.edit_message_text(
-            f"""
-*Справка о городе {city.name} {city.emoji}*
-
-○ Страна: `{city.country}`
-○ Широта: `{city.latitude}`
-○ Долгота: `{city.longitude}`
-○ Площадь: `{city.area} км²`
-○ Население: `{city.population}`
-            """,
-            parse_mode=ParseMode.MARKDOWN_V2,
-            reply_markup=ActionShowCityInfo.construct_keyboard(city_id)
-        )
+        await self.edit_message(query, texts.city_info, self.get_back_keyboard(city_id))
 
 
 class ActionShowPhotos(AbstractCityAction):
@@ -205,65 +260,59 @@ class ActionShowPhotos(AbstractCityAction):
 
         city_id = args[0]
         city = self.get_city(city_id)
+        texts = self.get_city_texts(city_id)
 
-        query: CallbackQuery = update.callback_query
-
-        if len(city.photos) == 0:
-            await query.edit_message_text(
-                f"""
-*Фотографии города*
+        photo_library: PhotoLibrary = self.bot.photo_library
+        photos = photo_library.get_photos(city)
 
-*Город:* {city.name} {city.emoji}
+        query: CallbackQuery = update.callback_query
 
-_К сожалению, фотографии пока отсутствуют :\\(_
-_Мы обязательно добавим их позже\\._
-                            """,
-                parse_mode=ParseMode.MARKDOWN_V2,
-                reply_markup=ActionShowPhotos.construct_keyboard(city_id)
-            )
+        if len(photos) == 0:
+            await self.edit_message(query, texts.photos_missing, self.get_back_keyboard(city_id))
+        elif query.message is None:
+            # inline messages can't be replied to, so only the photo sources are shown
+            keyboards = self.get_city_keyboards(city_id)
+            await self.edit_message(query, texts.photos_caption, InlineKeyboardMarkup([
+                keyboards.photo_sources,
+                *keyboards.back.inline_keyboard
+            ]))
         else:
             media = list()
 
-            for photo in city.photos:
+            for photo in photos:
                 photo: CityPhoto
-                media.append(InputMediaPhoto(photo.tg_id))
+                file_id = photo_library.get_file_id(city_id, photo)
+                if file_id is not None:
+                    media.append(InputMediaPhoto(file_id))
+
+            if len(media) == 0:
+                await self.edit_message(query, texts.photos_missing, self.get_back_keyboard(city_id))
+                return
 
             await query.delete_message()
 
             sent_messages = await query.message.reply_media_group(media, protect_content=False)
 
             await query.message.reply_text(
-                f"""
-*Фотографии города*
-
-*Город:* {city.name} {city.emoji}
-
-Вот несколько фото выбранного города 🥺
-Оригинальные источники доступны ниже\\.
-                """,
+                texts.photos_caption,
                 parse_mode=ParseMode.MARKDOWN_V2,
-                reply_markup=ActionShowPhotos.construct_custom_keyboard(city_id, city, sent_messages)
+                reply_markup=self.construct_custom_keyboard(city_id, sent_messages)
             )
 
-    @staticmethod
-    def construct_custom_keyboard(city_id: str, city: CityModel, photos_messages: tuple):
-        source_buttons = list()
-        counter = 1
-
-        for photo in city.photos:
-            photo: CityPhoto
-            source_buttons.append(InlineKeyboardButton(f"Источник #{counter}", url=photo.source))
-            counter += 1
+    def construct_custom_keyboard(self, city_id: str, photos_messages: tuple):
+        source_buttons = self.get_city_keyboards(city_id).photo_sources
 
         chat_id = photos_messages[0].chat_id
-        message_ids = ' '.join([str(message.message_id) for message in photos_messages])
+        message_ids = [message.message_id for message in photos_messages]
+
+        codec: CallbackCodec = self.bot.callback_codec
 
         return InlineKeyboardMarkup([
             source_buttons,
             [
                 InlineKeyboardButton(
                     '🎲 Вернуться к выбору действия',
-                    callback_data=f'#delete {chat_id} {message_ids}\n#select_city {city_id}'
+                    callback_data=codec.pack(('delete', chat_id, *message_ids), ('select_city', city_id))
                 )
             ]
         ])
@@ -273,13 +322,9 @@ class ActionShowWeather(AbstractCityAction):
     def __init__(self, bot):
         super().__init__(bot, 'show_weather')
 
-    def get_weather_data(self, city_id: str) -> CityWeatherData:
+    def record_demand(self, city_id: str):
         weather_service: WeatherService = self.bot.weather_service
-        return weather_service.get_cached_weather_data(city_id)
-
-    def get_condition(self, _id: int) -> WeatherCondition:
-        data_loader: DataLoader = self.bot.data_loader
-        return data_loader.get_weather_condition(_id)
+        weather_service.record_demand(city_id)
 
     async def handle(self, args: list, update: Update, ctx):
         if len(args) < 1:
@@ -287,54 +332,46 @@ class ActionShowWeather(AbstractCityAction):
             return
 
         city_id = args[0]
-        city = self.get_city(city_id)
+        self.record_demand(city_id)
 
+        renderer: MessageRenderer = self.bot.renderer
         query: CallbackQuery = update.callback_query
 
-        weather_data = self.get_weather_data(city_id)
-        if weather_data is None:
-            await query.edit_message_text(
-                f"""
-*Информация о текущей погоде*
+        await self.edit_message(query, renderer.render_weather(city_id), self.get_back_keyboard(city_id))
 
-*Город:* {city.name} {city.emoji}
 
-_К сожалению, информация в данный момент отстутствует :\\(_
-_Это может быть вызвано техническими неполадками\\._
-_Попробуйте повторить запрос позже\\._
-                """,
-                parse_mode=ParseMode.MARKDOWN_V2,
-                reply_markup=ActionShowWeather.construct_keyboard(city_id)
-            )
-        else:
-            local_datetime = datetime.utcnow() + timedelta(minutes=city.time_offset)
-            gmt_offset = f'\\+{city.time_offset // 60}' if city.time_offset >= 0 else city.time_offset // 60
+class ActionShowForecast(AbstractCityAction):
+    def __init__(self, bot):
+        super().__init__(bot, 'show_forecast')
+
+    async def handle(self, args: list, update: Update, ctx):
+        if len(args) < 1:
+            print(f'[Callback] Failed: there are no city_id argument received!')
+            return
+
+        city_id = args[0]
+        renderer: MessageRenderer = self.bot.renderer
+        query: CallbackQuery = update.callback_query
 
-            condition: WeatherCondition = self.get_condition(weather_data.condition_code)
-            condition_text: str = condition.get_text(weather_data.is_day)
-            condition_emoji: str = condition.get_emoji(weather_data.is_day)
+        await self.edit_message(query, renderer.render_forecast(city_id), self.get_back_keyboard(city_id))
 
-            time_delta: timedelta = datetime.now() - weather_data.date_time
-            update_time_ago: int = round(time_delta.total_seconds() / 60.0)
 
-            if update_time_ago == 0:
-                update_time_ago = 1
+class ActionSetFavorite(AbstractCityAction):
+    def __init__(self, bot):
+        super().__init__(bot, 'set_favorite')
 
-            await query.edit_message_text(
-                f"""
-*Информация о текущей погоде*
+    async def handle(self, args: list, update: Update, ctx):
+        if len(args) < 1:
+            print(f'[Callback] Failed: there are no city_id argument received!')
+            return
 
-*Город:* {city.name} {city.emoji}
-_{condition_text}_ {condition_emoji}
+        city_id = args[0]
+        texts = self.get_city_texts(city_id)
+        if texts is None:
+            return
 
-○ Местное время:  `{local_datetime.strftime('%d.%m.%y %H:%M:%S')}`  `GMT{gmt_offset}`
-○ Температура:  `{round(weather_data.temp_c)}°C / {round(weather_data.temp_f)}°F`
-○ Ощущается как:  `{round(weather_data.feelslike_c)}°C / {round(weather_data.feelslike_f)}°F`
-○ Влажность:  `{weather_data.humidity}%`
-○ Облачность:  `{weather_data.cloud}%`
+        state_store: StateStore = self.bot.state_store
+        state_store.set_favorite_city(update.effective_user.id, city_id)
 
-Последнее обновление: *{update_time_ago} мин\\. назад*
-                """,
-                parse_mode=ParseMode.MARKDOWN_V2,
-                reply_markup=ActionShowWeather.construct_keyboard(city_id)
-            )
+        query: CallbackQuery = update.callback_query
+        await self.edit_message(query, texts.favorite_set, self.get_city_keyboards(city_id).select_city)
@@ -0,0 +1,203 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
+from telegram.constants import ParseMode
+from telegram.error import Forbidden
+from telegram.ext import ExtBot
+
+from metrics import ALERTS_SENT
+from ratelimit import TokenBucket
+from weather import CityWeatherData
+
+
+class SubscriptionIndex:
+    def __init__(self):
+        # city id -> chat ids, walked by the fan-out
+        self.subscribers = dict()
+        # chat id -> city ids, for the commands
+        self.subscriptions = dict()
+        # called with (chat id, city id, subscribed) on every change
+        self.listener = None
+
+    def subscribe(self, chat_id: int, city_id: str) -> bool:
+        cities: set = self.subscriptions.setdefault(chat_id, set())
+        if city_id in cities:
+            return False
+
+        cities.add(city_id)
+        self.subscribers.setdefault(city_id, set()).add(chat_id)
+
+        if self.listener is not None:
+            self.listener(chat_id, city_id, True)
+        return True
+
+    def unsubscribe(self, chat_id: int, city_id: str) -> bool:
+        cities: set = self.subscriptions.get(chat_id)
+        if cities is None or city_id not in cities:
+            return False
+
+        cities.discard(city_id)
+        if len(cities) == 0:
+            del self.subscriptions[chat_id]
+
+        chats: set = self.subscribers[city_id]
+        chats.discard(chat_id)
+        if len(chats) == 0:
+            del self.subscribers[city_id]
+
+        if self.listener is not None:
+            self.listener(chat_id, city_id, False)
+        return True
+
+    def unsubscribe_all(self, chat_id: int) -> list:
+        city_ids = list(self.subscriptions.get(chat_id, ()))
+        for city_id in city_ids:
+            self.unsubscribe(chat_id, city_id)
+        return city_ids
+
+    def get_subscribers(self, city_id: str) -> set:
+        return self.subscribers.get(city_id, set())
+
+    def get_subscriptions(self, chat_id: int) -> set:
+        return self.subscriptions.get(chat_id, set())
+
+
+class AlertEngine:
+    def __init__(self, bot):
+        self.bot = bot
+        prefs = bot.prefs
+        self.temperature_step: float = prefs.alert_temperature_step
+        self.min_interval: float = prefs.alert_min_interval
+        self.batch_size: int = max(1, prefs.alert_batch_size)
+        # alerts take only a part of the outgoing rate limit, so replies to users aren't held back
+        self.bucket = TokenBucket(prefs.alert_messages_per_second, prefs.alert_messages_per_second)
+
+        self.index = SubscriptionIndex()
+        # city id -> (condition code, temperature) of the last reading users were alerted about
+        self.baselines = dict()
+        self.alerted_at = dict()
+        # city id -> end of the cooldown, a change which came during it is checked again then
+        self.deferred = dict()
+        # city id -> rendered alert, in the order of arrival
+        self.pending = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def is_meaningful(self, baseline: tuple, data: CityWeatherData) -> bool:
+        condition_code, temp_c = baseline
+        return data.condition_code != condition_code or abs(data.temp_c - temp_c) >= self.temperature_step
+
+    def on_weather_update(self, city_id: str, data: CityWeatherData):
+        baseline = self.baselines.get(city_id)
+        if baseline is None:
+            self.baselines[city_id] = (data.condition_code, data.temp_c)
+            return
+
+        if not self.is_meaningful(baseline, data):
+            return
+
+        if len(self.index.get_subscribers(city_id)) == 0:
+            # nobody to alert, the change just becomes the new baseline
+            self.baselines[city_id] = (data.condition_code, data.temp_c)
+            return
+
+        # the baseline stays, so the next reading after the cooldown is still compared against it
+        now = monotonic()
+        alerted_at = self.alerted_at.get(city_id)
+        if alerted_at is not None and now - alerted_at < self.min_interval:
+            # the readings may not change again, so it's not left to the next update
+            self.deferred[city_id] = alerted_at + self.min_interval
+            self.wakeup.set()
+            return
+
+        self.deferred.pop(city_id, None)
+        self.baselines[city_id] = (data.condition_code, data.temp_c)
+        self.alerted_at[city_id] = now
+        # rendered once for every subscriber of the city, a newer alert replaces an unsent one
+        self.pending[city_id] = self.bot.renderer.render_alert(city_id, baseline[1], data)
+        self.pending.move_to_end(city_id)
+        self.wakeup.set()
+
+    def forget_cities(self, city_ids: list):
+        for city_id in city_ids:
+            for chat_id in list(self.index.get_subscribers(city_id)):
+                self.index.unsubscribe(chat_id, city_id)
+            self.baselines.pop(city_id, None)
+            self.alerted_at.pop(city_id, None)
+            self.deferred.pop(city_id, None)
+            self.pending.pop(city_id, None)
+
+    def seed_baselines(self):
+        # weather restored from the snapshot, so the first change after a restart is compared against it
+        for city_id, data in self.bot.weather_service.cache.items():
+            self.baselines.setdefault(city_id, (data.condition_code, data.temp_c))
+
+    def check_deferred(self):
+        now = monotonic()
+        due = [city_id for city_id, deferred_until in self.deferred.items() if deferred_until <= now]
+        for city_id in due:
+            del self.deferred[city_id]
+            data = self.bot.weather_service.cache.get(city_id)
+            if data is not None:
+                self.on_weather_update(city_id, data)
+
+    def time_until_deferred(self):
+        if len(self.deferred) == 0:
+            return None
+        return max(0.0, min(self.deferred.values()) - monotonic())
+
+    def start(self):
+        self.seed_baselines()
+        self.task = asyncio.get_running_loop().create_task(self.run(), name='Alert Fan-out')
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.time_until_deferred())
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            self.check_deferred()
+
+            while len(self.pending) != 0:
+                city_id, (text, reply_markup) = self.pending.popitem(last=False)
+                await self.fan_out(city_id, text, reply_markup)
+
+    async def fan_out(self, city_id: str, text: str, reply_markup):
+        bot: ExtBot = self.bot.get()
+        # a copy, subscriptions may change while the alert is being sent
+        chat_ids = list(self.index.get_subscribers(city_id))
+
+        for i in range(0, len(chat_ids), self.batch_size):
+            batch = chat_ids[i:i + self.batch_size]
+            tasks = list()
+
+            for chat_id in batch:
+                await self.bucket.acquire()
+                tasks.append(asyncio.create_task(
+                    bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=reply_markup)
+                ))
+
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for chat_id, result in zip(batch, results):
+                if isinstance(result, Forbidden):
+                    # the bot was blocked or removed from the chat
+                    ALERTS_SENT.inc('blocked')
+                    self.index.unsubscribe_all(chat_id)
+                elif isinstance(result, Exception):
+                    ALERTS_SENT.inc('failed')
+                    print(f"[Alerts] Failed to send an alert for '{city_id}' to chat {chat_id}: {result}")
+                else:
+                    ALERTS_SENT.inc('sent')
+
+        print(f"[Alerts] Weather alert for '{city_id}' was sent to {len(chat_ids)} chats.")
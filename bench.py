@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from itertools import count
+from time import perf_counter, time
+
+from telegram import Update
+from telegram.ext import Application
+
+from bot import Bot, Preferences
+from callbacks import callback_data
+from data import DataLoader
+from fakes import FakeBotApiServer, FakeWeatherServer
+
+SCENARIOS = ('start', 'select_city', 'show_weather', 'show_forecast', 'show_photos', 'photo')
+WEATHER_WARMUP_TIMEOUT = 10
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class ScenarioReport:
+    def __init__(self, scenario: str, latencies: list, errors: int, elapsed: float, api_requests: int):
+        self.scenario = scenario
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+        self.api_requests = api_requests
+
+    def throughput(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def p50(self) -> float:
+        return percentile(self.latencies, 0.50) * 1000
+
+    def p99(self) -> float:
+        return percentile(self.latencies, 0.99) * 1000
+
+    def format(self) -> str:
+        return f'{self.scenario:<14}{len(self.latencies):>9}{self.errors:>8}{self.throughput():>12.1f}' \
+               f'{self.p50():>10.2f}{self.p99():>10.2f}{self.api_requests:>11}'
+
+
+class LoadGenerator:
+    def __init__(self, bot: Bot, bot_api: FakeBotApiServer, users: int):
+        self.bot = bot
+        self.bot_api = bot_api
+        self.users = users
+        self.update_ids = count(1)
+        self.message_ids = count(1)
+        self.errors = 0
+
+        data_loader: DataLoader = bot.data_loader
+        self.city_ids = data_loader.get_city_ids(False)
+
+    def make_user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'bench_{user_id}'}
+
+    def make_message(self, user_id: int, **content) -> dict:
+        return {
+            'message_id': next(self.message_ids),
+            'date': int(time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self.make_user(user_id),
+            **content
+        }
+
+    def make_callback(self, user_id: int, data: str) -> dict:
+        # every callback comes from its own message, so edits are never skipped as already shown
+        message = self.make_message(user_id, text='🏘 Выберите город из списка:')
+        message['from'] = FakeBotApiServer.BOT_USER
+        return {'id': str(next(self.update_ids)), 'from': self.make_user(user_id), 'chat_instance': str(user_id), 'data': data, 'message': message}
+
+    def make_update(self, scenario: str, index: int) -> dict:
+        user_id = 1 + index % self.users
+        city_id = self.city_ids[index % len(self.city_ids)]
+        update = {'update_id': next(self.update_ids)}
+
+        if scenario == 'start':
+            update['message'] = self.make_message(user_id, text='/start', entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])
+        elif scenario == 'photo':
+            photo = {'file_id': 'bench-photo', 'file_unique_id': 'bench-photo', 'width': 640, 'height': 480}
+            update['message'] = self.make_message(user_id, photo=[photo])
+        else:
+            update['callback_query'] = self.make_callback(user_id, callback_data(scenario, city_id))
+
+        return update
+
+    async def on_error(self, update, ctx):
+        self.errors += 1
+
+    async def run_scenario(self, scenario: str, total: int, concurrency: int) -> ScenarioReport:
+        app: Application = self.bot.app
+        # updates are built upfront, so only their handling is measured
+        updates = [Update.de_json(self.make_update(scenario, index), app.bot) for index in range(total)]
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = list()
+
+        async def process(update: Update):
+            async with semaphore:
+                started_at = perf_counter()
+                await app.process_update(update)
+                latencies.append(perf_counter() - started_at)
+
+        self.errors = 0
+        api_requests = self.bot_api.requests_count
+        started_at = perf_counter()
+        await asyncio.gather(*[process(update) for update in updates])
+        elapsed = perf_counter() - started_at
+
+        return ScenarioReport(scenario, latencies, self.errors, elapsed, self.bot_api.requests_count - api_requests)
+
+
+async def run_benchmark(args) -> list:
+    weather_api = FakeWeatherServer(latency=args.weather_latency, error_rate=args.weather_error_rate)
+    bot_api = FakeBotApiServer(latency=args.telegram_latency)
+    await weather_api.start()
+    await bot_api.start()
+
+    temp_directory = tempfile.mkdtemp(prefix='bench-')
+    prefs = Preferences('123456:bench', 'bench')
+    prefs.telegram_api_url = bot_api.api_url()
+    prefs.weather_api_url = weather_api.api_url()
+    prefs.weather_snapshot_file = os.path.join(temp_directory, 'weather_cache.bin')
+    prefs.photo_index_file = os.path.join(temp_directory, 'photo_index.json')
+    prefs.state_database_file = os.path.join(temp_directory, 'state.sqlite')
+    prefs.photo_preprocessing = False
+    if not args.rate_limit:
+        # the fake API has no flood limits, so by default the handlers themselves are measured
+        prefs.telegram_messages_per_second = 1e9
+        prefs.telegram_chat_messages_per_second = 1e9
+        prefs.telegram_group_messages_per_minute = 1e9
+
+    bot = Bot()
+    bot.use_preferences(prefs)
+    bot.load()
+
+    app: Application = bot.app
+    generator = LoadGenerator(bot, bot_api, args.users)
+    app.add_error_handler(generator.on_error)
+
+    await app.initialize()
+    await bot.post_init(app)
+    await app.start()
+
+    reports = list()
+    try:
+        warmup_deadline = perf_counter() + WEATHER_WARMUP_TIMEOUT
+        while len(bot.weather_service.cache) == 0 and perf_counter() < warmup_deadline:
+            await asyncio.sleep(0.1)
+        while bot.forecast_service is not None and len(bot.forecast_service.store.rows) == 0 \
+                and perf_counter() < warmup_deadline:
+            await asyncio.sleep(0.1)
+
+        for scenario in args.scenarios:
+            reports.append(await generator.run_scenario(scenario, args.updates, args.concurrency))
+    finally:
+        await app.stop()
+        await app.shutdown()
+        await bot.post_shutdown(app)
+        await bot_api.stop()
+        await weather_api.stop()
+
+    print('')
+    print(f'{"scenario":<14}{"updates":>9}{"errors":>8}{"updates/s":>12}{"p50 ms":>10}{"p99 ms":>10}{"api calls":>11}')
+    for report in reports:
+        print(report.format())
+    print(f'Weather API: {weather_api.requests_count} requests for {weather_api.locations_count} locations')
+
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the bot handlers against fake Telegram and weather APIs.')
+    parser.add_argument('--updates', type=int, default=2000, help='updates per scenario')
+    parser.add_argument('--concurrency', type=int, default=64, help='updates processed at the same time')
+    parser.add_argument('--users', type=int, default=500, help='distinct users sending updates')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='seconds per fake Bot API request')
+    parser.add_argument('--weather-latency', type=float, default=0.0, help='seconds per fake weather API request')
+    parser.add_argument('--weather-error-rate', type=float, default=0.0, help='share of failing weather API requests')
+    parser.add_argument('--rate-limit', action='store_true', help='keep the real Telegram rate limits')
+    parser.add_argument('--max-p99-ms', type=float, default=None, help='exit with an error when any p99 is above it')
+    args = parser.parse_args()
+
+    reports = asyncio.run(run_benchmark(args))
+
+    if args.max_p99_ms is not None:
+        slow = [report.scenario for report in reports if report.p99() > args.max_p99_ms]
+        if len(slow) != 0:
+            print(f'p99 latency is above {args.max_p99_ms} ms for: {", ".join(slow)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
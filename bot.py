@@ -1,15 +1,96 @@
-import yaml
+from time import perf_counter
+
+# taken before the other imports, so they are a part of the startup report
+STARTED_AT = perf_counter()
 
-from telegram.ext import Application, ApplicationBuilder, MessageHandler, CallbackContext
-from telegram.ext.filters import *
+import asyncio
+import importlib.util
+import signal
 
-from actions import *
-from commands import *
-from data import *
+import yaml
+
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder, ExtBot, MessageHandler, TypeHandler, CallbackContext, filters
+
+from actions import (
+    AbstractAction, CallbackHandler, ActionDeleteMessages, ActionShowCities, ActionSelectCity, ActionShowCityInfo,
+    ActionShowPhotos, ActionShowWeather, ActionShowForecast, ActionSetFavorite
+)
+from alerts import AlertEngine
+from commands import AbstractCommand, CommandStart, CommandBye, CommandHelp, CommandSubscribe, CommandUnsubscribe
+from data import DataLoader
+from callbacks import CallbackCodec
+from inline import InlineSearchHandler
+from keyboards import KeyboardCache
+from metrics import MetricsServer, UPDATES
+from persistence import WeatherSnapshot
+from photos import PhotoLibrary
+from ratelimit import OutboundRateLimiter
+from reload import DataWatcher
+from render import MessageRenderer
+from state import StateStore
+from updates import ChatOrderedUpdateProcessor
 from weather import WeatherService
 
 
 class Preferences:
+    weather_max_concurrency: int = 8
+    weather_requests_per_minute: int = 60
+    weather_min_refresh_interval: int = 900
+    weather_max_refresh_interval: int = 10800
+    weather_bulk_batch_size: int = 50
+    weather_api_url: str = 'https://api.weatherapi.com/v1'
+    weather_snapshot_file: str = 'weather_cache.bin'
+    weather_snapshot_interval: int = 300
+    weather_snapshot_max_age: int = 10800
+    weather_history_size: int = 24
+    weather_connect_timeout: float = 3
+    weather_read_timeout: float = 10
+    weather_circuit_failure_threshold: int = 5
+    weather_circuit_reset_timeout: int = 30
+    weather_stale_after: int = 14400
+    city_catalog_backend: str = 'memory'
+    city_catalog_cache_size: int = 10000
+    city_list_page_size: int = 8
+    city_list_columns: int = 2
+    city_list_alphabetical: bool = False
+    nearest_cities_count: int = 5
+    weather_share_radius_km: float = 0
+    inline_cache_time: int = 300
+    callback_token_ttl: int = 86400
+    callback_token_store_size: int = 100000
+    photo_index_file: str = 'data/photo_index.json'
+    photo_storage_chat_id: int = None
+    photo_upload_concurrency: int = 4
+    photo_preprocessing: bool = True
+    photo_preprocess_manifest: str = 'data/photos/.preprocessed.json'
+    photo_preprocess_workers: int = 0
+    photo_max_size: int = 1280
+    photo_quality: int = 85
+    telegram_api_url: str = 'https://api.telegram.org'
+    telegram_messages_per_second: float = 30
+    telegram_chat_messages_per_second: float = 1
+    telegram_group_messages_per_minute: float = 20
+    telegram_max_retries: int = 3
+    telegram_concurrent_updates: int = 64
+    webhook_url: str = None
+    webhook_listen: str = '0.0.0.0'
+    webhook_port: int = 8443
+    webhook_secret_token: str = None
+    cluster_workers: int = 0
+    metrics_listen: str = '127.0.0.1'
+    metrics_port: int = None
+    data_reload_interval: float = 5
+    forecast_days: int = 3
+    forecast_refresh_interval: int = 10800
+    alert_temperature_step: float = 5
+    alert_min_interval: int = 1800
+    alert_messages_per_second: float = 20
+    alert_batch_size: int = 100
+    alert_subscriptions_limit: int = 10
+    state_database_file: str = 'data/state.sqlite'
+    state_flush_interval: float = 5
+
     def __init__(self, telegram_bot_token: str, weather_api_key: str):
         self.telegram_bot_token: str = telegram_bot_token
         self.weather_api_key: str = weather_api_key
@@ -17,7 +98,26 @@ class Preferences:
     @staticmethod
     def load():
         file = open('preferences.yml', 'r', encoding='UTF-8')
-        return yaml.load(file, yaml.Loader)
+        # the LibYAML based loader is much faster, but it's only available when PyYAML was built with it
+        return yaml.load(file, getattr(yaml, 'CLoader', yaml.Loader))
+
+
+class StartupReport:
+    def __init__(self, started_at: float):
+        self.started_at = started_at
+        self.marked_at = started_at
+        self.stages = list()
+
+    def mark(self, stage: str):
+        now = perf_counter()
+        self.stages.append((stage, now - self.marked_at))
+        self.marked_at = now
+
+    def print(self):
+        print('Startup timing:')
+        for stage, duration in self.stages:
+            print(f'  {stage:<16}{duration * 1000:>9.1f} ms')
+        print(f'  {"ready after":<16}{(self.marked_at - self.started_at) * 1000:>9.1f} ms')
 
 
 class Bot:
@@ -27,11 +127,27 @@ class Bot:
         self.weather_api_key = None
         self.app = None
         self.data_loader = None
+        self.data_watcher = None
+        self.renderer = None
+        self.keyboards = None
+        self.inline_search = None
+        self.callback_codec = None
+        self.photo_library = None
         self.weather_service = None
+        self.weather_snapshot = None
+        self.forecast_service = None
+        self.alert_engine = None
+        self.state_store = None
+        # (worker index, workers count) in cluster mode, the worker only handles chats of its shard
+        self.shard = None
+        self.metrics_server = None
 
         self.registered_commands = dict()
         self.registered_actions = dict()
 
+        self.startup_report = StartupReport(STARTED_AT)
+        self.startup_report.mark('imports')
+
     def app(self) -> Application:
         return self.app
 
@@ -39,26 +155,121 @@ class Bot:
         return self.app.bot
 
     def load(self):
+        if self.prefs is None:
+            self.load_preferences()
+
+        self.load_data()
+        self.load_weather()
+        self.load_app()
+
+    def load_preferences(self):
         print('Loading preferences...')
-        self.prefs: Preferences = Preferences.load()
-        self.telegram_token = self.prefs.telegram_bot_token
-        self.weather_api_key = self.prefs.weather_api_key
+        self.use_preferences(Preferences.load())
+        self.startup_report.mark('preferences')
+
+    def use_preferences(self, prefs: Preferences):
+        # checked upfront, so a misconfigured instance fails before starting anything
+        if prefs.webhook_url is not None and not prefs.webhook_secret_token:
+            raise ValueError('webhook_secret_token has to be set when webhook_url is')
+
+        self.prefs = prefs
+        self.telegram_token = prefs.telegram_bot_token
+        self.weather_api_key = prefs.weather_api_key
 
+    def load_data(self):
         print('Loading data...')
-        self.data_loader: DataLoader = DataLoader()
+        self.data_loader: DataLoader = DataLoader(self.prefs.city_catalog_backend, self.prefs.city_catalog_cache_size)
         self.data_loader.load()
+        self.data_watcher: DataWatcher = DataWatcher(self, self.prefs.data_reload_interval)
+        self.startup_report.mark('data')
 
+    def load_weather(self, restore_snapshot: bool = True):
         print('Initializing Weather Service...')
         self.weather_service: WeatherService = WeatherService(self)
-        self.weather_service.start()
+
+        self.weather_snapshot: WeatherSnapshot = WeatherSnapshot(
+            self.weather_service,
+            self.prefs.weather_snapshot_file,
+            self.prefs.weather_snapshot_interval,
+            self.prefs.weather_snapshot_max_age
+        )
+
+        if restore_snapshot:
+            restored = self.weather_snapshot.load()
+            print(f'Restored weather data for {restored} cities from the snapshot.')
+
+        if self.prefs.forecast_days > 0:
+            if importlib.util.find_spec('numpy') is None:
+                print('[Forecast] NumPy is not installed, forecasts are disabled.')
+            else:
+                # NumPy takes a while to import, so it's only loaded when forecasts are enabled
+                from forecast import ForecastService
+                self.forecast_service = ForecastService(self)
+
+        self.startup_report.mark('weather')
+
+    def load_state(self):
+        self.state_store: StateStore = StateStore(self.prefs.state_database_file, self.prefs.state_flush_interval)
+        self.state_store.open()
+        users = self.state_store.load_users()
+
+        index = self.alert_engine.index
+        subscriptions = self.state_store.load_subscriptions(self.owns_chat)
+        for chat_id, city_id in subscriptions:
+            index.subscribe(chat_id, city_id)
+        # attached after the restore, so restored subscriptions aren't written back
+        index.listener = self.state_store.on_subscription_change
+
+        print(f'Restored {users} users and {len(subscriptions)} subscriptions.')
+
+    def owns_chat(self, chat_id: int) -> bool:
+        return self.shard is None or chat_id % self.shard[1] == self.shard[0]
+
+    def load_app(self):
+        self.callback_codec = CallbackCodec(self.prefs.callback_token_ttl, self.prefs.callback_token_store_size)
+
+        self.renderer: MessageRenderer = MessageRenderer(self)
+        self.renderer.build()
+        self.weather_service.add_listener(self.renderer.on_weather_update)
+        if self.forecast_service is not None:
+            self.forecast_service.add_listener(self.renderer.on_forecast_update)
+
+        self.alert_engine: AlertEngine = AlertEngine(self)
+        self.weather_service.add_listener(self.alert_engine.on_weather_update)
+        self.load_state()
+
+        self.keyboards: KeyboardCache = KeyboardCache(self)
+        self.keyboards.build()
+
+        self.inline_search: InlineSearchHandler = InlineSearchHandler(self)
+        self.inline_search.build()
+
+        self.photo_library: PhotoLibrary = PhotoLibrary(self)
 
         print('Initializing application...')
-        self.app = ApplicationBuilder().token(self.telegram_token).build()
+        rate_limiter = OutboundRateLimiter(
+            self.prefs.telegram_messages_per_second,
+            self.prefs.telegram_chat_messages_per_second,
+            self.prefs.telegram_group_messages_per_minute,
+            self.prefs.telegram_max_retries
+        )
+
+        self.app = ApplicationBuilder() \
+            .token(self.telegram_token) \
+            .base_url(f'{self.prefs.telegram_api_url}/bot') \
+            .base_file_url(f'{self.prefs.telegram_api_url}/file/bot') \
+            .rate_limiter(rate_limiter) \
+            .concurrent_updates(ChatOrderedUpdateProcessor(self.prefs.telegram_concurrent_updates)) \
+            .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown) \
+            .build()
 
         print('Registering commands...')
         self.register_command(CommandStart(self))
         self.register_command(CommandBye(self))
         self.register_command(CommandHelp(self))
+        self.register_command(CommandSubscribe(self))
+        self.register_command(CommandUnsubscribe(self))
 
         print('Registering actions...')
         self.register_action(ActionDeleteMessages(self))
@@ -67,11 +278,17 @@ class Bot:
         self.register_action(ActionShowCityInfo(self))
         self.register_action(ActionShowPhotos(self))
         self.register_action(ActionShowWeather(self))
+        self.register_action(ActionShowForecast(self))
+        self.register_action(ActionSetFavorite(self))
 
         print('Registering handlers...')
         self.register_handlers()
+        self.startup_report.mark('application')
 
     def register_handlers(self):
+        # update counter, runs before every other handler
+        self.app.add_handler(TypeHandler(Update, Bot.count_update), group=-1)
+
         # command handlers
         for command in self.registered_commands.values():
             command.register()
@@ -79,9 +296,13 @@ class Bot:
         # callback handler
         CallbackHandler(self).register()
 
+        # inline query handler
+        self.inline_search.register()
+
         # message handler
         app: Application = self.app
-        app.add_handler(MessageHandler(filters=PHOTO | ATTACHMENT, callback=self.handle_user_photo_message))
+        app.add_handler(MessageHandler(filters=filters.PHOTO | filters.ATTACHMENT, callback=self.handle_user_photo_message))
+        app.add_handler(MessageHandler(filters=filters.LOCATION, callback=self.handle_user_location_message))
         app.add_error_handler(callback=Bot.handle_error)
 
     def register_command(self, command: AbstractCommand):
@@ -91,12 +312,107 @@ class Bot:
         self.registered_actions[action.action_key] = action
 
     def start(self):
+        if self.prefs.webhook_url is not None:
+            print('Running Webhook...')
+            print('')
+            asyncio.run(self.run_webhook())
+            return
+
         print('Running LongPoll...')
         print('')
 
-        CallbackHandler(self).register()
         self.app.run_polling()
 
+    async def run_webhook(self):
+        from webhook import WebhookServer
+
+        app: Application = self.app
+        server = WebhookServer(
+            self.prefs.webhook_url,
+            self.prefs.webhook_listen,
+            self.prefs.webhook_port,
+            self.prefs.webhook_secret_token,
+            self.enqueue_update
+        )
+
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(stop_signal, stop_event.set)
+
+        await app.initialize()
+        await self.post_init(app)
+        await app.start()
+
+        try:
+            await server.start()
+            await server.register(app.bot)
+            print(f'Listening for updates on {server.url(server.path)}')
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            await app.stop()
+            await app.shutdown()
+            await self.post_shutdown(app)
+
+    async def enqueue_update(self, raw: dict):
+        app: Application = self.app
+        await app.update_queue.put(Update.de_json(raw, app.bot))
+
+    async def start_metrics(self, port_offset: int = 0):
+        if self.prefs.metrics_port is None:
+            return
+
+        self.metrics_server = MetricsServer(self.prefs.metrics_listen, self.prefs.metrics_port + port_offset)
+        await self.metrics_server.start()
+        print(f'Serving metrics on {self.metrics_server.url("/metrics")}')
+
+    async def stop_metrics(self):
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+            self.metrics_server = None
+
+    async def post_init(self, app: Application):
+        await self.start_metrics()
+
+        print('Starting Weather Service...')
+        self.weather_service.start()
+        self.weather_snapshot.start()
+        if self.forecast_service is not None:
+            self.forecast_service.start()
+
+        print('Starting Photo Sync...')
+        self.photo_library.start()
+        self.alert_engine.start()
+        self.state_store.start()
+        self.data_watcher.start()
+
+        self.startup_report.mark('initialization')
+        self.startup_report.print()
+
+    async def post_shutdown(self, app: Application):
+        await self.data_watcher.stop()
+        await self.alert_engine.stop()
+        await self.state_store.stop()
+        await self.photo_library.stop()
+
+        print('Stopping Weather Service...')
+        if self.forecast_service is not None:
+            await self.forecast_service.stop()
+        await self.weather_service.stop()
+
+        print('Saving weather snapshot...')
+        await self.weather_snapshot.stop()
+
+        await self.stop_metrics()
+
+    @staticmethod
+    async def count_update(update: Update, ctx):
+        for update_type in Update.ALL_TYPES:
+            if getattr(update, update_type) is not None:
+                UPDATES.inc(update_type)
+                return
+
     async def handle_user_photo_message(self, update: Update, ctx):
         has_photo: bool = False
 
@@ -117,6 +433,22 @@ class Bot:
             reply_to_message_id=update.message.message_id
         )
 
+    async def handle_user_location_message(self, update: Update, ctx):
+        location = update.message.location
+        if location is None:
+            return
+
+        data_loader: DataLoader = self.data_loader
+        nearest_cities = data_loader.get_nearest_cities(location.latitude, location.longitude, self.prefs.nearest_cities_count)
+        if len(nearest_cities) == 0:
+            return
+
+        await update.message.reply_text(
+            '📍 Ближайшие к вам города:',
+            reply_to_message_id=update.message.message_id,
+            reply_markup=KeyboardCache.construct_nearest_cities(nearest_cities)
+        )
+
     @staticmethod
     async def handle_error(update, ctx: CallbackContext):
         error: Exception = ctx.error
@@ -127,13 +459,22 @@ class Bot:
         print(f"  {error}")
 
 
-print("""
+
+if __name__ == '__main__':
+    print("""
 -------------------------
  Traveller Conductor Bot
     written by @soknight
 -------------------------
 """)
 
-bot = Bot()
-bot.load()
-bot.start()
+    bot = Bot()
+    bot.load_preferences()
+
+    if bot.prefs.cluster_workers > 1:
+        from cluster import ClusterSupervisor
+
+        ClusterSupervisor(Bot, bot.prefs).run()
+    else:
+        bot.load()
+        bot.start()
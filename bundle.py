@@ -0,0 +1,82 @@
+import marshal
+import os
+
+from files import atomic_write, hash_file
+
+
+class DataBundle:
+    VERSION = 1
+
+    def __init__(self, path: str, source_paths: dict):
+        self.path = path
+        # name -> path of the source file the bundled data was parsed from
+        self.source_paths = source_paths
+
+    @staticmethod
+    def describe_source(path: str) -> list:
+        stat = os.stat(path)
+        return [path, stat.st_mtime_ns, stat.st_size, hash_file(path)]
+
+    def describe_sources(self) -> dict:
+        return {name: DataBundle.describe_source(path) for name, path in self.source_paths.items()}
+
+    def load_or_build(self, build) -> dict:
+        data = self.load()
+        if data is not None:
+            return data
+
+        # described before parsing, so a source changed in the meantime invalidates the bundle
+        sources = self.describe_sources()
+        data = build()
+        self.save(data, sources)
+        return data
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as file:
+                bundle = marshal.loads(file.read())
+        except FileNotFoundError:
+            return None
+        except (EOFError, ValueError, TypeError) as error:
+            print(f"[Data Bundle] Ignoring corrupted bundle '{self.path}': {error}")
+            return None
+
+        # marshal format may change between interpreter versions
+        if not isinstance(bundle, dict) or bundle.get('version') != (DataBundle.VERSION, marshal.version):
+            return None
+
+        sources: dict = bundle['sources']
+        if sources.keys() != self.source_paths.keys():
+            return None
+
+        touched = False
+        for name, source_path in self.source_paths.items():
+            path, mtime_ns, size, content_hash = sources[name]
+            if path != source_path:
+                return None
+
+            stat = os.stat(source_path)
+            if stat.st_mtime_ns == mtime_ns and stat.st_size == size:
+                continue
+
+            # touched by a checkout or a copy, but the content is the same
+            if stat.st_size != size or hash_file(source_path) != content_hash:
+                return None
+            touched = True
+
+        if touched:
+            self.save(bundle['data'], self.describe_sources())
+
+        return bundle['data']
+
+    def save(self, data: dict, sources: dict):
+        bundle = {
+            'version': (DataBundle.VERSION, marshal.version),
+            'sources': sources,
+            'data': data
+        }
+
+        try:
+            atomic_write(self.path, marshal.dumps(bundle))
+        except OSError as error:
+            print(f"[Data Bundle] Failed to save bundle '{self.path}': {error}")
@@ -0,0 +1,158 @@
+import base64
+import secrets
+from collections import OrderedDict
+from time import monotonic
+
+# Opcodes are stored in the callback data of already sent messages, never reuse or renumber them
+ACTION_CODES = {
+    'delete': 1,
+    'show_cities': 2,
+    'select_city': 3,
+    'show_city_info': 4,
+    'show_photos': 5,
+    'show_weather': 6,
+    'show_forecast': 7,
+    'set_favorite': 8,
+}
+
+BINARY_PREFIX = '!'
+TOKEN_PREFIX = '~'
+LEGACY_PREFIX = '#'
+
+# Telegram limits callback data to 64 bytes
+MAX_CALLBACK_DATA_LENGTH = 64
+
+
+def write_varint(buffer: bytearray, value: int):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(raw: bytes, offset: int) -> tuple:
+    value = 0
+    shift = 0
+
+    while True:
+        byte = raw[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_commands(commands) -> str:
+    buffer = bytearray()
+
+    for action_key, *args in commands:
+        buffer.append(ACTION_CODES[action_key])
+        buffer.append(len(args))
+
+        for arg in args:
+            if isinstance(arg, int):
+                # zigzag keeps negative chat ids short
+                write_varint(buffer, (((arg << 1) ^ (arg >> 63)) << 1) | 1)
+            else:
+                encoded = str(arg).encode('UTF-8')
+                write_varint(buffer, len(encoded) << 1)
+                buffer += encoded
+
+    return BINARY_PREFIX + base64.urlsafe_b64encode(bytes(buffer)).decode('ascii').rstrip('=')
+
+
+def decode_commands(data: str) -> list:
+    if data.startswith(BINARY_PREFIX):
+        return decode_binary_commands(data[1:])
+
+    # messages sent before the binary format carry '#command arg\n#command arg' strings
+    commands = list()
+    for line in data.split('\n'):
+        if line.startswith(LEGACY_PREFIX):
+            args = line[1:].split(' ')
+            action_key = args.pop(0)
+            commands.append((ACTION_CODES.get(action_key, 0), args))
+
+    return commands
+
+
+def decode_binary_commands(payload: str) -> list:
+    raw = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+    commands = list()
+    offset = 0
+
+    while offset < len(raw):
+        opcode = raw[offset]
+        args_count = raw[offset + 1]
+        offset += 2
+
+        args = list()
+        for _ in range(args_count):
+            header, offset = read_varint(raw, offset)
+            if header & 1:
+                value = header >> 1
+                args.append(str((value >> 1) ^ -(value & 1)))
+            else:
+                length = header >> 1
+                args.append(raw[offset:offset + length].decode('UTF-8'))
+                offset += length
+
+        commands.append((opcode, args))
+
+    return commands
+
+
+def callback_data(action_key: str, *args) -> str:
+    data = encode_commands([(action_key, *args)])
+    if len(data) > MAX_CALLBACK_DATA_LENGTH:
+        raise ValueError(f"callback data for '{action_key}' exceeds {MAX_CALLBACK_DATA_LENGTH} bytes")
+    return data
+
+
+class CallbackTokenStore:
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def put(self, commands: list) -> str:
+        token = secrets.token_urlsafe(12)
+        self.entries[token] = (monotonic() + self.ttl, commands)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return token
+
+    def get(self, token: str):
+        entry = self.entries.get(token)
+        if entry is None:
+            return None
+
+        expires_at, commands = entry
+        if expires_at < monotonic():
+            del self.entries[token]
+            return None
+
+        self.entries.move_to_end(token)
+        return commands
+
+
+class CallbackCodec:
+    def __init__(self, token_ttl: int, token_store_size: int):
+        self.tokens = CallbackTokenStore(token_ttl, token_store_size)
+
+    def pack(self, *commands) -> str:
+        data = encode_commands(commands)
+        if len(data) <= MAX_CALLBACK_DATA_LENGTH:
+            return data
+
+        # doesn't fit into the button, so only a reference to the server side copy is sent
+        return TOKEN_PREFIX + self.tokens.put(decode_binary_commands(data[1:]))
+
+    def unpack(self, data: str):
+        if data.startswith(TOKEN_PREFIX):
+            return self.tokens.get(data[1:])
+
+        return decode_commands(data)
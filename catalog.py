@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+
+from caching import LruCache
+from data import CityModel
+
+
+class SqliteCityCatalog:
+    SCHEMA_VERSION = 2
+    SCHEMA = '''
+        CREATE TABLE cities (
+            id TEXT PRIMARY KEY,
+            sort_key TEXT NOT NULL,
+            name TEXT NOT NULL,
+            country TEXT NOT NULL,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX cities_sort_key ON cities (sort_key);
+    '''
+
+    def __init__(self, database_path: str, cache_size: int):
+        self.database_path = database_path
+        self.cache = LruCache(cache_size)
+        self.connection = None
+        self.count = 0
+
+    @staticmethod
+    def build(json_path: str, database_path: str):
+        with open(json_path, 'r', encoding='UTF-8') as file:
+            parsed: dict = json.load(file)
+
+        temp_path = f'{database_path}.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        connection = sqlite3.connect(temp_path)
+        try:
+            connection.executescript(SqliteCityCatalog.SCHEMA)
+            connection.execute(f'PRAGMA user_version = {SqliteCityCatalog.SCHEMA_VERSION}')
+            connection.executemany(
+                'INSERT INTO cities (id, sort_key, name, country, lat, lon, data) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        city_id, data['name'].casefold(), data['name'], data['country'],
+                        data['lat'], data['lon'], json.dumps(data, ensure_ascii=False)
+                    )
+                    for city_id, data in parsed.items()
+                ]
+            )
+            connection.commit()
+        finally:
+            connection.close()
+
+        os.replace(temp_path, database_path)
+
+    def is_outdated(self, json_path: str) -> bool:
+        if not os.path.exists(self.database_path):
+            return True
+
+        if os.path.getmtime(self.database_path) < os.path.getmtime(json_path):
+            return True
+
+        connection = sqlite3.connect(self.database_path)
+        try:
+            return connection.execute('PRAGMA user_version').fetchone()[0] != SqliteCityCatalog.SCHEMA_VERSION
+        finally:
+            connection.close()
+
+    def open(self, json_path: str):
+        if self.is_outdated(json_path):
+            print(f"[City Catalog] Building '{self.database_path}' from '{json_path}'...")
+            SqliteCityCatalog.build(json_path, self.database_path)
+
+        self.connection = sqlite3.connect(self.database_path)
+        self.count = self.connection.execute('SELECT COUNT(*) FROM cities').fetchone()[0]
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get(self, city_id: str, default=None) -> CityModel:
+        city = self.cache.get(city_id)
+        if city is not None:
+            return city
+
+        row = self.connection.execute('SELECT data FROM cities WHERE id = ?', (city_id,)).fetchone()
+        if row is None:
+            return default
+
+        city = CityModel(city_id, json.loads(row[0]))
+        self.cache.put(city_id, city)
+        return city
+
+    def __getitem__(self, city_id: str) -> CityModel:
+        city = self.get(city_id)
+        if city is None:
+            raise KeyError(city_id)
+        return city
+
+    def __contains__(self, city_id) -> bool:
+        if city_id in self.cache:
+            return True
+        return self.connection.execute('SELECT 1 FROM cities WHERE id = ?', (city_id,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self) -> list:
+        return [row[0] for row in self.connection.execute('SELECT id FROM cities ORDER BY rowid')]
+
+    def values(self):
+        for _, city in self.items():
+            yield city
+
+    def items(self):
+        # iterates over the whole catalog, so hydrated models bypass the LRU cache
+        for city_id, data in self.connection.execute('SELECT id, data FROM cities ORDER BY rowid'):
+            city = self.cache.get(city_id)
+            yield city_id, city if city is not None else CityModel(city_id, json.loads(data))
+
+    def sorted_keys(self) -> list:
+        return [row[0] for row in self.connection.execute('SELECT id FROM cities ORDER BY sort_key')]
+
+    def locations(self):
+        return self.connection.execute('SELECT id, lat, lon FROM cities ORDER BY rowid')
+
+    def search_entries(self):
+        return self.connection.execute('SELECT id, name, country FROM cities ORDER BY rowid')
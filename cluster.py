@@ -0,0 +1,370 @@
+import asyncio
+import multiprocessing
+import signal
+import threading
+
+from telegram import Bot as TelegramBot, Update
+from telegram.ext import Application
+
+from webhook import WebhookServer
+
+POLL_TIMEOUT = 30
+SHUTDOWN_TIMEOUT = 30
+PROCESS_CHECK_INTERVAL = 1
+
+
+def get_shard_key(update: Update) -> int:
+    # updates of a chat always go to the same worker, so they are handled in order
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+def forward_queue(source: multiprocessing.Queue, loop: asyncio.AbstractEventLoop, callback):
+    # multiprocessing queues can only be read by blocking, so every queue gets its own thread
+    while True:
+        item = source.get()
+        loop.call_soon_threadsafe(callback, item)
+        if item is None:
+            return
+
+
+def start_forwarding(source: multiprocessing.Queue, callback, name: str):
+    loop = asyncio.get_running_loop()
+    threading.Thread(target=forward_queue, args=(source, loop, callback), name=name, daemon=True).start()
+
+
+def run_weather_process(bot_class, prefs, weather_queues: list, demand_queue: multiprocessing.Queue):
+    # the supervisor handles Ctrl+C and stops its children through the queues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    bot = bot_class()
+    bot.use_preferences(prefs)
+    bot.load_data()
+    bot.load_weather()
+
+    asyncio.run(WeatherPublisher(bot, weather_queues, demand_queue).run())
+
+
+def run_worker_process(bot_class, prefs, index: int, update_queue: multiprocessing.Queue,
+                       weather_queue: multiprocessing.Queue, demand_queue: multiprocessing.Queue,
+                       photos_synced: multiprocessing.Event):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # demand is only a hint, it may be lost when the weather process is already gone
+    demand_queue.cancel_join_thread()
+    # every worker talks to Telegram on its own, so they share the global limit
+    prefs.telegram_messages_per_second /= prefs.cluster_workers
+    prefs.alert_messages_per_second /= prefs.cluster_workers
+
+    bot = bot_class()
+    bot.use_preferences(prefs)
+    bot.load_data()
+    # the weather process owns the snapshot and publishes its content on startup
+    bot.load_weather(restore_snapshot=False)
+    # subscriptions of other chats are alerted by the workers those chats are routed to
+    bot.shard = (index, prefs.cluster_workers)
+    bot.load_app()
+
+    asyncio.run(ClusterWorker(bot, index, update_queue, weather_queue, demand_queue, photos_synced).run())
+
+
+class WeatherPublisher:
+    PUBLISH_INTERVAL = 0.5
+
+    def __init__(self, bot, weather_queues: list, demand_queue: multiprocessing.Queue):
+        self.bot = bot
+        self.weather_queues = weather_queues
+        self.demand_queue = demand_queue
+        self.pending = dict()
+        self.pending_forecasts = dict()
+        self.stop_event = None
+
+    def on_weather_update(self, city_id: str, data):
+        self.pending[city_id] = data
+
+    def on_forecast_update(self, city_id: str, start_hour: int, values: dict, fetched_at: float):
+        self.pending_forecasts[city_id] = (start_hour, values, fetched_at)
+
+    def on_demand(self, city_id: str):
+        if city_id is None:
+            self.stop_event.set()
+            return
+
+        self.bot.weather_service.record_demand(city_id)
+
+    def publish(self, updates: list, forecasts: list = ()):
+        for weather_queue in self.weather_queues:
+            weather_queue.put((updates, forecasts))
+
+    async def run(self):
+        weather_service = self.bot.weather_service
+        weather_snapshot = self.bot.weather_snapshot
+        forecast_service = self.bot.forecast_service
+        self.stop_event = asyncio.Event()
+
+        # workers start with an empty cache, so everything restored from the snapshot goes first
+        self.publish(list(weather_service.cache.items()))
+        # workers detect changes on their own, so they get the refreshed update times too
+        weather_service.add_refresh_listener(self.on_weather_update)
+        if forecast_service is not None:
+            forecast_service.add_listener(self.on_forecast_update)
+        start_forwarding(self.demand_queue, self.on_demand, 'Demand Receiver')
+
+        print('[Cluster] Weather process is running.')
+        await self.bot.start_metrics()
+        weather_service.start()
+        weather_snapshot.start()
+        if forecast_service is not None:
+            forecast_service.start()
+        self.bot.data_watcher.start()
+
+        while not self.stop_event.is_set():
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), WeatherPublisher.PUBLISH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+            # updates are batched, so a bulk refresh reaches the workers as a single message
+            if len(self.pending) != 0 or len(self.pending_forecasts) != 0:
+                self.publish(list(self.pending.items()), list(self.pending_forecasts.items()))
+                self.pending = dict()
+                self.pending_forecasts = dict()
+
+        await self.bot.data_watcher.stop()
+        if forecast_service is not None:
+            await forecast_service.stop()
+        await weather_service.stop()
+        await weather_snapshot.stop()
+        await self.bot.stop_metrics()
+
+
+class ClusterWorker:
+    def __init__(self, bot, index: int, update_queue: multiprocessing.Queue, weather_queue: multiprocessing.Queue,
+                 demand_queue: multiprocessing.Queue, photos_synced: multiprocessing.Event):
+        self.bot = bot
+        self.index = index
+        self.update_queue = update_queue
+        self.weather_queue = weather_queue
+        self.demand_queue = demand_queue
+        self.photos_synced = photos_synced
+        self.stop_event = None
+
+    def on_update(self, raw: dict):
+        if raw is None:
+            self.stop_event.set()
+            return
+
+        app: Application = self.bot.app
+        app.update_queue.put_nowait(Update.de_json(raw, app.bot))
+
+    def on_weather_updates(self, message: tuple):
+        if message is None:
+            return
+
+        updates, forecasts = message
+        weather_service = self.bot.weather_service
+        for city_id, data in updates:
+            weather_service.update_weather_data(city_id, data)
+
+        forecast_service = self.bot.forecast_service
+        if forecast_service is not None:
+            for city_id, (start_hour, values, fetched_at) in forecasts:
+                forecast_service.update_forecast(city_id, start_hour, values, fetched_at)
+
+    async def run(self):
+        app: Application = self.bot.app
+        self.stop_event = asyncio.Event()
+
+        self.bot.weather_service.demand_sink = self.demand_queue.put
+        start_forwarding(self.weather_queue, self.on_weather_updates, 'Weather Receiver')
+        start_forwarding(self.update_queue, self.on_update, 'Update Receiver')
+
+        await app.initialize()
+        await app.start()
+        # the weather process serves metrics on the configured port, workers on the following ones
+        await self.bot.start_metrics(self.index + 1)
+        self.start_photo_sync()
+        self.bot.alert_engine.start()
+        self.bot.state_store.start()
+        self.bot.data_watcher.start()
+        print(f'[Cluster] Worker #{self.index} is running.')
+
+        try:
+            await self.stop_event.wait()
+        finally:
+            await self.bot.data_watcher.stop()
+            await self.bot.alert_engine.stop()
+            await self.bot.state_store.stop()
+            await app.stop()
+            await app.shutdown()
+            await self.bot.photo_library.stop()
+            await self.bot.stop_metrics()
+
+    def start_photo_sync(self):
+        photo_library = self.bot.photo_library
+
+        if self.index == 0:
+            photo_library.start()
+            photo_library.task.add_done_callback(lambda _: self.photos_synced.set())
+            return
+
+        # only the first worker uploads photos, the rest pick up its file_ids from the photo index
+        photo_library.resolve_missing = False
+        photo_library.task = asyncio.get_running_loop().create_task(self.sync_photos_later(), name='Photo Sync')
+
+    async def sync_photos_later(self):
+        loop = asyncio.get_running_loop()
+        while not await loop.run_in_executor(None, self.photos_synced.wait, 1):
+            pass
+
+        await self.bot.photo_library.sync()
+
+
+class ClusterSupervisor:
+    def __init__(self, bot_class, prefs):
+        self.bot_class = bot_class
+        self.prefs = prefs
+        self.update_queues = list()
+        self.processes = list()
+        # set when a child process died, the cluster is stopped then
+        self.failed_process = None
+
+    def run(self):
+        workers_count: int = self.prefs.cluster_workers
+        self.update_queues = [multiprocessing.Queue() for _ in range(workers_count)]
+        weather_queues = [multiprocessing.Queue() for _ in range(workers_count)]
+        demand_queue = multiprocessing.Queue()
+        photos_synced = multiprocessing.Event()
+
+        weather_process = multiprocessing.Process(
+            target=run_weather_process,
+            args=(self.bot_class, self.prefs, weather_queues, demand_queue),
+            name='Weather'
+        )
+
+        worker_processes = [
+            multiprocessing.Process(
+                target=run_worker_process,
+                args=(
+                    self.bot_class, self.prefs, index, self.update_queues[index],
+                    weather_queues[index], demand_queue, photos_synced
+                ),
+                name=f'Worker #{index}'
+            )
+            for index in range(workers_count)
+        ]
+
+        print(f'[Cluster] Starting the weather process and {workers_count} workers...')
+        self.processes = [weather_process, *worker_processes]
+        for process in self.processes:
+            process.start()
+
+        try:
+            asyncio.run(self.route_updates())
+        finally:
+            print('[Cluster] Stopping...')
+            # the weather process goes first, so it can flush the last updates to running workers
+            demand_queue.put(None)
+            ClusterSupervisor.join_process(weather_process)
+
+            for update_queue in self.update_queues:
+                update_queue.put(None)
+            for process in worker_processes:
+                ClusterSupervisor.join_process(process)
+
+        if self.failed_process is not None:
+            # a partly working cluster would drop the updates of a shard or serve stale weather forever,
+            # so it exits with an error and is restarted as a whole by the service manager
+            raise SystemExit(f"[Cluster] Stopped because process '{self.failed_process.name}' "
+                             f"exited with code {self.failed_process.exitcode}.")
+
+    @staticmethod
+    def join_process(process: multiprocessing.Process):
+        process.join(SHUTDOWN_TIMEOUT)
+        if process.is_alive():
+            print(f"[Cluster] Process '{process.name}' didn't stop in time, terminating it.")
+            process.terminate()
+            process.join()
+
+    def route_update(self, update: Update, raw: dict):
+        shard = get_shard_key(update) % len(self.update_queues)
+        self.update_queues[shard].put(raw)
+
+    async def dispatch_update(self, raw: dict):
+        self.route_update(Update.de_json(raw, None), raw)
+
+    async def route_updates(self):
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(stop_signal, stop_event.set)
+
+        bot = TelegramBot(
+            self.prefs.telegram_bot_token,
+            base_url=f'{self.prefs.telegram_api_url}/bot',
+            base_file_url=f'{self.prefs.telegram_api_url}/file/bot'
+        )
+
+        async with bot:
+            if self.prefs.webhook_url is not None:
+                task = loop.create_task(self.serve_webhook(bot))
+            else:
+                task = loop.create_task(self.poll_updates(bot))
+
+            watcher = loop.create_task(self.watch_processes(stop_event))
+            await stop_event.wait()
+
+            for running_task in (task, watcher):
+                running_task.cancel()
+                try:
+                    await running_task
+                except asyncio.CancelledError:
+                    pass
+
+    async def watch_processes(self, stop_event: asyncio.Event):
+        while True:
+            await asyncio.sleep(PROCESS_CHECK_INTERVAL)
+            for process in self.processes:
+                if not process.is_alive():
+                    print(f"[Cluster] Process '{process.name}' exited unexpectedly with code {process.exitcode}, "
+                          f"stopping the cluster.")
+                    self.failed_process = process
+                    stop_event.set()
+                    return
+
+    async def serve_webhook(self, bot: TelegramBot):
+        server = WebhookServer(
+            self.prefs.webhook_url,
+            self.prefs.webhook_listen,
+            self.prefs.webhook_port,
+            self.prefs.webhook_secret_token,
+            self.dispatch_update
+        )
+
+        await server.start()
+        try:
+            await server.register(bot)
+            print(f'[Cluster] Listening for updates on {server.url(server.path)}')
+            await asyncio.Future()
+        finally:
+            await server.stop()
+
+    async def poll_updates(self, bot: TelegramBot):
+        await bot.delete_webhook()
+        print('[Cluster] Polling updates...')
+        offset = 0
+
+        while True:
+            try:
+                updates = await bot.get_updates(offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES)
+            except Exception as error:
+                # the polling loop must outlive any single bad response
+                print(f'[Cluster] Failed to poll updates: {error}')
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                self.route_update(update, update.to_dict())
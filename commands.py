@@ -1,16 +1,35 @@
+from time import perf_counter
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
 from telegram.ext import CommandHandler
+from telegram.helpers import escape_markdown
+
+from callbacks import callback_data
+from data import DataLoader, CityModel
+from metrics import COMMAND_DURATION, COMMAND_ERRORS
+from state import StateStore
 
 
 class AbstractCommand(CommandHandler):
     def __init__(self, bot, command: str):
-        super().__init__(command, self.execute)
+        super().__init__(command, self.handle)
         self.bot = bot
         self.command = command
 
     def register(self):
         self.bot.app.add_handler(self)
 
+    async def handle(self, update: Update, ctx):
+        started_at = perf_counter()
+        try:
+            await self.execute(update, ctx)
+        except Exception:
+            COMMAND_ERRORS.inc(self.command)
+            raise
+        finally:
+            COMMAND_DURATION.observe(perf_counter() - started_at, self.command)
+
     async def execute(self, update: Update, ctx):
         print(f"Execution code for command '{self.command}' isn't implemented!")
 
@@ -19,13 +38,29 @@ class CommandStart(AbstractCommand):
     def __init__(self, bot):
         super().__init__(bot, 'start')
         self.keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔎 Получить свежую информацию", callback_data="#show_cities")]
+            [InlineKeyboardButton("🔎 Получить свежую информацию", callback_data=callback_data('show_cities'))]
         ])
 
     async def execute(self, update: Update, ctx):
+        state_store: StateStore = self.bot.state_store
+        user_id = update.effective_user.id
+        city_id = state_store.get_favorite_city(user_id) or state_store.get_last_city(user_id)
+
+        # read from memory, so returning users get their city without any extra request
+        texts = self.bot.renderer.get_city_texts(city_id) if city_id is not None else None
+        if texts is None:
+            await update.message.reply_text(
+                f'🎉 Приветствую тебя, {update.effective_user.first_name}!',
+                reply_markup=self.keyboard
+            )
+            return
+
         await update.message.reply_text(
-            f'🎉 Приветствую тебя, {update.effective_user.first_name}!',
-            reply_markup=self.keyboard
+            f'🎉 Приветствую тебя, {escape_markdown(update.effective_user.first_name, version=2)}\\!\n'
+            '\n'
+            f'{texts.select_city}',
+            parse_mode=ParseMode.MARKDOWN_V2,
+            reply_markup=self.bot.keyboards.get_city_keyboards(city_id).select_city
         )
 
 
@@ -45,4 +80,95 @@ class CommandHelp(AbstractCommand):
         super().__init__(bot, 'help')
 
     async def execute(self, update: Update, ctx):
-        await self.bot.registered_actions['show_cities'].show_cities(None, update.message.chat_id, None)
+        state_store: StateStore = self.bot.state_store
+        city_id = state_store.get_favorite_city(update.effective_user.id)
+
+        # the list opens on the page of the favorite city
+        position = self.bot.keyboards.city_positions.get(city_id)
+        page = position // self.bot.keyboards.page_size if position is not None else 0
+
+        await self.bot.registered_actions['show_cities'].show_cities(None, update.message.chat_id, None, page)
+
+
+class AbstractSubscriptionCommand(AbstractCommand):
+    def __init__(self, bot, command: str):
+        super().__init__(bot, command)
+
+    def find_city(self, query: str) -> CityModel:
+        data_loader: DataLoader = self.bot.data_loader
+
+        city = data_loader.get_city_model(query)
+        if city is not None:
+            return city
+
+        found = data_loader.search_index.search(query, 1)
+        return data_loader.get_city_model(found[0]) if len(found) != 0 else None
+
+    def describe_subscriptions(self, chat_id: int) -> str:
+        data_loader: DataLoader = self.bot.data_loader
+        city_ids = self.bot.alert_engine.index.get_subscriptions(chat_id)
+        cities = [data_loader.get_city_model(city_id) for city_id in city_ids]
+        names = sorted(f'{city.emoji} {city.name}' for city in cities if city is not None)
+
+        if len(names) == 0:
+            return '🔕 Подписок пока нет.'
+        return '🔔 Подписки: ' + ', '.join(names)
+
+
+class CommandSubscribe(AbstractSubscriptionCommand):
+    def __init__(self, bot):
+        super().__init__(bot, 'subscribe')
+
+    async def execute(self, update: Update, ctx):
+        chat_id = update.effective_chat.id
+
+        if len(ctx.args) == 0:
+            await update.message.reply_text(
+                '✍️ Укажите город: /subscribe <город>\n'
+                '📬 Я пришлю сообщение, когда погода в нём заметно изменится.\n'
+                '\n'
+                f'{self.describe_subscriptions(chat_id)}'
+            )
+            return
+
+        city = self.find_city(' '.join(ctx.args))
+        if city is None:
+            await update.message.reply_text('🤷 Такой город не найден.')
+            return
+
+        index = self.bot.alert_engine.index
+        if len(index.get_subscriptions(chat_id)) >= self.bot.prefs.alert_subscriptions_limit:
+            await update.message.reply_text('😔 Достигнут предел подписок, сначала отпишитесь от другого города.')
+            return
+
+        if not index.subscribe(chat_id, city.city_id):
+            await update.message.reply_text(f'👌 Вы уже подписаны на {city.name} {city.emoji}.')
+            return
+
+        await update.message.reply_text(
+            f'🔔 Подписка оформлена: {city.name} {city.emoji}\n'
+            '📬 Я пришлю сообщение, когда погода заметно изменится.'
+        )
+
+
+class CommandUnsubscribe(AbstractSubscriptionCommand):
+    def __init__(self, bot):
+        super().__init__(bot, 'unsubscribe')
+
+    async def execute(self, update: Update, ctx):
+        chat_id = update.effective_chat.id
+        index = self.bot.alert_engine.index
+
+        if len(ctx.args) == 0:
+            if len(index.unsubscribe_all(chat_id)) == 0:
+                await update.message.reply_text('🔕 Подписок пока нет.')
+            else:
+                await update.message.reply_text('🔕 Все подписки отменены.')
+            return
+
+        city = self.find_city(' '.join(ctx.args))
+        if city is None or not index.unsubscribe(chat_id, city.city_id):
+            await update.message.reply_text(f'🤷 Такой подписки нет.\n{self.describe_subscriptions(chat_id)}')
+            return
+
+        await update.message.reply_text(f'🔕 Подписка отменена: {city.name} {city.emoji}')
@@ -3,15 +3,35 @@ import random
 
 from telegram import InlineKeyboardButton
 
+from bundle import DataBundle
+from callbacks import callback_data
+from geo import SpatialIndex
+from search import CitySearchIndex
+
+DATA_BUNDLE_PATH = 'data/bundle.bin'
+DATA_SOURCE_PATHS = {
+    'cities': 'data/cities.json',
+    'weather_conditions': 'data/weather_conditions.json',
+    'phrases': 'data/phrases.txt',
+}
+CATALOG_DATABASE_PATH = 'data/cities.sqlite'
+
 
 class CityPhoto:
+    __slots__ = ('tg_id', 'file', 'source')
+
     def __init__(self, data: dict):
-        self.tg_id = data['tg_id']
+        self.tg_id = data.get('tg_id')
         self.file = data['file']
-        self.source = data['source']
+        self.source = data.get('source')
 
 
 class CityModel:
+    __slots__ = (
+        'city_id', 'name', 'country', 'emoji', 'latitude', 'longitude',
+        'raw_lat', 'raw_lon', 'area', 'population', 'time_offset', 'photos'
+    )
+
     def __init__(self, city_id: str, data: dict):
         self.city_id: str = city_id
         self.name: str = data['name']
@@ -30,11 +50,20 @@ class CityModel:
             for item in data['photos']:
                 self.photos.append(CityPhoto(item))
 
+    def same_as(self, other) -> bool:
+        if any(getattr(self, name) != getattr(other, name) for name in CityModel.__slots__ if name != 'photos'):
+            return False
+
+        # file_ids are resolved at runtime, so only the files themselves are compared
+        return [(photo.file, photo.source) for photo in self.photos] == [(photo.file, photo.source) for photo in other.photos]
+
     def as_inline_button(self):
-        return InlineKeyboardButton(f'{self.emoji} {self.name}', callback_data=f'#select_city {self.city_id}')
+        return InlineKeyboardButton(f'{self.emoji} {self.name}', callback_data=callback_data('select_city', self.city_id))
 
 
 class WeatherCondition:
+    __slots__ = ('code', 'icon', 'day_text', 'day_emoji', 'night_text', 'night_emoji')
+
     def __init__(self, data: dict):
         self.code = data['code']
         self.icon = data['icon']
@@ -51,48 +80,105 @@ class WeatherCondition:
 
 
 class DataLoader:
-    def __init__(self):
+    def __init__(self, catalog_backend: str = 'memory', catalog_cache_size: int = 10000):
+        self.catalog_backend = catalog_backend
+        self.catalog_cache_size = catalog_cache_size
         self.city_models = dict()
         self.weather_conditions = dict()
         self.user_photo_reactions = list()
+        self.spatial_index = SpatialIndex()
+        self.search_index = CitySearchIndex()
 
     def load(self):
-        self.parse_city_models()
-        self.parse_weather_conditions()
-        self.read_user_photo_reactions()
-
-    def parse_city_models(self):
-        file = open('data/cities.json', 'r', encoding='UTF-8')
-        raw_json = '\n'.join(file.readlines())
-        file.close()
-
-        parsed: dict = json.loads(raw_json)
-        for item in parsed.items():
-            city = CityModel(item[0], item[1])
-            self.city_models[city.city_id] = city
-
-    def parse_weather_conditions(self):
-        file = open('data/weather_conditions.json', 'r', encoding='UTF-8')
-        raw_json = '\n'.join(file.readlines())
-        file.close()
-
-        parsed: list = json.loads(raw_json)
+        sources = self.load_sources()
+        self.parse_city_models(sources.get('cities'))
+        self.build_indexes()
+        self.parse_weather_conditions(sources['weather_conditions'])
+        self.user_photo_reactions = sources['phrases']
+
+    def build_indexes(self):
+        self.spatial_index.build(self.get_city_locations())
+        self.search_index.build(self.get_city_search_entries())
+
+    def is_lazy_catalog(self) -> bool:
+        return self.catalog_backend == 'sqlite'
+
+    def load_sources(self) -> dict:
+        source_paths = dict(DATA_SOURCE_PATHS)
+        if self.is_lazy_catalog():
+            # the SQLite catalog is built from the JSON file on its own
+            del source_paths['cities']
+
+        bundle = DataBundle(DATA_BUNDLE_PATH, source_paths)
+        return bundle.load_or_build(lambda: {name: DataLoader.read_source(path) for name, path in source_paths.items()})
+
+    @staticmethod
+    def read_source(path: str):
+        with open(path, 'rb') as file:
+            raw = file.read()
+
+        if path.endswith('.json'):
+            return json.loads(raw)
+
+        return [line for line in raw.decode('UTF-8').splitlines() if len(line) > 1]
+
+    def parse_city_models(self, parsed: dict):
+        if self.is_lazy_catalog():
+            self.city_models = self.open_catalog()
+            return
+
+        self.city_models = DataLoader.build_city_models(parsed)
+
+    def open_catalog(self):
+        from catalog import SqliteCityCatalog
+
+        catalog = SqliteCityCatalog(CATALOG_DATABASE_PATH, self.catalog_cache_size)
+        catalog.open(DATA_SOURCE_PATHS['cities'])
+        return catalog
+
+    @staticmethod
+    def build_city_models(parsed: dict) -> dict:
+        return {city_id: CityModel(city_id, data) for city_id, data in parsed.items()}
+
+    def parse_weather_conditions(self, parsed: list):
+        self.weather_conditions = DataLoader.build_weather_conditions(parsed)
+
+    @staticmethod
+    def build_weather_conditions(parsed: list) -> dict:
+        conditions = dict()
         for item in parsed:
             condition = WeatherCondition(item)
-            self.weather_conditions[condition.code] = condition
+            conditions[condition.code] = condition
+
+        return conditions
 
-    def read_user_photo_reactions(self):
-        file = open('data/phrases.txt', 'r', encoding='UTF-8')
+    def get_city_model(self, _id: str) -> CityModel:
+        return self.city_models.get(_id)
 
-        for line in file.readlines():
-            line = line.rstrip('\n')
-            if len(line) > 1:
-                self.user_photo_reactions.append(line)
+    def get_city_ids(self, alphabetical: bool) -> list:
+        if self.is_lazy_catalog():
+            return self.city_models.sorted_keys() if alphabetical else self.city_models.keys()
 
-        file.close()
+        cities = list(self.city_models.values())
+        if alphabetical:
+            cities.sort(key=lambda city: city.name.casefold())
 
-    def get_city_model(self, _id: str) -> CityModel:
-        return self.city_models[_id] if _id in self.city_models.keys() else None
+        return [city.city_id for city in cities]
+
+    def get_city_locations(self):
+        if self.is_lazy_catalog():
+            return self.city_models.locations()
+
+        return [(city.city_id, city.raw_lat, city.raw_lon) for city in self.city_models.values()]
+
+    def get_city_search_entries(self):
+        if self.is_lazy_catalog():
+            return self.city_models.search_entries()
+
+        return [(city.city_id, city.name, city.country) for city in self.city_models.values()]
+
+    def get_nearest_cities(self, lat: float, lon: float, count: int) -> list:
+        return [(self.get_city_model(city_id), distance) for city_id, distance in self.spatial_index.nearest(lat, lon, count)]
 
     def get_weather_condition(self, _id: int) -> WeatherCondition:
         return self.weather_conditions[_id] if _id in self.weather_conditions.keys() else None
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import random
+import sys
+import zlib
+from itertools import count
+from time import time
+from urllib.parse import parse_qsl
+
+from web import HttpServer, HttpRequest, HttpResponse
+
+
+class FakeWeatherServer(HttpServer):
+    CONDITION_CODES = (1000, 1003, 1006, 1009, 1063, 1183, 1213)
+    UNKNOWN_LOCATION_ERROR = {'code': 1006, 'message': 'No matching location found.'}
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, error_rate: float = 0.0):
+        super().__init__(host, port)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests_count = 0
+        self.locations_count = 0
+        # queries answered like locations the real API can't find
+        self.unknown_locations = set()
+
+        self.route('GET', '/v1/current.json', self.handle_current)
+        self.route('POST', '/v1/current.json', self.handle_current)
+        self.route('GET', '/v1/forecast.json', self.handle_forecast)
+
+    def api_url(self) -> str:
+        return self.url('/v1')
+
+    async def handle_current(self, request: HttpRequest) -> HttpResponse:
+        self.requests_count += 1
+
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+        if random.random() < self.error_rate:
+            return HttpResponse.json({'error': {'code': 9999, 'message': 'Internal application error.'}}, 500)
+
+        if request.query.get('q') != 'bulk':
+            self.locations_count += 1
+            if request.query.get('q') in self.unknown_locations:
+                return HttpResponse.json({'error': FakeWeatherServer.UNKNOWN_LOCATION_ERROR}, 400)
+            return HttpResponse.json({'current': self.generate_current(request.query.get('q', ''))})
+
+        bulk = list()
+        for location in request.json()['locations']:
+            self.locations_count += 1
+            if location['q'] in self.unknown_locations:
+                # the real API reports a failed location inside the bulk response
+                bulk.append({'query': {
+                    'custom_id': location.get('custom_id'),
+                    'q': location['q'],
+                    'error': FakeWeatherServer.UNKNOWN_LOCATION_ERROR
+                }})
+                continue
+
+            bulk.append({'query': {
+                'custom_id': location.get('custom_id'),
+                'q': location['q'],
+                'current': self.generate_current(location['q'])
+            }})
+
+        return HttpResponse.json({'bulk': bulk})
+
+    async def handle_forecast(self, request: HttpRequest) -> HttpResponse:
+        self.requests_count += 1
+        self.locations_count += 1
+
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+        if random.random() < self.error_rate:
+            return HttpResponse.json({'error': {'code': 9999, 'message': 'Internal application error.'}}, 500)
+
+        days = min(max(1, int(request.query.get('days', '1'))), 14)
+        return HttpResponse.json({'forecast': {'forecastday': self.generate_forecast(request.query.get('q', ''), days)}})
+
+    @staticmethod
+    def generate_forecast(query: str, days: int) -> list:
+        seed = zlib.crc32(query.encode('UTF-8'))
+        now = int(time())
+        # like the real API, the forecast starts at the midnight of the current day
+        midnight = now - now % 86400
+        forecast_days = list()
+
+        for day in range(days):
+            hours = list()
+            for hour in range(24):
+                epoch = midnight + (day * 24 + hour) * 3600
+                temp_c = (seed % 500) / 10.0 - 15.0 + 5.0 * (1 if 10 <= hour < 18 else -1)
+                chance_of_rain = (seed // 7 + day * 24 + hour) * 37 % 100
+                hours.append({
+                    'time_epoch': epoch,
+                    'temp_c': temp_c,
+                    'precip_mm': round(chance_of_rain / 50.0, 1) if chance_of_rain > 60 else 0.0,
+                    'chance_of_rain': chance_of_rain,
+                    'wind_kph': (seed // 1000 + hour) % 40,
+                    'is_day': 1 if 6 <= hour < 20 else 0,
+                    'condition': {'code': FakeWeatherServer.CONDITION_CODES[(seed + day) % len(FakeWeatherServer.CONDITION_CODES)]}
+                })
+            forecast_days.append({'date_epoch': midnight + day * 86400, 'hour': hours})
+
+        return forecast_days
+
+    @staticmethod
+    def generate_current(query: str) -> dict:
+        seed = zlib.crc32(query.encode('UTF-8'))
+        now = int(time())
+        temp_c = (seed % 500) / 10.0 - 15.0
+
+        return {
+            'last_updated_epoch': now - now % 900,
+            'temp_c': temp_c,
+            'temp_f': round(temp_c * 9 / 5 + 32, 1),
+            'feelslike_c': temp_c - 2.0,
+            'feelslike_f': round((temp_c - 2.0) * 9 / 5 + 32, 1),
+            'humidity': seed % 100,
+            'cloud': (seed // 100) % 100,
+            'is_day': 1 if 6 <= (now // 3600) % 24 < 20 else 0,
+            'condition': {'code': FakeWeatherServer.CONDITION_CODES[seed % len(FakeWeatherServer.CONDITION_CODES)]}
+        }
+
+
+class FakeBotApiServer(HttpServer):
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Traveller Conductor', 'username': 'fake_conductor_bot'}
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0):
+        super().__init__(host, port)
+        # photos are uploaded in full, like to the real Bot API
+        self.max_body_size = 50 << 20
+        self.latency = latency
+        self.requests_count = 0
+        self.method_counts = dict()
+        self.message_ids = count(1)
+
+    def api_url(self) -> str:
+        return self.url()
+
+    async def dispatch(self, request: HttpRequest) -> HttpResponse:
+        # requests go to /bot<token>/<method>, so they can't be matched by exact routes
+        parts = request.path.split('/')
+        if len(parts) != 3 or not parts[1].startswith('bot'):
+            return HttpResponse(404, b'Not Found')
+
+        method = parts[2]
+        self.requests_count += 1
+        self.method_counts[method] = self.method_counts.get(method, 0) + 1
+
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+        params = FakeBotApiServer.parse_params(request)
+        if method == 'getUpdates':
+            # nothing ever arrives, a short wait keeps pollers from spinning
+            await asyncio.sleep(min(params.get('timeout', 0), 1))
+
+        return HttpResponse.json({'ok': True, 'result': self.generate_result(method, params)})
+
+    @staticmethod
+    def parse_params(request: HttpRequest) -> dict:
+        # files are sent as multipart forms, the content of those requests doesn't matter here
+        if not request.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+            return dict()
+
+        params = dict()
+        for name, value in parse_qsl(request.body.decode('UTF-8')):
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                params[name] = value
+
+        return params
+
+    def generate_message(self, params: dict) -> dict:
+        return {
+            'message_id': params.get('message_id', next(self.message_ids)),
+            'date': int(time()),
+            'chat': {'id': params.get('chat_id', 1), 'type': 'private'},
+            'from': FakeBotApiServer.BOT_USER,
+            'text': params.get('text', '')
+        }
+
+    def generate_result(self, method: str, params: dict):
+        if method == 'getMe':
+            return FakeBotApiServer.BOT_USER
+
+        if method == 'getUpdates':
+            return []
+
+        if method == 'getFile':
+            return {'file_id': params.get('file_id', ''), 'file_unique_id': 'fake'}
+
+        if method == 'sendMediaGroup':
+            return [self.generate_message(params) for _ in params.get('media', ())]
+
+        if method.startswith(('send', 'copy', 'forward')):
+            message = self.generate_message(params)
+            if method == 'sendPhoto':
+                message['photo'] = [{'file_id': f'fake-{message["message_id"]}', 'file_unique_id': 'fake', 'width': 1, 'height': 1}]
+            return message
+
+        if method.startswith('edit') and 'inline_message_id' not in params:
+            return self.generate_message(params)
+
+        return True
+
+
+async def serve_fake_weather(port: int):
+    server = FakeWeatherServer(port=port)
+    await server.start()
+    print(f'Fake weather API is listening on {server.api_url()}')
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve_fake_weather(int(sys.argv[1]) if len(sys.argv) > 1 else 8081))
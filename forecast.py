@@ -0,0 +1,289 @@
+import asyncio
+from time import time
+
+import httpx
+import numpy as np
+
+from weather import WeatherFetcher, QueryItem, CircuitBreaker, CircuitOpenError, MALFORMED_RESPONSE_ERRORS, backoff_delay
+
+HOUR = 3600
+DAY = 86400
+
+
+def current_hour(now: float = None) -> int:
+    return int((time() if now is None else now) // HOUR)
+
+
+def parse_forecast(raw: dict) -> tuple:
+    hours = [hour for day in raw['forecast']['forecastday'] for hour in day['hour']]
+    if len(hours) == 0:
+        raise ValueError('the forecast is empty')
+
+    # hours come one after another, so only the first one has to be placed
+    start_hour = hours[0]['time_epoch'] // HOUR
+    values = {
+        'temp_c': np.array([hour['temp_c'] for hour in hours], dtype=np.float32),
+        'precip_mm': np.array([hour['precip_mm'] for hour in hours], dtype=np.float32),
+        'chance_of_rain': np.array([hour['chance_of_rain'] for hour in hours], dtype=np.float32),
+        'wind_kph': np.array([hour['wind_kph'] for hour in hours], dtype=np.float32),
+        'condition_code': np.array([hour['condition']['code'] for hour in hours], dtype=np.int16),
+        'is_day': np.array([hour['is_day'] == 1 for hour in hours], dtype=np.bool_),
+    }
+
+    return start_hour, values
+
+
+class ForecastStore:
+    # field -> type of the column and the value of hours without data
+    FIELDS = {
+        'temp_c': (np.float32, np.nan),
+        'precip_mm': (np.float32, np.nan),
+        'chance_of_rain': (np.float32, np.nan),
+        'wind_kph': (np.float32, np.nan),
+        'condition_code': (np.int16, 0),
+        'is_day': (np.bool_, False),
+    }
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, hours: int):
+        self.hours = hours
+        # the first column of every field is this hour since the epoch
+        self.base_hour = current_hour()
+        # city id -> row in every column
+        self.rows = dict()
+        # row -> city id, None for released rows
+        self.city_ids = list()
+        self.free_rows = list()
+        self.capacity = 0
+        self.columns = dict()
+        self.fetched_at = np.zeros(0)
+        self.resize(ForecastStore.INITIAL_CAPACITY)
+
+    def resize(self, capacity: int):
+        columns = dict()
+        for field, (dtype, missing) in ForecastStore.FIELDS.items():
+            column = np.full((capacity, self.hours), missing, dtype=dtype)
+            if field in self.columns.keys():
+                column[:self.capacity] = self.columns[field]
+            columns[field] = column
+
+        fetched_at = np.zeros(capacity)
+        fetched_at[:self.capacity] = self.fetched_at
+
+        self.columns = columns
+        self.fetched_at = fetched_at
+        self.capacity = capacity
+
+    def advance(self, now: float = None):
+        shift = current_hour(now) - self.base_hour
+        if shift <= 0:
+            return
+
+        # past hours are dropped and the new ones at the end stay unknown until the next fetch
+        for field, (dtype, missing) in ForecastStore.FIELDS.items():
+            column = self.columns[field]
+            if shift < self.hours:
+                column[:, :-shift] = column[:, shift:]
+                column[:, -shift:] = missing
+            else:
+                column[:] = missing
+
+        self.base_hour += shift
+
+    def allocate_row(self, city_id: str) -> int:
+        row = self.rows.get(city_id)
+        if row is not None:
+            return row
+
+        if len(self.free_rows) != 0:
+            row = self.free_rows.pop()
+        else:
+            row = len(self.city_ids)
+            if row == self.capacity:
+                self.resize(self.capacity * 2)
+            self.city_ids.append(None)
+
+        self.city_ids[row] = city_id
+        self.rows[city_id] = row
+        return row
+
+    def put(self, city_id: str, start_hour: int, values: dict, fetched_at: float):
+        self.advance()
+        row = self.allocate_row(city_id)
+
+        # the forecast starts at the local midnight, hours which are already over are skipped
+        skip = max(0, self.base_hour - start_hour)
+        offset = max(0, start_hour - self.base_hour)
+
+        for field, (dtype, missing) in ForecastStore.FIELDS.items():
+            column = self.columns[field]
+            column[row] = missing
+            source = values[field][skip:skip + self.hours - offset]
+            column[row, offset:offset + len(source)] = source
+
+        self.fetched_at[row] = fetched_at
+
+    def remove(self, city_id: str):
+        row = self.rows.pop(city_id, None)
+        if row is None:
+            return
+
+        for field, (dtype, missing) in ForecastStore.FIELDS.items():
+            self.columns[field][row] = missing
+
+        self.fetched_at[row] = 0
+        self.city_ids[row] = None
+        self.free_rows.append(row)
+
+    def select(self, field: str, rows) -> np.ndarray:
+        column = self.columns[field]
+        return column[:len(self.city_ids)] if rows is None else column[rows]
+
+    def daily_aggregates(self, time_offset: int, rows=None) -> dict:
+        # hours are grouped into local days of cities sharing the time offset in minutes
+        local_days = ((self.base_hour + np.arange(self.hours)) * HOUR + time_offset * 60) // DAY
+        starts = np.flatnonzero(np.diff(local_days, prepend=local_days[0] - 1))
+
+        temp_c = self.select('temp_c', rows)
+        precip_mm = self.select('precip_mm', rows)
+        chance_of_rain = self.select('chance_of_rain', rows)
+
+        # fmin and fmax skip NaN unless every hour of the day is unknown
+        return {
+            'day': local_days[starts],
+            'hours': np.add.reduceat((~np.isnan(temp_c)).astype(np.int32), starts, axis=1),
+            'min_temp_c': np.fmin.reduceat(temp_c, starts, axis=1),
+            'max_temp_c': np.fmax.reduceat(temp_c, starts, axis=1),
+            'precip_mm': np.add.reduceat(np.nan_to_num(precip_mm), starts, axis=1),
+            'chance_of_rain': np.fmax.reduceat(chance_of_rain, starts, axis=1),
+            # condition codes grow with the severity of the weather
+            'condition_code': np.maximum.reduceat(self.select('condition_code', rows), starts, axis=1),
+        }
+
+
+class ForecastService:
+    SWEEP_INTERVAL = 60
+    RETRY_DELAY = 300
+
+    def __init__(self, bot):
+        self.bot = bot
+        prefs = bot.prefs
+        self.days: int = prefs.forecast_days
+        self.refresh_interval: int = prefs.forecast_refresh_interval
+        # current weather goes first, forecasts take up to a half of the request budget
+        self.requests_per_sweep = max(1, prefs.weather_requests_per_minute * ForecastService.SWEEP_INTERVAL // 120)
+        self.store = ForecastStore(self.days * 24)
+        # query city id -> (failed fetches in a row, time of the next attempt)
+        self.failures = dict()
+        self.listeners = list()
+        self.task = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify_listeners(self, city_id: str, start_hour: int, values: dict, fetched_at: float):
+        for listener in self.listeners:
+            try:
+                listener(city_id, start_hour, values, fetched_at)
+            except Exception as error:
+                print(f"[Forecast] Listener {listener.__qualname__} failed for '{city_id}': {error!r}")
+
+    def update_forecast(self, city_id: str, start_hour: int, values: dict, fetched_at: float):
+        self.store.put(city_id, start_hour, values, fetched_at)
+        self.notify_listeners(city_id, start_hour, values, fetched_at)
+
+    def forget_forecasts(self, city_ids: list):
+        for city_id in city_ids:
+            self.store.remove(city_id)
+            self.failures.pop(city_id, None)
+
+    def record_failure(self, query_item: QueryItem):
+        failures = self.failures.get(query_item.city_id, (0, 0.0))[0] + 1
+        retry_at = time() + backoff_delay(failures, ForecastService.RETRY_DELAY, self.refresh_interval)
+        self.failures[query_item.city_id] = (failures, retry_at)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run(), name='Forecast Fetcher')
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as error:
+                print(f"[Forecast] Refresh sweep failed: {error!r}")
+            await asyncio.sleep(ForecastService.SWEEP_INTERVAL)
+
+    async def sweep(self):
+        self.store.advance()
+        # the current weather probes a failing upstream, forecasts wait until it has recovered
+        if self.bot.weather_service.fetcher.breaker.state == CircuitBreaker.CLOSED:
+            due_items = self.collect_due(time())
+            await asyncio.gather(*[self.refresh(query_item) for query_item in due_items])
+
+    def collect_due(self, now: float) -> list:
+        fetcher: WeatherFetcher = self.bot.weather_service.fetcher
+        store = self.store
+        due = list()
+
+        for query_item in fetcher.query_items:
+            # a failing city would otherwise stay first in line and take the whole sweep
+            failure = self.failures.get(query_item.city_id)
+            if failure is not None and now < failure[1]:
+                continue
+
+            row = store.rows.get(query_item.city_id)
+            fetched_at = store.fetched_at[row] if row is not None else 0.0
+            if now - fetched_at >= self.refresh_interval:
+                due.append((fetched_at, query_item))
+
+        due.sort(key=lambda item: item[0])
+        return [query_item for _, query_item in due[:self.requests_per_sweep]]
+
+    async def refresh(self, query_item: QueryItem):
+        fetcher: WeatherFetcher = self.bot.weather_service.fetcher
+
+        params = dict()
+        params['key'] = self.bot.weather_api_key
+        params['q'] = query_item.query_string()
+        params['days'] = self.days
+        params['aqi'] = 'no'
+        params['alerts'] = 'no'
+
+        try:
+            response = await fetcher.send_request('forecast', 'GET', params, endpoint='forecast.json')
+        except CircuitOpenError:
+            return
+        except httpx.HTTPError as error:
+            print(f"[Forecast] Connection error :( ({error.__class__.__name__})")
+            self.record_failure(query_item)
+            return
+
+        if response.status_code != 200:
+            print(f"[Forecast] Status code {response.status_code} received for '{query_item.city_id}' :(")
+            self.record_failure(query_item)
+            return
+
+        try:
+            start_hour, values = parse_forecast(response.json())
+        except MALFORMED_RESPONSE_ERRORS as error:
+            print(f"[Forecast] Malformed forecast received for '{query_item.city_id}': {error!r}")
+            self.record_failure(query_item)
+            return
+
+        self.failures.pop(query_item.city_id, None)
+
+        fetched_at = time()
+        for city_id in query_item.city_ids:
+            # removed by a data reload while it was being fetched
+            if city_id not in fetcher.representatives:
+                continue
+            self.update_forecast(city_id, start_hour, values, fetched_at)
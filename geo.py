@@ -0,0 +1,142 @@
+import heapq
+from array import array
+from math import radians, degrees, sin, cos, asin, sqrt, floor, ceil
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.195
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    d_lat = radians(lat2 - lat1)
+    d_lon = radians(lon2 - lon1)
+    a = sin(d_lat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a)))
+
+
+class SpatialIndex:
+    def __init__(self, cell_size: float = 1.0):
+        self.cell_size = cell_size
+        self.lon_cells = int(ceil(360.0 / cell_size))
+        self.lat_cells = int(ceil(180.0 / cell_size))
+        self.city_ids = list()
+        self.lats = array('d')
+        self.lons = array('d')
+        self.cells = dict()
+        self.positions = dict()
+
+    def build(self, locations):
+        city_ids = list()
+        lats = array('d')
+        lons = array('d')
+        cells = dict()
+
+        for city_id, lat, lon in locations:
+            index = len(city_ids)
+            city_ids.append(city_id)
+            lats.append(lat)
+            lons.append(lon)
+
+            cell = self.cell_of(lat, lon)
+            members = cells.get(cell)
+            if members is None:
+                members = array('I')
+                cells[cell] = members
+            members.append(index)
+
+        self.city_ids = city_ids
+        self.lats = lats
+        self.lons = lons
+        self.cells = cells
+        self.positions = {city_id: index for index, city_id in enumerate(city_ids)}
+
+    def location_of(self, city_id: str) -> tuple:
+        index = self.positions[city_id]
+        return self.lats[index], self.lons[index]
+
+    def __len__(self) -> int:
+        return len(self.city_ids)
+
+    def cell_of(self, lat: float, lon: float) -> tuple:
+        row = min(int(floor((lat + 90.0) / self.cell_size)), self.lat_cells - 1)
+        column = int(floor((lon + 180.0) / self.cell_size)) % self.lon_cells
+        return row, column
+
+    def cap_cells(self, lat: float, lon: float, radius_km: float):
+        # cells covering the bounding box of a spherical cap around the point
+        angle = radius_km / EARTH_RADIUS_KM
+        d_lat = degrees(angle)
+
+        first_row = self.cell_of(max(-90.0, lat - d_lat), lon)[0]
+        last_row = self.cell_of(min(90.0, lat + d_lat), lon)[0]
+
+        if lat - d_lat <= -90.0 or lat + d_lat >= 90.0 or sin(angle) >= cos(radians(lat)):
+            columns = range(self.lon_cells)
+        else:
+            d_lon = degrees(asin(sin(angle) / cos(radians(lat))))
+            first_column = int(floor((lon - d_lon + 180.0) / self.cell_size))
+            last_column = int(floor((lon + d_lon + 180.0) / self.cell_size))
+
+            if last_column - first_column + 1 >= self.lon_cells:
+                columns = range(self.lon_cells)
+            else:
+                columns = [column % self.lon_cells for column in range(first_column, last_column + 1)]
+
+        for row in range(first_row, last_row + 1):
+            for column in columns:
+                members = self.cells.get((row, column))
+                if members is not None:
+                    yield members
+
+    def within_distances(self, lat: float, lon: float, radius_km: float) -> list:
+        found = list()
+        lats = self.lats
+        lons = self.lons
+
+        for members in self.cap_cells(lat, lon, radius_km):
+            for index in members:
+                distance = distance_km(lat, lon, lats[index], lons[index])
+                if distance <= radius_km:
+                    found.append((distance, index))
+
+        return found
+
+    def nearest(self, lat: float, lon: float, count: int) -> list:
+        if len(self.city_ids) == 0 or count <= 0:
+            return list()
+
+        count = min(count, len(self.city_ids))
+        radius_km = self.cell_size * KM_PER_DEGREE
+
+        while True:
+            found = self.within_distances(lat, lon, radius_km)
+            if len(found) >= count:
+                break
+            radius_km *= 2
+
+        return [(self.city_ids[index], distance) for distance, index in heapq.nsmallest(count, found)]
+
+    def within(self, lat: float, lon: float, radius_km: float) -> list:
+        return [index for _, index in self.within_distances(lat, lon, radius_km)]
+
+    def cluster(self, radius_km: float) -> list:
+        if radius_km <= 0:
+            return [[city_id] for city_id in self.city_ids]
+
+        assigned = bytearray(len(self.city_ids))
+        groups = list()
+
+        for index, city_id in enumerate(self.city_ids):
+            if assigned[index]:
+                continue
+
+            assigned[index] = 1
+            group = [city_id]
+
+            for member in self.within(self.lats[index], self.lons[index], radius_km):
+                if not assigned[member]:
+                    assigned[member] = 1
+                    group.append(self.city_ids[member])
+
+            groups.append(group)
+
+        return groups
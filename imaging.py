@@ -0,0 +1,155 @@
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+
+from files import atomic_write
+
+CACHE_DIRECTORY = '.cache'
+
+
+def hash_bytes(raw: bytes) -> str:
+    return hashlib.sha256(raw).hexdigest()
+
+
+def process_image(source_path: str, target_path: str, max_size: int, quality: int) -> str:
+    # runs in a worker process, so Pillow is only imported where it's used
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB')
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        temp_path = f'{target_path}.tmp'
+        # EXIF and other metadata are not passed to save(), so they are dropped
+        image.save(temp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+
+    os.replace(temp_path, target_path)
+
+    with open(target_path, 'rb') as file:
+        return hash_bytes(file.read())
+
+
+class PhotoPreprocessor:
+    def __init__(self, manifest_path: str, max_size: int, quality: int, workers: int):
+        self.manifest_path = manifest_path
+        self.max_size = max_size
+        self.quality = quality
+        self.workers = workers if workers > 0 else os.cpu_count()
+        # source path -> [mtime, size, source hash, max size, quality, target path, target hash]
+        self.manifest = dict()
+
+    @staticmethod
+    def is_available() -> bool:
+        # checked without importing, Pillow is only loaded by the worker processes
+        return importlib.util.find_spec('PIL') is not None
+
+    @staticmethod
+    def get_target_path(source_path: str, source_hash: str) -> str:
+        # named by the content, so 3.jpg and 3.png of a city don't share the output
+        return os.path.join(os.path.dirname(source_path), CACHE_DIRECTORY, f'{source_hash}.jpg')
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='UTF-8') as file:
+                self.manifest = json.load(file)
+        except FileNotFoundError:
+            self.manifest = dict()
+        except ValueError as error:
+            print(f"[Photo Preprocessor] Ignoring corrupted manifest '{self.manifest_path}': {error}")
+            self.manifest = dict()
+
+    def is_up_to_date(self, source_path: str, stat: os.stat_result) -> bool:
+        entry = self.manifest.get(source_path)
+        return entry is not None \
+            and entry[0] == stat.st_mtime and entry[1] == stat.st_size \
+            and entry[3] == self.max_size and entry[4] == self.quality \
+            and PhotoPreprocessor.is_valid_output(entry)
+
+    @staticmethod
+    def is_valid_output(entry: list) -> bool:
+        # outputs named after the source file may have been overwritten by a photo with another extension
+        return os.path.basename(entry[5]) == f'{entry[2]}.jpg' and os.path.exists(entry[5])
+
+    def run(self, source_paths: list) -> dict:
+        self.load_manifest()
+
+        processed_by_hash = dict()
+        for entry in self.manifest.values():
+            if entry[3] == self.max_size and entry[4] == self.quality and PhotoPreprocessor.is_valid_output(entry):
+                processed_by_hash[entry[2]] = entry
+
+        results = dict()
+        processed_count = 0
+        pending = dict()
+        duplicates = list()
+
+        for source_path in source_paths:
+            stat = os.stat(source_path)
+            if self.is_up_to_date(source_path, stat):
+                results[source_path] = self.manifest[source_path][5]
+                continue
+
+            with open(source_path, 'rb') as file:
+                source_hash = hash_bytes(file.read())
+
+            # byte-identical photos are processed once and share the output
+            if source_hash in pending:
+                duplicates.append((source_path, stat, source_hash))
+                continue
+
+            processed = processed_by_hash.get(source_hash)
+            if processed is not None:
+                self.manifest[source_path] = [stat.st_mtime, stat.st_size, *processed[2:]]
+                results[source_path] = processed[5]
+                continue
+
+            pending[source_hash] = (source_path, stat)
+
+        if len(pending) != 0:
+            from concurrent.futures import ProcessPoolExecutor
+
+            jobs = [source_path for source_path, _ in pending.values()]
+            targets = [
+                PhotoPreprocessor.get_target_path(source_path, source_hash)
+                for source_hash, (source_path, _) in pending.items()
+            ]
+
+            # the pool is started from an executor thread of a running bot, a forked child would inherit
+            # the locks of the other threads in whatever state they are, so workers start from a clean process
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            mp_context = multiprocessing.get_context(start_method)
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs)), mp_context=mp_context) as executor:
+                futures = [
+                    executor.submit(process_image, source_path, target_path, self.max_size, self.quality)
+                    for source_path, target_path in zip(jobs, targets)
+                ]
+
+            for (source_hash, (source_path, stat)), target_path, future in zip(pending.items(), targets, futures):
+                try:
+                    target_hash = future.result()
+                except Exception as error:
+                    print(f"[Photo Preprocessor] Failed to process '{source_path}': {error}")
+                    continue
+
+                self.manifest[source_path] = [
+                    stat.st_mtime, stat.st_size, source_hash,
+                    self.max_size, self.quality, target_path, target_hash
+                ]
+                results[source_path] = target_path
+                processed_count += 1
+
+        for source_path, stat, source_hash in duplicates:
+            processed = self.manifest.get(pending[source_hash][0])
+            if processed is None or processed[2] != source_hash:
+                continue
+
+            self.manifest[source_path] = [stat.st_mtime, stat.st_size, *processed[2:]]
+            results[source_path] = processed[5]
+
+        atomic_write(self.manifest_path, json.dumps(self.manifest, indent=2, sort_keys=True).encode('UTF-8'))
+        print(f'[Photo Preprocessor] {processed_count} of {len(source_paths)} photos were processed.')
+        return results
@@ -0,0 +1,76 @@
+from telegram import Update, InlineQueryResultArticle, InputTextMessageContent
+from telegram.constants import ParseMode
+from telegram.ext import InlineQueryHandler
+
+from caching import LruCache
+from data import DataLoader, CityModel
+from keyboards import KeyboardCache
+from render import MessageRenderer
+
+
+class InlineSearchHandler(InlineQueryHandler):
+    # Telegram shows up to 50 results for a single inline query
+    RESULTS_LIMIT = 50
+
+    def __init__(self, bot):
+        super().__init__(self.handle_inline_query)
+        self.bot = bot
+        self.results = LruCache()
+
+    def register(self):
+        self.bot.app.add_handler(self)
+
+    def build(self):
+        data_loader: DataLoader = self.bot.data_loader
+
+        if data_loader.is_lazy_catalog():
+            self.results = LruCache(data_loader.catalog_cache_size)
+            return
+
+        results = LruCache()
+        for city_id in data_loader.city_models.keys():
+            results.put(city_id, self.construct_result(city_id))
+
+        self.results = results
+
+    def forget_results(self, city_ids: set):
+        for city_id in city_ids:
+            self.results.pop(city_id)
+
+    def get_result(self, city_id: str) -> InlineQueryResultArticle:
+        result = self.results.get(city_id)
+        if result is None:
+            result = self.construct_result(city_id)
+            self.results.put(city_id, result)
+
+        return result
+
+    def construct_result(self, city_id: str) -> InlineQueryResultArticle:
+        data_loader: DataLoader = self.bot.data_loader
+        renderer: MessageRenderer = self.bot.renderer
+        keyboards: KeyboardCache = self.bot.keyboards
+
+        city: CityModel = data_loader.get_city_model(city_id)
+
+        return InlineQueryResultArticle(
+            id=city_id,
+            title=f'{city.emoji} {city.name}',
+            description=city.country,
+            input_message_content=InputTextMessageContent(
+                renderer.get_city_texts(city_id).select_city,
+                parse_mode=ParseMode.MARKDOWN_V2
+            ),
+            reply_markup=keyboards.get_city_keyboards(city_id).select_city
+        )
+
+    async def handle_inline_query(self, update: Update, ctx):
+        query = update.inline_query
+        data_loader: DataLoader = self.bot.data_loader
+
+        city_ids = data_loader.search_index.search(query.query, InlineSearchHandler.RESULTS_LIMIT)
+
+        await query.answer(
+            [self.get_result(city_id) for city_id in city_ids],
+            cache_time=self.bot.prefs.inline_cache_time,
+            is_personal=False
+        )
@@ -0,0 +1,170 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from caching import LruCache
+from callbacks import callback_data
+from data import DataLoader, CityModel, CityPhoto
+
+
+class CityKeyboards:
+    def __init__(self, city: CityModel, page: int, show_forecast: bool):
+        city_id = city.city_id
+
+        weather_buttons = [
+            InlineKeyboardButton('📷 Фото', callback_data=callback_data('show_photos', city_id)),
+            InlineKeyboardButton('🌤 Погода', callback_data=callback_data('show_weather', city_id))
+        ]
+        if show_forecast:
+            weather_buttons.append(InlineKeyboardButton('📅 Прогноз', callback_data=callback_data('show_forecast', city_id)))
+
+        self.select_city = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton('📚 Открыть справочник', callback_data=callback_data('show_city_info', city_id)),
+                InlineKeyboardButton('⭐ В избранное', callback_data=callback_data('set_favorite', city_id))
+            ],
+            weather_buttons,
+            [
+                InlineKeyboardButton('🏘 Выбрать другой город', callback_data=callback_data('show_cities', page))
+            ]
+        ])
+
+        self.back = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton('🎲 Вернуться к выбору действия', callback_data=callback_data('select_city', city_id))
+            ]
+        ])
+
+        self.photo_sources = list()
+        counter = 1
+
+        for photo in city.photos:
+            photo: CityPhoto
+            if photo.source is None:
+                continue
+            self.photo_sources.append(InlineKeyboardButton(f"Источник #{counter}", url=photo.source))
+            counter += 1
+
+
+class KeyboardCache:
+    # Telegram accepts up to 100 buttons in a single inline keyboard
+    MAX_PAGE_SIZE = 90
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.page_size: int = min(max(1, bot.prefs.city_list_page_size), KeyboardCache.MAX_PAGE_SIZE)
+        self.columns: int = max(1, bot.prefs.city_list_columns)
+        self.alphabetical: bool = bot.prefs.city_list_alphabetical
+        self.city_keyboards = LruCache()
+        self.city_order = list()
+        self.city_positions = dict()
+        self.pages = LruCache()
+
+    def build(self):
+        data_loader: DataLoader = self.bot.data_loader
+
+        self.city_order = data_loader.get_city_ids(self.alphabetical)
+        self.city_positions = {city_id: index for index, city_id in enumerate(self.city_order)}
+
+        if data_loader.is_lazy_catalog():
+            # the catalog may be huge, keyboards are built on first use and kept in bounded caches
+            self.city_keyboards = LruCache(data_loader.catalog_cache_size)
+            self.pages = LruCache(data_loader.catalog_cache_size)
+            return
+
+        city_keyboards = LruCache()
+        for city_id in self.city_order:
+            city_keyboards.put(city_id, self.construct_city_keyboards(city_id))
+
+        self.city_keyboards = city_keyboards
+        self.pages = LruCache()
+
+    def update(self, changed: set, removed: set) -> set:
+        # returns the cities whose keyboards were dropped, results embedding them are stale as well
+        data_loader: DataLoader = self.bot.data_loader
+        previous_order = self.city_order
+        previous_positions = self.city_positions
+        previous_pages_count = self.pages_count()
+
+        self.city_order = data_loader.get_city_ids(self.alphabetical)
+        self.city_positions = {city_id: index for index, city_id in enumerate(self.city_order)}
+
+        if self.pages_count() != previous_pages_count:
+            # every page shows the pages count
+            self.pages.clear()
+        else:
+            for page in range(self.pages_count()):
+                start, end = page * self.page_size, (page + 1) * self.page_size
+                city_ids = self.city_order[start:end]
+                if city_ids != previous_order[start:end] or any(city_id in changed for city_id in city_ids):
+                    self.pages.pop(page)
+
+        # the back button of a city keyboard leads to the page of the city
+        stale = changed | removed
+        for city_id, position in self.city_positions.items():
+            previous_position = previous_positions.get(city_id)
+            if previous_position is not None and previous_position // self.page_size != position // self.page_size:
+                stale.add(city_id)
+
+        for city_id in stale:
+            self.city_keyboards.pop(city_id)
+
+        return stale
+
+    def get_city_keyboards(self, city_id: str) -> CityKeyboards:
+        keyboards: CityKeyboards = self.city_keyboards.get(city_id)
+        if keyboards is None and city_id in self.city_positions:
+            keyboards = self.construct_city_keyboards(city_id)
+            self.city_keyboards.put(city_id, keyboards)
+
+        return keyboards
+
+    def construct_city_keyboards(self, city_id: str) -> CityKeyboards:
+        data_loader: DataLoader = self.bot.data_loader
+        page = self.city_positions[city_id] // self.page_size
+        return CityKeyboards(data_loader.get_city_model(city_id), page, self.bot.forecast_service is not None)
+
+    def pages_count(self) -> int:
+        return max(1, -(-len(self.city_order) // self.page_size))
+
+    def get_city_list(self, page: int) -> InlineKeyboardMarkup:
+        page = min(max(0, page), self.pages_count() - 1)
+
+        keyboard = self.pages.get(page)
+        if keyboard is None:
+            keyboard = self.construct_city_list(page)
+            self.pages.put(page, keyboard)
+
+        return keyboard
+
+    def construct_city_list(self, page: int) -> InlineKeyboardMarkup:
+        data_loader: DataLoader = self.bot.data_loader
+        city_ids = self.city_order[page * self.page_size:(page + 1) * self.page_size]
+        buttons = [data_loader.get_city_model(city_id).as_inline_button() for city_id in city_ids]
+
+        rows = list()
+        for i in range(0, len(buttons), self.columns):
+            rows.append(buttons[i:i + self.columns])
+
+        pages_count = self.pages_count()
+        if pages_count > 1:
+            previous_page = (page - 1) % pages_count
+            next_page = (page + 1) % pages_count
+            rows.append([
+                InlineKeyboardButton('◀️', callback_data=callback_data('show_cities', previous_page)),
+                InlineKeyboardButton(f'{page + 1} / {pages_count}', callback_data=callback_data('show_cities', page)),
+                InlineKeyboardButton('▶️', callback_data=callback_data('show_cities', next_page))
+            ])
+
+        return InlineKeyboardMarkup(rows)
+
+    @staticmethod
+    def construct_nearest_cities(nearest_cities: list) -> InlineKeyboardMarkup:
+        rows = list()
+
+        for city, distance in nearest_cities:
+            city: CityModel
+            rows.append([InlineKeyboardButton(
+                f'{city.emoji} {city.name} · {round(distance)} км',
+                callback_data=callback_data('select_city', city.city_id)
+            )])
+
+        return InlineKeyboardMarkup(rows)
@@ -0,0 +1,128 @@
+from bisect import bisect_left
+
+from web import HttpServer, HttpRequest, HttpResponse
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+AGE_BUCKETS = (60, 300, 900, 1800, 3600, 7200, 10800, 21600, 43200, 86400)
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(label_names: tuple, label_values: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if len(pairs) != 0 else ''
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        # label values -> value
+        self.values = dict()
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self, lines: list):
+        lines.append(f'# HELP {self.name} {self.documentation}')
+        lines.append(f'# TYPE {self.name} counter')
+        for label_values, value in self.values.items():
+            lines.append(f'{self.name}{format_labels(self.label_names, label_values)} {value}')
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [counts per bucket + overflow, sum]
+        self.series = dict()
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = [[0] * (len(self.buckets) + 1), 0.0]
+            self.series[label_values] = series
+
+        # counts are kept per bucket and only accumulated when rendered
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self, lines: list):
+        lines.append(f'# HELP {self.name} {self.documentation}')
+        lines.append(f'# TYPE {self.name} histogram')
+
+        for label_values, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+
+            cumulative += counts[-1]
+            labels = format_labels(self.label_names, label_values, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = list()
+
+    def counter(self, name: str, documentation: str, label_names: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> bytes:
+        lines = list()
+        for metric in self.metrics:
+            metric.render(lines)
+        lines.append('')
+        return '\n'.join(lines).encode('UTF-8')
+
+
+REGISTRY = MetricsRegistry()
+
+UPDATES = REGISTRY.counter('bot_updates_total', 'Updates received from Telegram', ('type',))
+ACTION_DURATION = REGISTRY.histogram('bot_action_duration_seconds', 'Time spent handling callback actions', ('action',))
+ACTION_ERRORS = REGISTRY.counter('bot_action_errors_total', 'Callback actions failed with an exception', ('action',))
+COMMAND_DURATION = REGISTRY.histogram('bot_command_duration_seconds', 'Time spent handling commands', ('command',))
+COMMAND_ERRORS = REGISTRY.counter('bot_command_errors_total', 'Commands failed with an exception', ('command',))
+ALERTS_SENT = REGISTRY.counter('bot_alerts_sent_total', 'Weather alerts sent to subscribed chats', ('result',))
+
+TELEGRAM_API_DURATION = REGISTRY.histogram('telegram_api_duration_seconds', 'Bot API request latency', ('method',))
+TELEGRAM_API_ERRORS = REGISTRY.counter('telegram_api_errors_total', 'Failed Bot API requests', ('method', 'error'))
+
+WEATHER_API_DURATION = REGISTRY.histogram('weather_api_duration_seconds', 'Weather API request latency', ('kind',))
+WEATHER_API_RESPONSES = REGISTRY.counter('weather_api_responses_total', 'Weather API responses by status', ('kind', 'status'))
+WEATHER_CIRCUIT_CHANGES = REGISTRY.counter(
+    'weather_circuit_changes_total', 'Weather API circuit breaker state changes', ('state',)
+)
+WEATHER_CACHE_LOOKUPS = REGISTRY.counter('weather_cache_lookups_total', 'Weather cache lookups', ('result',))
+WEATHER_CACHE_AGE = REGISTRY.histogram(
+    'weather_cache_age_seconds', 'Age of the weather data served from the cache', buckets=AGE_BUCKETS
+)
+
+
+class MetricsServer(HttpServer):
+    def __init__(self, host: str, port: int):
+        super().__init__(host, port)
+        self.route('GET', '/metrics', self.handle_metrics)
+
+    async def handle_metrics(self, request: HttpRequest) -> HttpResponse:
+        return HttpResponse(200, REGISTRY.render(), 'text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,117 @@
+import asyncio
+import struct
+from time import time
+
+from files import atomic_write
+from weather import WeatherService, CityWeatherData
+
+
+class WeatherSnapshot:
+    MAGIC = b'TCWS'
+    VERSION = 1
+
+    # magic, version, saved at, records count
+    HEADER = struct.Struct('<4sBdI')
+
+    def __init__(self, service: WeatherService, path: str, interval: int, max_age: int):
+        self.service = service
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.task = None
+
+    def load(self) -> int:
+        try:
+            with open(self.path, 'rb') as file:
+                raw = file.read()
+        except FileNotFoundError:
+            return 0
+
+        try:
+            records = self.decode(raw)
+        except (ValueError, IndexError, struct.error, UnicodeDecodeError) as error:
+            print(f"[Weather Snapshot] Ignoring corrupted snapshot '{self.path}': {error}")
+            return 0
+
+        oldest_allowed = time() - self.max_age
+        restored = 0
+
+        for city_id, data in records.items():
+            if data.updated_epoch < oldest_allowed:
+                continue
+
+            if self.service.restore_weather_data(city_id, data):
+                restored += 1
+
+        return restored
+
+    def save(self):
+        try:
+            atomic_write(self.path, self.encode(self.service.cache))
+        except OSError as error:
+            # the bot is stopping anyway, the previous snapshot stays in place
+            print(f"[Weather Snapshot] Failed to save snapshot: {error}")
+
+    def encode(self, cache: dict) -> bytes:
+        chunks = list()
+
+        for city_id, data in cache.items():
+            if data is None:
+                continue
+
+            data: CityWeatherData
+            encoded_id = city_id.encode('UTF-8')
+            chunks.append(struct.pack('<B', len(encoded_id)))
+            chunks.append(encoded_id)
+
+            record = bytearray(CityWeatherData.RECORD.size)
+            data.pack_into(record, 0)
+            chunks.append(record)
+
+        header = WeatherSnapshot.HEADER.pack(WeatherSnapshot.MAGIC, WeatherSnapshot.VERSION, time(), len(chunks) // 3)
+        return header + b''.join(chunks)
+
+    @staticmethod
+    def decode(raw: bytes) -> dict:
+        magic, version, _, count = WeatherSnapshot.HEADER.unpack_from(raw, 0)
+        if magic != WeatherSnapshot.MAGIC or version != WeatherSnapshot.VERSION:
+            raise ValueError('unsupported snapshot format')
+
+        records = dict()
+        offset = WeatherSnapshot.HEADER.size
+
+        for _ in range(count):
+            id_length = raw[offset]
+            city_id = raw[offset + 1:offset + 1 + id_length].decode('UTF-8')
+            offset += 1 + id_length
+
+            records[city_id] = CityWeatherData.unpack_from(raw, offset)
+            offset += CityWeatherData.RECORD.size
+
+        return records
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run(), name='Weather Snapshot')
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        self.save()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(self.interval)
+
+            payload = self.encode(self.service.cache)
+            try:
+                await loop.run_in_executor(None, atomic_write, self.path, payload)
+            except OSError as error:
+                print(f"[Weather Snapshot] Failed to save snapshot: {error}")
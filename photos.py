@@ -0,0 +1,209 @@
+import asyncio
+import json
+import os
+
+from telegram.error import TelegramError
+from telegram.ext import ExtBot
+
+from data import DataLoader, CityModel, CityPhoto
+from files import atomic_write, hash_file
+from imaging import PhotoPreprocessor
+
+PHOTOS_DIRECTORY = 'data/photos'
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+class PhotoIndex:
+    def __init__(self, path: str):
+        self.path = path
+        # content hash -> bot id -> file_id, file_ids are only valid for the bot which received them
+        self.file_ids = dict()
+        # file path -> [mtime, size, content hash], so unchanged files are not hashed again
+        self.hashes = dict()
+        self.changed = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='UTF-8') as file:
+                raw = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError as error:
+            print(f"[Photo Sync] Ignoring corrupted photo index '{self.path}': {error}")
+            return
+
+        self.file_ids = raw.get('file_ids', dict())
+        self.hashes = raw.get('hashes', dict())
+
+    def save(self):
+        if not self.changed:
+            return
+
+        raw = {'file_ids': self.file_ids, 'hashes': self.hashes}
+        atomic_write(self.path, json.dumps(raw, indent=2, sort_keys=True).encode('UTF-8'))
+        self.changed = False
+
+    def get_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        cached = self.hashes.get(path)
+        if cached is not None and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            return cached[2]
+
+        content_hash = hash_file(path)
+        self.hashes[path] = [stat.st_mtime, stat.st_size, content_hash]
+        self.changed = True
+        return content_hash
+
+    def get_file_id(self, content_hash: str, bot_id: int) -> str:
+        return self.file_ids.get(content_hash, dict()).get(str(bot_id))
+
+    def put_file_id(self, content_hash: str, bot_id: int, file_id: str):
+        self.file_ids.setdefault(content_hash, dict())[str(bot_id)] = file_id
+        self.changed = True
+
+
+class PhotoLibrary:
+    def __init__(self, bot):
+        self.bot = bot
+        self.index = PhotoIndex(bot.prefs.photo_index_file)
+        self.storage_chat_id = bot.prefs.photo_storage_chat_id
+        self.max_parallel_uploads: int = bot.prefs.photo_upload_concurrency
+        # (city_id, file) -> file_id valid for the current bot
+        self.file_ids = dict()
+        # photos found in data/photos/<city> which aren't listed in the catalog
+        self.discovered_photos = dict()
+        # original photo path -> resized and recompressed copy used for uploads
+        self.processed_paths = dict()
+        # disabled in cluster workers which only pick up file_ids uploaded by another worker
+        self.resolve_missing = True
+        self.task = None
+
+        self.preprocessor = None
+        if bot.prefs.photo_preprocessing:
+            if PhotoPreprocessor.is_available():
+                self.preprocessor = PhotoPreprocessor(
+                    bot.prefs.photo_preprocess_manifest,
+                    bot.prefs.photo_max_size,
+                    bot.prefs.photo_quality,
+                    bot.prefs.photo_preprocess_workers
+                )
+            else:
+                print('[Photo Sync] Pillow is not installed, photos will be uploaded without preprocessing.')
+
+    def get_photos(self, city: CityModel) -> list:
+        return city.photos + self.discovered_photos.get(city.city_id, list())
+
+    def get_file_id(self, city_id: str, photo: CityPhoto) -> str:
+        file_id = self.file_ids.get((city_id, photo.file))
+        return file_id if file_id is not None else photo.tg_id
+
+    def get_photo_path(self, city_id: str, photo: CityPhoto) -> str:
+        return os.path.join(PHOTOS_DIRECTORY, city_id, photo.file)
+
+    def get_upload_path(self, city_id: str, photo: CityPhoto) -> str:
+        path = self.get_photo_path(city_id, photo)
+        return self.processed_paths.get(path, path)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.sync(), name='Photo Sync')
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def collect_photos(self) -> tuple:
+        data_loader: DataLoader = self.bot.data_loader
+        photos = list()
+        discovered_photos = dict()
+
+        if not os.path.isdir(PHOTOS_DIRECTORY):
+            return photos, discovered_photos
+
+        for city_id in sorted(os.listdir(PHOTOS_DIRECTORY)):
+            city: CityModel = data_loader.get_city_model(city_id)
+            if city is None:
+                continue
+
+            listed_files = set(photo.file for photo in city.photos)
+            discovered = list()
+
+            for file in sorted(os.listdir(os.path.join(PHOTOS_DIRECTORY, city_id))):
+                if file in listed_files or not file.lower().endswith(PHOTO_EXTENSIONS):
+                    continue
+                discovered.append(CityPhoto({'file': file}))
+
+            if len(discovered) != 0:
+                discovered_photos[city_id] = discovered
+
+            for photo in city.photos + discovered:
+                photos.append((city_id, photo))
+
+        return photos, discovered_photos
+
+    async def sync(self):
+        bot: ExtBot = self.bot.get()
+        loop = asyncio.get_running_loop()
+
+        self.index.load()
+        photos, discovered_photos = self.collect_photos()
+        # built from scratch and swapped in at the end, a restart after a data reload drops removed cities and files
+        file_ids = dict()
+        semaphore = asyncio.Semaphore(self.max_parallel_uploads)
+
+        if self.preprocessor is not None:
+            source_paths = [self.get_photo_path(city_id, photo) for city_id, photo in photos]
+            source_paths = [path for path in source_paths if os.path.exists(path)]
+            self.processed_paths = await loop.run_in_executor(None, self.preprocessor.run, source_paths)
+
+        async def sync_photo(city_id: str, photo: CityPhoto):
+            path = self.get_upload_path(city_id, photo)
+            if not os.path.exists(path):
+                return
+
+            content_hash = await loop.run_in_executor(None, self.index.get_hash, path)
+
+            file_id = self.index.get_file_id(content_hash, bot.id)
+            if file_id is None:
+                if not self.resolve_missing:
+                    return
+
+                async with semaphore:
+                    file_id = await self.resolve_file_id(bot, photo, path)
+
+                if file_id is None:
+                    return
+                self.index.put_file_id(content_hash, bot.id, file_id)
+
+            file_ids[(city_id, photo.file)] = file_id
+
+        results = await asyncio.gather(*[sync_photo(city_id, photo) for city_id, photo in photos], return_exceptions=True)
+        for (city_id, photo), result in zip(photos, results):
+            if isinstance(result, Exception):
+                print(f"[Photo Sync] Failed to sync '{city_id}/{photo.file}': {result}")
+
+        self.file_ids = file_ids
+        self.discovered_photos = discovered_photos
+        self.index.save()
+        print(f'[Photo Sync] {len(file_ids)} of {len(photos)} photos are ready to be sent by file_id.')
+
+    async def resolve_file_id(self, bot: ExtBot, photo: CityPhoto, path: str):
+        # file_ids from the catalog only work for the bot which uploaded the photo
+        if photo.tg_id is not None:
+            try:
+                await bot.get_file(photo.tg_id)
+                return photo.tg_id
+            except TelegramError:
+                pass
+
+        if self.storage_chat_id is None:
+            return None
+
+        with open(path, 'rb') as file:
+            message = await bot.send_photo(self.storage_chat_id, photo=file, disable_notification=True)
+
+        return message.photo[-1].file_id
@@ -0,0 +1,163 @@
+import asyncio
+from time import monotonic, perf_counter
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import TELEGRAM_API_DURATION, TELEGRAM_API_ERRORS
+
+# requests of these endpoints put a message into a chat and count towards its flood limit
+CHAT_ENDPOINT_PREFIXES = ('send', 'edit', 'copy', 'forward')
+EDIT_ENDPOINTS = frozenset(('editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup'))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def is_full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChatLane:
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        # asyncio.Lock wakes waiters in FIFO order, so messages to a chat keep their order
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    # Telegram tolerates short bursts in a single chat
+    CHAT_BURST = 3
+    LANES_SWEEP_THRESHOLD = 10000
+
+    def __init__(self, messages_per_second: float, chat_messages_per_second: float,
+                 group_messages_per_minute: float, max_retries: int):
+        self.bucket = TokenBucket(messages_per_second, messages_per_second)
+        self.chat_messages_per_second = chat_messages_per_second
+        self.group_messages_per_second = group_messages_per_minute / 60
+        self.max_retries = max_retries
+
+        self.lanes = dict()
+        self.next_lanes_sweep = OutboundRateLimiter.LANES_SWEEP_THRESHOLD
+        # (chat id or inline message id, message id) -> sequence number of the latest queued edit
+        self.edit_sequences = dict()
+        self.paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def get_lane(self, lane_key) -> ChatLane:
+        lane = self.lanes.get(lane_key)
+        if lane is not None:
+            return lane
+
+        if len(self.lanes) >= self.next_lanes_sweep:
+            self.sweep_lanes()
+
+        # negative ids and @usernames belong to groups and channels, which have a lower limit
+        is_group = isinstance(lane_key, str) and lane_key.startswith('@') \
+            or isinstance(lane_key, int) and lane_key < 0
+        rate = self.group_messages_per_second if is_group else self.chat_messages_per_second
+
+        lane = ChatLane(TokenBucket(rate, OutboundRateLimiter.CHAT_BURST))
+        self.lanes[lane_key] = lane
+        return lane
+
+    def sweep_lanes(self):
+        # lanes without queued requests and with a full bucket don't carry any state worth keeping
+        self.lanes = {key: lane for key, lane in self.lanes.items() if lane.pending != 0 or not lane.bucket.is_full()}
+        self.next_lanes_sweep = max(OutboundRateLimiter.LANES_SWEEP_THRESHOLD, len(self.lanes) * 2)
+
+    def pause(self, delay: float):
+        self.paused_until = max(self.paused_until, monotonic() + delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint: str, data: dict, rate_limit_args):
+        max_retries = rate_limit_args if rate_limit_args is not None else self.max_retries
+
+        lane_key = data.get('chat_id')
+        if lane_key is None:
+            lane_key = data.get('inline_message_id')
+
+        # answers to callback and inline queries don't post anything into a chat
+        if lane_key is None:
+            return await self.run_request(callback, args, kwargs, endpoint, max_retries, is_limited=False)
+
+        if not endpoint.startswith(CHAT_ENDPOINT_PREFIXES):
+            return await self.run_request(callback, args, kwargs, endpoint, max_retries, is_limited=True)
+
+        edit_key = None
+        sequence = 0
+        if endpoint in EDIT_ENDPOINTS:
+            edit_key = (lane_key, data.get('message_id'))
+            sequence = self.edit_sequences.get(edit_key, 0) + 1
+            self.edit_sequences[edit_key] = sequence
+
+        lane = self.get_lane(lane_key)
+        lane.pending += 1
+        try:
+            async with lane.lock:
+                await lane.bucket.acquire()
+
+                if edit_key is not None:
+                    if self.edit_sequences[edit_key] != sequence:
+                        # a newer edit of the same message is queued behind, it would overwrite this one anyway
+                        lane.bucket.tokens += 1
+                        return True
+                    del self.edit_sequences[edit_key]
+
+                return await self.run_request(callback, args, kwargs, endpoint, max_retries, is_limited=True)
+        finally:
+            lane.pending -= 1
+
+    async def run_request(self, callback, args, kwargs, endpoint: str, max_retries: int, is_limited: bool):
+        attempt = 0
+
+        while True:
+            delay = self.paused_until - monotonic()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.paused_until - monotonic()
+
+            if is_limited:
+                await self.bucket.acquire()
+
+            started_at = perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as error:
+                TELEGRAM_API_ERRORS.inc(endpoint, 'RetryAfter')
+                if attempt >= max_retries:
+                    raise
+
+                attempt += 1
+                print(f'[Rate Limiter] Flood limit hit, retrying in {error.retry_after} seconds...')
+                # the flood limit applies to the whole bot, so every request waits it out
+                self.pause(error.retry_after + 0.1)
+            except Exception as error:
+                TELEGRAM_API_ERRORS.inc(endpoint, error.__class__.__name__)
+                raise
+            finally:
+                TELEGRAM_API_DURATION.observe(perf_counter() - started_at, endpoint)
@@ -0,0 +1,186 @@
+import asyncio
+import os
+
+from data import DataLoader, CityModel, DATA_SOURCE_PATHS, CATALOG_DATABASE_PATH
+
+RELOAD_ERRORS = (OSError, ValueError, KeyError, TypeError)
+
+
+def stat_source(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class DataWatcher:
+    def __init__(self, bot, interval: float):
+        self.bot = bot
+        self.interval = interval
+        self.source_stats = dict()
+        self.task = None
+
+    def start(self):
+        if self.interval <= 0:
+            return
+
+        self.source_stats = {name: stat_source(path) for name, path in DATA_SOURCE_PATHS.items()}
+        self.task = asyncio.get_running_loop().create_task(self.run(), name='Data Watcher')
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            for name, path in DATA_SOURCE_PATHS.items():
+                stat = stat_source(path)
+                if stat is None or stat == self.source_stats.get(name):
+                    continue
+
+                # remembered upfront, so a broken file is reported once and not on every poll
+                self.source_stats[name] = stat
+                try:
+                    await self.reload(name, path)
+                except RELOAD_ERRORS as error:
+                    print(f"[Data Reload] Failed to reload '{path}', keeping the current data: {error!r}")
+
+    async def reload(self, name: str, path: str):
+        loop = asyncio.get_running_loop()
+        data_loader: DataLoader = self.bot.data_loader
+
+        if name == 'phrases':
+            phrases = await loop.run_in_executor(None, DataLoader.read_source, path)
+            if len(phrases) == 0:
+                raise ValueError('no phrases')
+
+            data_loader.user_photo_reactions = phrases
+            print(f"[Data Reload] Reloaded {len(phrases)} phrases from '{path}'.")
+            return
+
+        if name == 'weather_conditions':
+            parsed = await loop.run_in_executor(None, DataLoader.read_source, path)
+            data_loader.weather_conditions = DataLoader.build_weather_conditions(parsed)
+
+            renderer = self.bot.renderer
+            if renderer is not None:
+                renderer.weather_templates.clear()
+                renderer.forecast_texts.clear()
+
+            print(f"[Data Reload] Reloaded {len(data_loader.weather_conditions)} weather conditions from '{path}'.")
+            return
+
+        if data_loader.is_lazy_catalog():
+            await self.reload_catalog(path)
+        else:
+            await self.reload_city_models(path)
+
+    async def reload_city_models(self, path: str):
+        loop = asyncio.get_running_loop()
+        data_loader: DataLoader = self.bot.data_loader
+
+        # parsing takes a while for large files, so it's done off the event loop
+        parsed = await loop.run_in_executor(None, DataLoader.read_source, path)
+        city_models = await loop.run_in_executor(None, DataLoader.build_city_models, parsed)
+
+        changed = set()
+        # names and locations are indexed, other fields are only shown
+        reindex = False
+        for city_id, city in city_models.items():
+            current_city: CityModel = data_loader.city_models.get(city_id)
+            if current_city is not None and current_city.same_as(city):
+                city_models[city_id] = current_city
+                continue
+
+            changed.add(city_id)
+            if current_city is None or not DataWatcher.same_indexed_fields(current_city, city):
+                reindex = True
+
+        removed = data_loader.city_models.keys() - city_models.keys()
+        reordered = list(city_models.keys()) != list(data_loader.city_models.keys())
+        if len(changed) == 0 and len(removed) == 0 and not reordered:
+            return
+
+        data_loader.city_models = city_models
+        self.apply_city_changes(changed, removed, reindex or len(removed) != 0)
+        print(f"[Data Reload] Reloaded cities from '{path}': {len(changed)} added or changed, {len(removed)} removed.")
+
+    @staticmethod
+    def same_indexed_fields(city: CityModel, other: CityModel) -> bool:
+        return city.name == other.name and city.country == other.country \
+            and city.raw_lat == other.raw_lat and city.raw_lon == other.raw_lon
+
+    async def reload_catalog(self, path: str):
+        from catalog import SqliteCityCatalog
+
+        loop = asyncio.get_running_loop()
+        data_loader: DataLoader = self.bot.data_loader
+
+        # connections to the replaced database keep reading the old file until they are closed
+        await loop.run_in_executor(None, SqliteCityCatalog.build, path, CATALOG_DATABASE_PATH)
+
+        catalog = data_loader.city_models
+        data_loader.city_models = data_loader.open_catalog()
+        catalog.close()
+
+        self.apply_cities()
+        print(f"[Data Reload] Rebuilt the city catalog from '{path}' with {len(data_loader.city_models)} cities.")
+
+    def apply_cities(self):
+        # everything is rebuilt, a replaced catalog doesn't tell what has changed
+        bot = self.bot
+        data_loader: DataLoader = bot.data_loader
+        data_loader.build_indexes()
+        self.sync_weather()
+
+        # the weather process of a cluster has no application to rebuild
+        if bot.renderer is None:
+            return
+
+        bot.renderer.build()
+        bot.keyboards.build()
+        bot.inline_search.build()
+        self.restart_photo_sync_later()
+
+    def apply_city_changes(self, changed: set, removed: set, reindex: bool):
+        bot = self.bot
+        data_loader: DataLoader = bot.data_loader
+        if reindex:
+            data_loader.build_indexes()
+            # query items only depend on locations
+            self.sync_weather()
+
+        if bot.renderer is None:
+            return
+
+        bot.renderer.forget_cities(changed | removed)
+        stale = bot.keyboards.update(changed, removed)
+        # inline results embed the city text and keyboard
+        bot.inline_search.forget_results(stale)
+        self.restart_photo_sync_later()
+
+    def sync_weather(self):
+        bot = self.bot
+        forgotten = bot.weather_service.fetcher.sync_query_items()
+        bot.weather_service.forget_weather_data(forgotten)
+        if bot.forecast_service is not None:
+            bot.forecast_service.forget_forecasts(forgotten)
+        if bot.alert_engine is not None:
+            bot.alert_engine.forget_cities(forgotten)
+
+    def restart_photo_sync_later(self):
+        if self.bot.photo_library.task is not None:
+            asyncio.get_running_loop().create_task(self.restart_photo_sync(), name='Photo Sync Restart')
+
+    async def restart_photo_sync(self):
+        photo_library = self.bot.photo_library
+        await photo_library.stop()
+        photo_library.start()
@@ -0,0 +1,313 @@
+import math
+from datetime import datetime, timedelta
+from time import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from caching import LruCache
+from callbacks import callback_data
+from data import DataLoader, CityModel, WeatherCondition
+from weather import WeatherService, CityWeatherData
+
+
+class CityTexts:
+    def __init__(self, city: CityModel):
+        self.select_city = (
+            '*Выберите действие с городом*\n'
+            '\n'
+            f'{city.emoji} Город: `{city.name}`\n'
+            f'🌍 Страна: `{city.country}`'
+        )
+
+        self.favorite_set = (
+            f'{self.select_city}\n'
+            '\n'
+            '⭐ _Город добавлен в избранное, /start откроет его сразу_'
+        )
+
+        self.city_info = (
+            f'*Справка о городе {city.name} {city.emoji}*\n'
+            '\n'
+            f'○ Страна: `{city.country}`\n'
+            f'○ Широта: `{city.latitude}`\n'
+            f'○ Долгота: `{city.longitude}`\n'
+            f'○ Площадь: `{city.area} км²`\n'
+            f'○ Население: `{city.population}`'
+        )
+
+        self.photos_missing = (
+            '*Фотографии города*\n'
+            '\n'
+            f'*Город:* {city.name} {city.emoji}\n'
+            '\n'
+            '_К сожалению, фотографии пока отсутствуют :\\(_\n'
+            '_Мы обязательно добавим их позже\\._'
+        )
+
+        self.photos_caption = (
+            '*Фотографии города*\n'
+            '\n'
+            f'*Город:* {city.name} {city.emoji}\n'
+            '\n'
+            'Вот несколько фото выбранного города 🥺\n'
+            'Оригинальные источники доступны ниже\\.'
+        )
+
+        self.weather_missing = (
+            '*Информация о текущей погоде*\n'
+            '\n'
+            f'*Город:* {city.name} {city.emoji}\n'
+            '\n'
+            '_К сожалению, информация в данный момент отстутствует :\\(_\n'
+            '_Это может быть вызвано техническими неполадками\\._\n'
+            '_Попробуйте повторить запрос позже\\._'
+        )
+
+        self.forecast_missing = (
+            '*Прогноз погоды*\n'
+            '\n'
+            f'*Город:* {city.name} {city.emoji}\n'
+            '\n'
+            '_К сожалению, прогноз пока не загружен :\\(_\n'
+            '_Попробуйте повторить запрос позже\\._'
+        )
+
+
+class MessageRenderer:
+    SHOWN_CONTENT_LIMIT = 10000
+    FORECAST_HOURS = 24
+    FORECAST_HOURS_STEP = 3
+    STALE_WEATHER_NOTE = '\n\n⚠️ _Сервис погоды сейчас недоступен, показаны последние полученные данные_'
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.city_texts = LruCache()
+        # weather text parts around the local time and the update age, filled in per request
+        self.weather_templates = LruCache()
+        self.shown_content = LruCache(MessageRenderer.SHOWN_CONTENT_LIMIT)
+        # city id -> (base hour of the forecast store, text)
+        self.forecast_texts = LruCache()
+        self.weather_stale_after: int = bot.prefs.weather_stale_after
+
+    def build(self):
+        data_loader: DataLoader = self.bot.data_loader
+
+        if data_loader.is_lazy_catalog():
+            # the catalog may be huge, texts are built on first use and kept in bounded caches
+            self.city_texts = LruCache(data_loader.catalog_cache_size)
+            self.weather_templates = LruCache(data_loader.catalog_cache_size)
+            self.forecast_texts = LruCache(data_loader.catalog_cache_size)
+            return
+
+        city_texts = LruCache()
+        for city in data_loader.city_models.values():
+            city_texts.put(city.city_id, CityTexts(city))
+
+        self.city_texts = city_texts
+        self.weather_templates = LruCache()
+        self.forecast_texts = LruCache()
+
+    def forget_cities(self, city_ids: set):
+        # rebuilt on the next use from the reloaded city models
+        for city_id in city_ids:
+            self.city_texts.pop(city_id)
+            self.weather_templates.pop(city_id)
+            self.forecast_texts.pop(city_id)
+
+    def get_city_texts(self, city_id: str) -> CityTexts:
+        texts: CityTexts = self.city_texts.get(city_id)
+        if texts is not None:
+            return texts
+
+        data_loader: DataLoader = self.bot.data_loader
+        city: CityModel = data_loader.get_city_model(city_id)
+        if city is None:
+            return None
+
+        texts = CityTexts(city)
+        self.city_texts.put(city_id, texts)
+        return texts
+
+    def on_weather_update(self, city_id: str, data: CityWeatherData):
+        # only called for changed readings, a refresh with the same readings keeps the template
+        self.weather_templates.pop(city_id)
+
+    def get_temperature_trend(self, city_id: str) -> str:
+        weather_service: WeatherService = self.bot.weather_service
+        history = weather_service.get_weather_history(city_id)
+        if len(history) < 2:
+            return ''
+
+        difference = round(history[0].temp_c) - round(history[1].temp_c)
+        if difference == 0:
+            return ''
+        return ' ↑' if difference > 0 else ' ↓'
+
+    def compile_weather_template(self, city_id: str, data: CityWeatherData):
+        data_loader: DataLoader = self.bot.data_loader
+        city: CityModel = data_loader.get_city_model(city_id)
+
+        gmt_offset = f'\\+{city.time_offset // 60}' if city.time_offset >= 0 else city.time_offset // 60
+
+        condition: WeatherCondition = data_loader.get_weather_condition(data.condition_code)
+        condition_text: str = condition.get_text(data.is_day)
+        condition_emoji: str = condition.get_emoji(data.is_day)
+
+        head = (
+            '*Информация о текущей погоде*\n'
+            '\n'
+            f'*Город:* {city.name} {city.emoji}\n'
+            f'_{condition_text}_ {condition_emoji}\n'
+            '\n'
+            '○ Местное время:  `'
+        )
+
+        body = (
+            f'`  `GMT{gmt_offset}`\n'
+            f'○ Температура:  `{round(data.temp_c)}°C / {round(data.temp_f)}°F`{self.get_temperature_trend(city_id)}\n'
+            f'○ Ощущается как:  `{round(data.feelslike_c)}°C / {round(data.feelslike_f)}°F`\n'
+            f'○ Влажность:  `{data.humidity}%`\n'
+            f'○ Облачность:  `{data.cloud}%`\n'
+            '\n'
+            'Последнее обновление: *'
+        )
+
+        return head, body, ' мин\\. назад*', city.time_offset
+
+    def render_weather(self, city_id: str) -> str:
+        weather_service: WeatherService = self.bot.weather_service
+        data: CityWeatherData = weather_service.get_cached_weather_data(city_id)
+        if data is None:
+            return self.get_city_texts(city_id).weather_missing
+
+        # the update time isn't a part of the template, refreshes with the same readings only move it
+        template = self.weather_templates.get(city_id)
+        if template is None:
+            template = self.compile_weather_template(city_id, data)
+            self.weather_templates.put(city_id, template)
+
+        head, body, tail, time_offset = template
+
+        local_datetime = datetime.utcnow() + timedelta(minutes=time_offset)
+
+        # the last good reading is served with its real age while the upstream fails
+        age = time() - data.updated_epoch
+        update_time_ago: int = round(age / 60.0)
+
+        if update_time_ago == 0:
+            update_time_ago = 1
+
+        if age > self.weather_stale_after:
+            tail += MessageRenderer.STALE_WEATHER_NOTE
+
+        return f"{head}{local_datetime.strftime('%d.%m.%y %H:%M:%S')}{body}{update_time_ago}{tail}"
+
+    def render_alert(self, city_id: str, previous_temp_c: float, data: CityWeatherData) -> tuple:
+        data_loader: DataLoader = self.bot.data_loader
+        city: CityModel = data_loader.get_city_model(city_id)
+
+        condition: WeatherCondition = data_loader.get_weather_condition(data.condition_code)
+        condition_text: str = condition.get_text(data.is_day)
+        condition_emoji: str = condition.get_emoji(data.is_day)
+
+        text = (
+            '🔔 *Погода изменилась*\n'
+            '\n'
+            f'*Город:* {city.name} {city.emoji}\n'
+            f'_{condition_text}_ {condition_emoji}\n'
+            '\n'
+            f'○ Температура:  `{round(data.temp_c)}°C`, было `{round(previous_temp_c)}°C`\n'
+            '\n'
+            '_Отписаться: /unsubscribe_'
+        )
+
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton('🌤 Подробнее', callback_data=callback_data('show_weather', city_id))]
+        ])
+
+        return text, reply_markup
+
+    def on_forecast_update(self, city_id: str, start_hour: int, values: dict, fetched_at: float):
+        self.forecast_texts.pop(city_id)
+
+    def render_forecast(self, city_id: str) -> str:
+        forecast_service = self.bot.forecast_service
+        if forecast_service is None or city_id not in forecast_service.store.rows.keys():
+            return self.get_city_texts(city_id).forecast_missing
+
+        store = forecast_service.store
+        store.advance()
+
+        cached = self.forecast_texts.get(city_id)
+        if cached is not None and cached[0] == store.base_hour:
+            return cached[1]
+
+        text = self.compile_forecast(city_id, store)
+        self.forecast_texts.put(city_id, (store.base_hour, text))
+        return text
+
+    def compile_forecast(self, city_id: str, store) -> str:
+        data_loader: DataLoader = self.bot.data_loader
+        city: CityModel = data_loader.get_city_model(city_id)
+        row = store.rows[city_id]
+
+        lines = [
+            '*Прогноз погоды*',
+            '',
+            f'*Город:* {city.name} {city.emoji}',
+            '',
+            '*Ближайшие часы:*'
+        ]
+
+        temp_c = store.columns['temp_c'][row]
+        chance_of_rain = store.columns['chance_of_rain'][row]
+        condition_codes = store.columns['condition_code'][row]
+        is_day = store.columns['is_day'][row]
+
+        for hour in range(0, min(MessageRenderer.FORECAST_HOURS, store.hours), MessageRenderer.FORECAST_HOURS_STEP):
+            if math.isnan(temp_c[hour]):
+                continue
+
+            local_time = datetime.utcfromtimestamp((store.base_hour + hour) * 3600) + timedelta(minutes=city.time_offset)
+            condition: WeatherCondition = data_loader.get_weather_condition(int(condition_codes[hour]))
+            emoji = condition.get_emoji(bool(is_day[hour])) if condition is not None else '❔'
+            lines.append(
+                f"`{local_time.strftime('%H:%M')}`  {emoji}  `{round(float(temp_c[hour])):+d}°C`  "
+                f'💧 `{round(float(chance_of_rain[hour]))}%`'
+            )
+
+        lines.append('')
+        lines.append('*По дням:*')
+
+        # a single row, so every aggregate holds one value per local day
+        days = store.daily_aggregates(city.time_offset, [row])
+        for index, day in enumerate(days['day']):
+            if days['hours'][0, index] == 0:
+                continue
+
+            date = datetime.utcfromtimestamp(int(day) * 86400)
+            condition: WeatherCondition = data_loader.get_weather_condition(int(days['condition_code'][0, index]))
+            emoji = condition.get_emoji(True) if condition is not None else '❔'
+            min_temp = round(float(days['min_temp_c'][0, index]))
+            max_temp = round(float(days['max_temp_c'][0, index]))
+            lines.append(
+                f"`{date.strftime('%d.%m')}`  {emoji}  `{min_temp:+d}…{max_temp:+d}°C`  "
+                f"💧 `{float(days['precip_mm'][0, index]):.1f} мм`"
+            )
+
+        fetched_at = datetime.utcfromtimestamp(float(store.fetched_at[row])) + timedelta(minutes=city.time_offset)
+        lines.append('')
+        lines.append(f"Обновлено в *{fetched_at.strftime('%H:%M')}* по местному времени")
+        return '\n'.join(lines)
+
+    def remember_content(self, message_key, text: str, reply_markup) -> bool:
+        content_hash = hash((text, reply_markup))
+
+        if self.shown_content.get(message_key) == content_hash:
+            return False
+
+        self.shown_content.put(message_key, content_hash)
+        return True
+
+    def forget_content(self, message_key):
+        self.shown_content.pop(message_key, None)
@@ -0,0 +1,118 @@
+from array import array
+from bisect import bisect_left
+
+from caching import LruCache
+
+
+def normalize(text: str) -> str:
+    text = text.casefold().replace('ё', 'е')
+    text = ''.join(char if char.isalnum() else ' ' for char in text)
+    return ' '.join(text.split())
+
+
+def trigrams(text: str) -> set:
+    padded = f' {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CitySearchIndex:
+    QUERY_CACHE_SIZE = 4096
+    # share of the query trigrams a name has to contain to be a fuzzy match
+    FUZZY_THRESHOLD = 0.4
+
+    def __init__(self):
+        self.city_ids = list()
+        self.name_keys = list()
+        self.country_keys = list()
+        self.name_trigrams = dict()
+        self.query_cache = LruCache(CitySearchIndex.QUERY_CACHE_SIZE)
+
+    def build(self, entries):
+        city_ids = list()
+        name_keys = list()
+        country_keys = list()
+        name_trigrams = dict()
+
+        for city_id, name, country in entries:
+            index = len(city_ids)
+            city_ids.append(city_id)
+
+            name = normalize(name)
+            words = name.split(' ')
+            for i in range(len(words)):
+                # every word of the name starts a key, so 'новгород' finds 'нижний новгород'
+                name_keys.append((' '.join(words[i:]), index))
+
+            country_keys.append((normalize(country), index))
+
+            for trigram in trigrams(name):
+                postings = name_trigrams.get(trigram)
+                if postings is None:
+                    postings = array('I')
+                    name_trigrams[trigram] = postings
+                postings.append(index)
+
+        name_keys.sort()
+        country_keys.sort()
+
+        self.city_ids = city_ids
+        self.name_keys = name_keys
+        self.country_keys = country_keys
+        self.name_trigrams = name_trigrams
+        self.query_cache = LruCache(CitySearchIndex.QUERY_CACHE_SIZE)
+
+    def __len__(self) -> int:
+        return len(self.city_ids)
+
+    def search(self, query: str, limit: int) -> list:
+        query = normalize(query)
+        cache_key = (query, limit)
+
+        cached = self.query_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        if len(query) == 0:
+            found = self.city_ids[:limit]
+        else:
+            found = list()
+            seen = set()
+
+            self.collect_prefix_matches(self.name_keys, query, limit, found, seen)
+            self.collect_prefix_matches(self.country_keys, query, limit, found, seen)
+
+            if len(found) < limit and len(query) >= 3:
+                self.collect_fuzzy_matches(query, limit, found, seen)
+
+        self.query_cache.put(cache_key, found)
+        return found
+
+    def collect_prefix_matches(self, keys: list, query: str, limit: int, found: list, seen: set):
+        position = bisect_left(keys, (query,))
+
+        while position < len(keys) and len(found) < limit:
+            key, index = keys[position]
+            if not key.startswith(query):
+                break
+
+            if index not in seen:
+                seen.add(index)
+                found.append(self.city_ids[index])
+
+            position += 1
+
+    def collect_fuzzy_matches(self, query: str, limit: int, found: list, seen: set):
+        query_trigrams = trigrams(query)
+        scores = dict()
+
+        for trigram in query_trigrams:
+            for index in self.name_trigrams.get(trigram, ()):
+                scores[index] = scores.get(index, 0) + 1
+
+        min_score = len(query_trigrams) * CitySearchIndex.FUZZY_THRESHOLD
+        candidates = [(-score, index) for index, score in scores.items() if score >= min_score and index not in seen]
+        candidates.sort()
+
+        for _, index in candidates[:limit - len(found)]:
+            seen.add(index)
+            found.append(self.city_ids[index])
@@ -0,0 +1,169 @@
+import asyncio
+import sqlite3
+import threading
+
+
+class UserState:
+    __slots__ = ('favorite_city', 'last_city')
+
+    def __init__(self, favorite_city: str = None, last_city: str = None):
+        self.favorite_city = favorite_city
+        self.last_city = last_city
+
+
+class StateStore:
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            favorite_city TEXT,
+            last_city TEXT
+        );
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            chat_id INTEGER NOT NULL,
+            city_id TEXT NOT NULL,
+            PRIMARY KEY (chat_id, city_id)
+        );
+    '''
+
+    def __init__(self, database_path: str, flush_interval: float):
+        self.database_path = database_path
+        self.flush_interval = flush_interval
+        self.connection = None
+        # user id -> state, every read is served from here
+        self.users = dict()
+        # changes since the last flush: user id -> changed fields and (chat id, city id) -> subscribed
+        self.dirty_users = dict()
+        self.dirty_subscriptions = dict()
+        self.flush_lock = asyncio.Lock()
+        # a flush cancelled by the shutdown keeps writing on its thread, the final one waits for it
+        self.write_lock = threading.Lock()
+        self.task = None
+
+    def open(self):
+        # flushes run on executor threads
+        self.connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        # readers and the writer don't block each other, cluster workers share the database
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(StateStore.SCHEMA)
+
+    def close(self):
+        with self.write_lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def load_users(self) -> int:
+        for user_id, favorite_city, last_city in self.connection.execute('SELECT user_id, favorite_city, last_city FROM users'):
+            self.users[user_id] = UserState(favorite_city, last_city)
+        return len(self.users)
+
+    def load_subscriptions(self, owns_chat=None) -> list:
+        rows = self.connection.execute('SELECT chat_id, city_id FROM subscriptions')
+        return [(chat_id, city_id) for chat_id, city_id in rows if owns_chat is None or owns_chat(chat_id)]
+
+    def get_user(self, user_id: int) -> UserState:
+        return self.users.get(user_id)
+
+    def get_favorite_city(self, user_id: int) -> str:
+        state = self.users.get(user_id)
+        return state.favorite_city if state is not None else None
+
+    def get_last_city(self, user_id: int) -> str:
+        state = self.users.get(user_id)
+        return state.last_city if state is not None else None
+
+    def update_user(self, user_id: int, **changes):
+        state = self.users.get(user_id)
+        if state is None:
+            state = UserState()
+            self.users[user_id] = state
+
+        for name, value in changes.items():
+            setattr(state, name, value)
+
+        # only changed fields are written, cluster workers keep their own copies of every user
+        self.dirty_users.setdefault(user_id, set()).update(changes.keys())
+
+    def set_favorite_city(self, user_id: int, city_id: str):
+        self.update_user(user_id, favorite_city=city_id)
+
+    def set_last_city(self, user_id: int, city_id: str):
+        if self.get_last_city(user_id) != city_id:
+            self.update_user(user_id, last_city=city_id)
+
+    def on_subscription_change(self, chat_id: int, city_id: str, subscribed: bool):
+        self.dirty_subscriptions[(chat_id, city_id)] = subscribed
+
+    def take_changes(self) -> tuple:
+        # field -> (user id, value) rows
+        users = {field: list() for field in UserState.__slots__}
+        for user_id, fields in self.dirty_users.items():
+            state = self.users[user_id]
+            for field in fields:
+                users[field].append((user_id, getattr(state, field)))
+
+        subscribed = [key for key, value in self.dirty_subscriptions.items() if value]
+        unsubscribed = [key for key, value in self.dirty_subscriptions.items() if not value]
+
+        self.dirty_users = dict()
+        self.dirty_subscriptions = dict()
+        return users, subscribed, unsubscribed
+
+    def write(self, users: dict, subscribed: list, unsubscribed: list):
+        with self.write_lock, self.connection:
+            # field names come from UserState, not from the outside
+            for field, rows in users.items():
+                self.connection.executemany(
+                    f'INSERT INTO users (user_id, {field}) VALUES (?, ?) '
+                    f'ON CONFLICT (user_id) DO UPDATE SET {field} = excluded.{field}',
+                    rows
+                )
+            self.connection.executemany('INSERT OR IGNORE INTO subscriptions (chat_id, city_id) VALUES (?, ?)', subscribed)
+            self.connection.executemany('DELETE FROM subscriptions WHERE chat_id = ? AND city_id = ?', unsubscribed)
+
+    def has_changes(self) -> bool:
+        return len(self.dirty_users) != 0 or len(self.dirty_subscriptions) != 0
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.has_changes():
+                return
+
+            changes = self.take_changes()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.write, *changes)
+            except sqlite3.Error as error:
+                users = len({user_id for rows in changes[0].values() for user_id, _ in rows})
+                print(f'[State] Failed to save {users} users and {len(changes[1]) + len(changes[2])} subscriptions: {error}')
+                self.restore_changes(*changes)
+
+    def restore_changes(self, users: dict, subscribed: list, unsubscribed: list):
+        # written again with the next flush, unless they were changed in the meantime
+        for field, rows in users.items():
+            for user_id, _ in rows:
+                self.dirty_users.setdefault(user_id, set()).add(field)
+        for key in subscribed:
+            self.dirty_subscriptions.setdefault(key, True)
+        for key in unsubscribed:
+            self.dirty_subscriptions.setdefault(key, False)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run(), name='State Writer')
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        await self.flush()
+        self.close()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
@@ -0,0 +1,111 @@
+import base64
+import unittest
+from time import monotonic
+from types import SimpleNamespace
+
+from actions import CallbackHandler
+from callbacks import (
+    ACTION_CODES, MAX_CALLBACK_DATA_LENGTH, TOKEN_PREFIX, CallbackCodec, callback_data, decode_commands
+)
+
+
+def binary_data(raw: bytes) -> str:
+    return '!' + base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+class CallbackCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.codec = CallbackCodec(60, 10)
+
+    def test_round_trip(self):
+        data = self.codec.pack(('select_city', 'spb', -1001234567890), ('show_weather', 0, 'Питер'))
+
+        self.assertLessEqual(len(data.encode('UTF-8')), MAX_CALLBACK_DATA_LENGTH)
+        self.assertFalse(data.startswith(TOKEN_PREFIX))
+        self.assertEqual(self.codec.unpack(data), [
+            (ACTION_CODES['select_city'], ['spb', '-1001234567890']),
+            (ACTION_CODES['show_weather'], ['0', 'Питер'])
+        ])
+
+    def test_long_payload_goes_to_token_store(self):
+        commands = [('delete', message_id) for message_id in range(-20, 20)]
+        data = self.codec.pack(*commands)
+
+        self.assertTrue(data.startswith(TOKEN_PREFIX))
+        self.assertLessEqual(len(data.encode('UTF-8')), MAX_CALLBACK_DATA_LENGTH)
+        self.assertEqual(self.codec.unpack(data), [
+            (ACTION_CODES['delete'], [str(message_id)]) for message_id in range(-20, 20)
+        ])
+
+        with self.assertRaises(ValueError):
+            callback_data('delete', *range(100))
+
+    def test_expired_token(self):
+        data = self.codec.pack(('show_city_info', 'Владивосток' * 10))
+        token = data[len(TOKEN_PREFIX):]
+        self.assertIsNotNone(self.codec.unpack(data))
+
+        _, commands = self.codec.tokens.entries[token]
+        self.codec.tokens.entries[token] = (monotonic() - 1, commands)
+
+        self.assertIsNone(self.codec.unpack(data))
+        self.assertNotIn(token, self.codec.tokens.entries)
+        self.assertIsNone(self.codec.unpack(TOKEN_PREFIX + 'unknown'))
+
+    def test_evicted_token(self):
+        first = self.codec.pack(('show_city_info', 'Владивосток' * 10))
+        for _ in range(self.codec.tokens.max_size):
+            self.codec.pack(('show_city_info', 'Хабаровск' * 10))
+
+        self.assertIsNone(self.codec.unpack(first))
+
+    def test_legacy_format(self):
+        self.assertEqual(decode_commands('#select_city moscow 42\n#show_weather moscow\n#removed_action'), [
+            (ACTION_CODES['select_city'], ['moscow', '42']),
+            (ACTION_CODES['show_weather'], ['moscow']),
+            (0, [])
+        ])
+        self.assertEqual(decode_commands('no commands here'), [])
+
+    def test_malformed_payload(self):
+        payloads = {
+            # a base64 string can't be this long
+            '!AAAAA': ValueError,
+            # an opcode without the arguments count
+            binary_data(bytes([ACTION_CODES['delete']])): IndexError,
+            # two arguments announced, none sent
+            binary_data(bytes([ACTION_CODES['delete'], 2])): IndexError,
+            # a string argument that isn't UTF-8
+            binary_data(bytes([ACTION_CODES['select_city'], 1, 2 << 1, 0xFF, 0xFE])): UnicodeDecodeError,
+        }
+
+        for data, error in payloads.items():
+            with self.assertRaises(error, msg=data):
+                self.codec.unpack(data)
+
+
+class CallbackHandlerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        bot = SimpleNamespace(callback_codec=CallbackCodec(60, 10), registered_actions=dict())
+        self.handler = CallbackHandler(bot)
+        self.answers = list()
+
+    async def answer(self, text: str = None):
+        self.answers.append(text)
+
+    async def handle(self, data: str):
+        query = SimpleNamespace(data=data, answer=self.answer, message=None)
+        update = SimpleNamespace(effective_user=SimpleNamespace(username='tester'), callback_query=query)
+        await self.handler.handle_callback(update, None)
+
+    async def test_expired_button(self):
+        await self.handle(TOKEN_PREFIX + 'unknown')
+        self.assertEqual(self.answers, ['⌛ Эта кнопка устарела'])
+
+    async def test_malformed_button(self):
+        await self.handle('!AAAAA')
+        self.assertEqual(self.answers, [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from time import time
+
+from bot import Bot, Preferences
+from fakes import FakeWeatherServer
+from persistence import WeatherSnapshot
+from weather import CityWeatherData
+
+
+class WeatherSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'weather_cache.bin')
+
+        self.bot = self.create_bot()
+        self.city_ids = [query_item.city_id for query_item in self.bot.weather_service.fetcher.query_items[:3]]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_bot(self, restore_snapshot: bool = False) -> Bot:
+        prefs = Preferences('1:fake', 'fake')
+        prefs.weather_snapshot_file = self.path
+        prefs.forecast_days = 0
+
+        bot = Bot()
+        bot.use_preferences(prefs)
+        bot.load_data()
+        bot.load_weather(restore_snapshot)
+        return bot
+
+    def store_weather(self, city_id: str, age: int = 0) -> CityWeatherData:
+        current = FakeWeatherServer.generate_current(city_id)
+        current['last_updated_epoch'] = int(time()) - age
+        data = CityWeatherData().load_from_response(current)
+        self.bot.weather_service.store_weather_data(city_id, data)
+        return data
+
+    def test_round_trip(self):
+        stored = {city_id: self.store_weather(city_id) for city_id in self.city_ids}
+        snapshot: WeatherSnapshot = self.bot.weather_snapshot
+
+        records = WeatherSnapshot.decode(snapshot.encode(self.bot.weather_service.cache))
+
+        self.assertEqual(records.keys(), stored.keys())
+        for city_id, data in stored.items():
+            self.assertEqual(records[city_id].updated_epoch, data.updated_epoch)
+            self.assertTrue(records[city_id].same_readings(data))
+
+    def test_corrupted_snapshot_is_ignored(self):
+        for city_id in self.city_ids:
+            self.store_weather(city_id)
+        snapshot: WeatherSnapshot = self.bot.weather_snapshot
+        raw = snapshot.encode(self.bot.weather_service.cache)
+
+        corrupted = (
+            b'',
+            raw[:WeatherSnapshot.HEADER.size - 1],
+            # records announced, none written
+            raw[:WeatherSnapshot.HEADER.size],
+            # cut inside the id of the first record
+            raw[:WeatherSnapshot.HEADER.size + 2],
+            # cut inside the last record and right before it
+            raw[:-1],
+            raw[:-CityWeatherData.RECORD.size],
+            b'XXXX' + raw[4:],
+            os.urandom(len(raw)),
+        )
+
+        for content in corrupted:
+            with open(self.path, 'wb') as file:
+                file.write(content)
+
+            restored_bot = self.create_bot(restore_snapshot=True)
+            self.assertEqual(restored_bot.weather_snapshot.load(), 0, content)
+
+    def test_old_weather_is_discarded(self):
+        max_age = self.bot.prefs.weather_snapshot_max_age
+        fresh_id, old_id = self.city_ids[:2]
+        self.store_weather(fresh_id, age=60)
+        self.store_weather(old_id, age=max_age + 60)
+        self.bot.weather_snapshot.save()
+
+        restored_bot = self.create_bot(restore_snapshot=True)
+
+        self.assertIn(fresh_id, restored_bot.weather_service.cache)
+        self.assertNotIn(old_id, restored_bot.weather_service.cache)
+
+    def test_failed_save_on_stop_is_logged(self):
+        self.store_weather(self.city_ids[0])
+        snapshot: WeatherSnapshot = self.bot.weather_snapshot
+        snapshot.path = os.path.join(self.directory.name, 'missing', 'weather_cache.bin')
+
+        asyncio.run(snapshot.stop())
+
+        self.assertFalse(os.path.exists(snapshot.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
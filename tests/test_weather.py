@@ -0,0 +1,171 @@
+import asyncio
+import unittest
+from time import monotonic
+
+import httpx
+
+from bot import Bot, Preferences
+from fakes import FakeWeatherServer
+from weather import CircuitBreaker, CityWeatherData, RequestBudget, WeatherFetcher
+
+
+class BulkRequestTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakeWeatherServer()
+        await self.server.start()
+
+        prefs = Preferences('1:fake', 'fake')
+        prefs.weather_api_url = self.server.api_url()
+        prefs.forecast_days = 0
+
+        bot = Bot()
+        bot.use_preferences(prefs)
+        bot.load_data()
+        bot.load_weather(restore_snapshot=False)
+
+        # only the client is needed, start() would run the refresh loop as well
+        self.fetcher: WeatherFetcher = bot.weather_service.fetcher
+        self.fetcher.client = httpx.AsyncClient(timeout=self.fetcher.timeout)
+        self.batch = self.fetcher.query_items[:3]
+
+    async def asyncTearDown(self):
+        await self.fetcher.client.aclose()
+        await self.server.stop()
+
+    async def test_results_are_split_by_custom_id(self):
+        results = await self.fetcher.perform_bulk_request(self.batch)
+
+        self.assertEqual(set(results.keys()), {query_item.city_id for query_item in self.batch})
+        self.assertEqual(self.server.requests_count, 1)
+
+        for query_item in self.batch:
+            expected = FakeWeatherServer.generate_current(query_item.query_string())
+            data = results[query_item.city_id]
+            self.assertIsNotNone(data)
+            self.assertEqual(data.temp_c, expected['temp_c'])
+            self.assertEqual(data.condition_code, expected['condition']['code'])
+
+    async def test_failed_location_leaves_others(self):
+        unknown = self.batch[1]
+        self.server.unknown_locations.add(unknown.query_string())
+
+        results = await self.fetcher.perform_bulk_request(self.batch)
+
+        self.assertIsNone(results[unknown.city_id])
+        for query_item in self.batch:
+            if query_item is not unknown:
+                self.assertIsNotNone(results[query_item.city_id])
+
+    async def test_server_error_fails_every_location(self):
+        self.server.error_rate = 1.0
+
+        results = await self.fetcher.perform_bulk_request(self.batch)
+
+        self.assertEqual(results, {query_item.city_id: None for query_item in self.batch})
+
+
+class CityWeatherDataTest(unittest.TestCase):
+    def test_readings_survive_packing(self):
+        current = FakeWeatherServer.generate_current('Moscow')
+        current['temp_c'] = 15.3
+        data = CityWeatherData().load_from_response(current)
+
+        buffer = bytearray(CityWeatherData.RECORD.size)
+        data.pack_into(buffer, 0)
+        restored = CityWeatherData.unpack_from(buffer, 0)
+
+        self.assertNotEqual(restored.temp_c, data.temp_c)
+        self.assertTrue(restored.same_readings(data))
+        self.assertTrue(data.same_readings(restored))
+
+    def test_changed_reading_differs(self):
+        data = CityWeatherData().load_from_response(FakeWeatherServer.generate_current('Moscow'))
+        other = CityWeatherData().load_from_response(FakeWeatherServer.generate_current('Moscow'))
+        other.updated_epoch += 60
+        self.assertTrue(data.same_readings(other))
+
+        other.condition_code += 1
+        self.assertFalse(data.same_readings(other))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(3, 30)
+
+    def open_breaker(self, now: float):
+        for _ in range(self.breaker.failure_threshold):
+            self.assertTrue(self.breaker.allow_request(now))
+            self.breaker.record_failure(now)
+
+    def test_opens_after_failures_in_a_row(self):
+        breaker = self.breaker
+        breaker.record_failure(0)
+        breaker.record_failure(0)
+        breaker.record_success()
+        breaker.record_failure(0)
+        breaker.record_failure(0)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.time_until_retry(0), 0)
+
+        breaker.record_failure(0)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request(1))
+        self.assertTrue(30 * 0.75 <= breaker.time_until_retry(0) <= 30 * 1.25)
+
+    def test_single_probe_closes(self):
+        breaker = self.breaker
+        self.open_breaker(0)
+
+        self.assertTrue(breaker.allow_request(breaker.retry_at))
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # the others wait for the probe
+        self.assertFalse(breaker.allow_request(breaker.retry_at))
+        self.assertEqual(breaker.time_until_retry(breaker.retry_at), CircuitBreaker.PROBE_POLL_INTERVAL)
+
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow_request(breaker.retry_at))
+        self.assertTrue(breaker.allow_request(breaker.retry_at))
+
+    def test_failed_probe_doubles_timeout(self):
+        breaker = self.breaker
+        self.open_breaker(0)
+
+        timeouts = list()
+        for _ in range(7):
+            now = breaker.retry_at
+            self.assertTrue(breaker.allow_request(now))
+            breaker.record_failure(now)
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            self.assertFalse(breaker.probing)
+            timeouts.append(breaker.reset_timeout)
+
+        self.assertEqual(timeouts, [60, 120, 240, 480, 600, 600, 600])
+
+        breaker.allow_request(breaker.retry_at)
+        breaker.record_success()
+        self.assertEqual(breaker.reset_timeout, 30)
+
+
+class RequestBudgetTest(unittest.IsolatedAsyncioTestCase):
+    async def test_requests_over_budget_wait(self):
+        budget = RequestBudget(2)
+        await budget.acquire()
+        await budget.acquire()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(budget.acquire(), 0.1)
+
+        # a minute has passed for the first request
+        budget.timestamps[0] = monotonic() - 60
+        await asyncio.wait_for(budget.acquire(), 0.1)
+        self.assertEqual(len(budget.timestamps), 2)
+
+    def test_empty_budget_is_rejected(self):
+        for requests_per_minute in (0, -1):
+            with self.assertRaises(ValueError):
+                RequestBudget(requests_per_minute)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import json
+import unittest
+
+import httpx
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+
+from bot import Bot
+from webhook import WebhookServer, SECRET_TOKEN_HEADER
+
+SECRET_TOKEN = 'secret'
+UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 10,
+        'date': 0,
+        'chat': {'id': 5, 'type': 'private'},
+        'from': {'id': 5, 'is_bot': False, 'first_name': 'Test'},
+        'text': '/start'
+    }
+}
+
+
+class WebhookServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # only the update queue of the application is used, nothing is started
+        self.bot = Bot()
+        self.bot.app = ApplicationBuilder().token('1:fake').build()
+
+        self.server = WebhookServer('https://example.com/webhook', '127.0.0.1', 0, SECRET_TOKEN, self.bot.enqueue_update)
+        await self.server.start()
+        self.client = httpx.AsyncClient(base_url=self.server.url())
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        await self.server.stop()
+
+    async def post(self, content, secret_token: str = SECRET_TOKEN) -> httpx.Response:
+        headers = {'content-type': 'application/json'}
+        if secret_token is not None:
+            headers[SECRET_TOKEN_HEADER] = secret_token
+        return await self.client.post('/webhook', content=content, headers=headers)
+
+    async def test_update_is_enqueued(self):
+        response = await self.post(json.dumps(UPDATE))
+
+        self.assertEqual(response.status_code, 200)
+        update = self.bot.app.update_queue.get_nowait()
+        self.assertIsInstance(update, Update)
+        self.assertEqual(update.update_id, 1)
+        self.assertEqual(update.effective_chat.id, 5)
+
+    async def test_wrong_secret_is_forbidden(self):
+        body = json.dumps(UPDATE)
+
+        for secret_token in ('wrong', '', None):
+            response = await self.post(body, secret_token)
+            self.assertEqual(response.status_code, 403)
+
+        self.assertTrue(self.bot.app.update_queue.empty())
+
+    async def test_malformed_update_is_rejected(self):
+        bodies = (
+            b'{"update_id": 1',
+            b'',
+            b'[1, 2]',
+            b'{"message": {}}',
+            # parsed as JSON, but not as an update
+            b'{"update_id": 1, "message": "text"}'
+        )
+
+        for body in bodies:
+            response = await self.post(body)
+            self.assertEqual(response.status_code, 400, body)
+
+        self.assertTrue(self.bot.app.update_queue.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
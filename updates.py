@@ -0,0 +1,55 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def get_order_key(update) -> int:
+    # updates of a chat are handled one after another, inline queries have no chat, so they go by user
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # the base semaphore is taken before the chat lock, so it's kept out of the way
+    UNBOUNDED = 1 << 30
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(ChatOrderedUpdateProcessor.UNBOUNDED)
+        # limits the updates being handled, updates waiting for their chat don't take a slot
+        self.limit = asyncio.Semaphore(max(1, max_concurrent_updates))
+        # order key -> [lock, updates holding or waiting for it]
+        self.chat_locks = dict()
+
+    async def do_process_update(self, update: object, coroutine):
+        key = get_order_key(update)
+        if key is None:
+            async with self.limit:
+                await coroutine
+            return
+
+        chat_lock = self.chat_locks.get(key)
+        if chat_lock is None:
+            chat_lock = [asyncio.Lock(), 0]
+            self.chat_locks[key] = chat_lock
+
+        chat_lock[1] += 1
+        try:
+            # updates of a chat are started in the order of arrival, locks are acquired in the same order
+            async with chat_lock[0], self.limit:
+                await coroutine
+        finally:
+            chat_lock[1] -= 1
+            if chat_lock[1] == 0:
+                del self.chat_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
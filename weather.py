@@ -1,28 +1,39 @@
-from datetime import datetime
-from threading import Thread
-from time import sleep
+import asyncio
+import heapq
+import random
+import struct
+from collections import deque
+from time import monotonic, perf_counter, time
 
-from requests import get, ConnectionError
+import httpx
 
-from data import DataLoader, CityModel
+from data import DataLoader
+from geo import SpatialIndex
+from metrics import WEATHER_API_DURATION, WEATHER_API_RESPONSES, WEATHER_CACHE_LOOKUPS, WEATHER_CACHE_AGE, \
+    WEATHER_CIRCUIT_CHANGES
+
+# raised when a response is received, but doesn't contain the weather
+MALFORMED_RESPONSE_ERRORS = (KeyError, ValueError, TypeError)
+
+
+def backoff_delay(failures: int, base_delay: float, max_delay: float) -> float:
+    # exponential up to max_delay, with a half of it random, so retries don't come in waves
+    delay = min(max_delay, base_delay * 2 ** min(failures - 1, 16))
+    return delay / 2 + random.uniform(0, delay / 2)
 
 
 class CityWeatherData:
-    date_time: datetime
-    temp_c: float
-    temp_f: float
-    feelslike_c: float
-    feelslike_f: float
-    humidity: int
-    cloud: int
-    is_day: bool
-    condition_code: int
-
-    def __init__(self):
-        super().__init__()
+    __slots__ = (
+        'updated_epoch', 'temp_c', 'temp_f', 'feelslike_c', 'feelslike_f',
+        'humidity', 'cloud', 'is_day', 'condition_code'
+    )
+    # last updated epoch, temp c/f, feels like c/f, humidity, cloud, is day, condition code
+    RECORD = struct.Struct('<Iffffbb?H')
+    # the record without the update time, readings restored from a snapshot are only float32 precise
+    READINGS_RECORD = struct.Struct('<ffffbb?H')
 
     def load_from_response(self, weather_data: dict):
-        self.date_time = datetime.fromtimestamp(weather_data['last_updated_epoch'])
+        self.updated_epoch = weather_data['last_updated_epoch']
         self.temp_c = weather_data['temp_c']
         self.temp_f = weather_data['temp_f']
         self.feelslike_c = weather_data['feelslike_c']
@@ -33,68 +44,642 @@ class CityWeatherData:
         self.condition_code = weather_data['condition']['code']
         return self
 
+    def same_readings(self, other) -> bool:
+        return self.pack_readings() == other.pack_readings()
+
+    def pack_readings(self) -> bytes:
+        return CityWeatherData.READINGS_RECORD.pack(
+            self.temp_c, self.temp_f,
+            self.feelslike_c, self.feelslike_f,
+            self.humidity, self.cloud,
+            self.is_day, self.condition_code
+        )
+
+    def pack_into(self, buffer, offset: int):
+        CityWeatherData.RECORD.pack_into(
+            buffer, offset,
+            int(self.updated_epoch),
+            self.temp_c, self.temp_f,
+            self.feelslike_c, self.feelslike_f,
+            self.humidity, self.cloud,
+            self.is_day, self.condition_code
+        )
+
+    @staticmethod
+    def unpack_from(buffer, offset: int):
+        data = CityWeatherData()
+        fields = CityWeatherData.RECORD.unpack_from(buffer, offset)
+        data.updated_epoch = fields[0]
+        data.temp_c, data.temp_f, data.feelslike_c, data.feelslike_f = fields[1:5]
+        data.humidity, data.cloud, data.is_day, data.condition_code = fields[5:9]
+        return data
+
+
+class WeatherHistory:
+    __slots__ = ('buffer', 'capacity', 'next_index', 'count')
+
+    def __init__(self, capacity: int):
+        # records are packed, so the history of a city takes the same memory whatever it holds
+        self.buffer = bytearray(capacity * CityWeatherData.RECORD.size)
+        self.capacity = capacity
+        self.next_index = 0
+        self.count = 0
+
+    def append(self, data: CityWeatherData):
+        data.pack_into(self.buffer, self.next_index * CityWeatherData.RECORD.size)
+        self.next_index = (self.next_index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def latest(self) -> list:
+        # newest first
+        records = list()
+        for i in range(1, self.count + 1):
+            index = (self.next_index - i) % self.capacity
+            records.append(CityWeatherData.unpack_from(self.buffer, index * CityWeatherData.RECORD.size))
+        return records
+
 
 class WeatherService:
     def __init__(self, bot):
         self.bot = bot
-        self.thread = WeatherFetchThread(self)
+        self.fetcher = WeatherFetcher(self)
         self.cache = dict()
+        self.history = dict()
+        self.history_size: int = bot.prefs.weather_history_size
+        # notified about changed readings only
+        self.listeners = list()
+        # notified about every stored reading, even when only its update time has changed
+        self.refresh_listeners = list()
+        # cluster workers don't fetch weather themselves and forward demand to the weather process instead
+        self.demand_sink = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify_listeners(self, city_id: str, data):
+        WeatherService.call_listeners(self.listeners, city_id, data)
+
+    def add_refresh_listener(self, listener):
+        self.refresh_listeners.append(listener)
+
+    def notify_refresh_listeners(self, city_id: str, data):
+        WeatherService.call_listeners(self.refresh_listeners, city_id, data)
+
+    @staticmethod
+    def call_listeners(listeners: list, city_id: str, data):
+        # listeners run inside the fetcher, a failing one mustn't stop the refreshes or the other listeners
+        for listener in listeners:
+            try:
+                listener(city_id, data)
+            except Exception as error:
+                print(f"[Weather Service] Listener {listener.__qualname__} failed for '{city_id}': {error!r}")
 
     def get_cached_weather_data(self, city_id: str) -> CityWeatherData:
-        return self.cache[city_id] if city_id in self.cache.keys() else None
+        data = self.cache.get(city_id)
+        if data is None:
+            WEATHER_CACHE_LOOKUPS.inc('miss')
+            return None
+
+        WEATHER_CACHE_LOOKUPS.inc('hit')
+        WEATHER_CACHE_AGE.observe(time() - data.updated_epoch)
+        return data
+
+    def get_weather_history(self, city_id: str) -> list:
+        history: WeatherHistory = self.history.get(city_id)
+        return history.latest() if history is not None else list()
+
+    def update_weather_data(self, city_id: str, data: CityWeatherData) -> bool:
+        # a failed fetch keeps the last good reading
+        if data is None:
+            return False
 
-    def update_weather_data(self, city_id: str, data):
+        current: CityWeatherData = self.cache.get(city_id)
+        if current is not None:
+            # a response which was overtaken by a newer one
+            if data.updated_epoch < current.updated_epoch:
+                return False
+
+            if current.same_readings(data):
+                self.cache[city_id] = data
+                self.notify_refresh_listeners(city_id, data)
+                return False
+
+        self.store_weather_data(city_id, data)
+        self.notify_refresh_listeners(city_id, data)
+        return True
+
+    def store_weather_data(self, city_id: str, data: CityWeatherData):
         self.cache[city_id] = data
 
+        if self.history_size > 0:
+            history: WeatherHistory = self.history.get(city_id)
+            if history is None:
+                history = WeatherHistory(self.history_size)
+                self.history[city_id] = history
+            history.append(data)
+
+        self.notify_listeners(city_id, data)
+
+    def restore_weather_data(self, city_id: str, data: CityWeatherData) -> bool:
+        representative_id = self.fetcher.representatives.get(city_id)
+        if representative_id is None:
+            return False
+
+        self.store_weather_data(city_id, data)
+        self.fetcher.scheduler.restore(representative_id, data)
+        return True
+
+    def forget_weather_data(self, city_ids: list):
+        for city_id in city_ids:
+            self.cache.pop(city_id, None)
+            self.history.pop(city_id, None)
+
+    def record_demand(self, city_id: str):
+        if self.demand_sink is not None:
+            self.demand_sink(city_id)
+            return
+
+        representative_id = self.fetcher.representatives.get(city_id)
+        if representative_id is not None:
+            self.fetcher.scheduler.record_demand(representative_id)
+
     def start(self):
-        self.thread.start()
+        self.fetcher.start()
+
+    async def stop(self):
+        await self.fetcher.stop()
 
 
 class QueryItem:
-    def __init__(self, city_id: str, city: CityModel):
+    def __init__(self, city_id: str, lat: float, lon: float, city_ids: list = None):
         self.city_id = city_id
-        self.lat = city.raw_lat
-        self.lon = city.raw_lon
+        self.lat = lat
+        self.lon = lon
+        # cities close enough to share the weather fetched for this one
+        self.city_ids = city_ids if city_ids is not None else [city_id]
 
     def query_string(self) -> str:
         return f'{self.lat},{self.lon}'
 
+    def same_as(self, other) -> bool:
+        return self.city_id == other.city_id and self.lat == other.lat and self.lon == other.lon \
+            and self.city_ids == other.city_ids
+
+
+class RequestBudget:
+    def __init__(self, requests_per_minute: int):
+        # no request could ever be sent, acquire() would wait for a timestamp that never comes
+        if requests_per_minute < 1:
+            raise ValueError('weather_requests_per_minute has to be at least 1')
+        self.requests_per_minute = requests_per_minute
+        self.timestamps = deque()
+
+    async def acquire(self):
+        while True:
+            now = monotonic()
+            while len(self.timestamps) != 0 and now - self.timestamps[0] >= 60:
+                self.timestamps.popleft()
+
+            if len(self.timestamps) < self.requests_per_minute:
+                self.timestamps.append(now)
+                return
+
+            await asyncio.sleep(60 - (now - self.timestamps[0]))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    MAX_RESET_TIMEOUT = 600
+    PROBE_POLL_INTERVAL = 1.0
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_reset_timeout = reset_timeout
+        # doubled by every failed probe, so a long outage is probed less and less often
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.retry_at = 0.0
+        self.probing = False
+
+    def change_state(self, state: str):
+        if self.state != state:
+            self.state = state
+            WEATHER_CIRCUIT_CHANGES.inc(state)
+            print(f'[Weather Service] Circuit breaker is {state.replace("_", "-")} now.')
+
+    def time_until_retry(self, now: float) -> float:
+        if self.state == CircuitBreaker.HALF_OPEN and self.probing:
+            return CircuitBreaker.PROBE_POLL_INTERVAL
+        if self.state != CircuitBreaker.OPEN:
+            return 0.0
+        return max(0.0, self.retry_at - now)
+
+    def allow_request(self, now: float) -> bool:
+        if self.state == CircuitBreaker.OPEN:
+            if now < self.retry_at:
+                return False
+            self.change_state(CircuitBreaker.HALF_OPEN)
+
+        if self.state == CircuitBreaker.HALF_OPEN:
+            # a single request probes the upstream, the rest wait for its outcome
+            if self.probing:
+                return False
+            self.probing = True
+
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+        self.reset_timeout = self.base_reset_timeout
+        self.change_state(CircuitBreaker.CLOSED)
+
+    def record_failure(self, now: float):
+        self.failures += 1
+
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self.probing = False
+            self.reset_timeout = min(CircuitBreaker.MAX_RESET_TIMEOUT, self.reset_timeout * 2)
+        elif self.state == CircuitBreaker.OPEN or self.failures < self.failure_threshold:
+            return
+
+        # jittered, so cluster processes and restarted instances don't probe in lockstep
+        self.retry_at = now + self.reset_timeout * random.uniform(0.75, 1.25)
+        self.change_state(CircuitBreaker.OPEN)
+
+
+class ScheduleEntry:
+    def __init__(self, query_item: QueryItem):
+        self.query_item = query_item
+        self.demand = 0.0
+        self.demand_updated_at = 0.0
+        self.fetched_at = 0.0
+        self.last_updated_epoch = 0
+        self.next_due = 0.0
+        # failed fetches in a row, each one doubles the retry delay
+        self.failures = 0
+
+
+class RefreshScheduler:
+    # weatherapi.com refreshes current conditions every 15 minutes
+    UPSTREAM_UPDATE_PERIOD = 900
+    DEMAND_HALF_LIFE = 3600
+    RETRY_DELAY = 60
+
+    def __init__(self, min_interval: int, max_interval: int):
+        self.min_interval = max(min_interval, RefreshScheduler.UPSTREAM_UPDATE_PERIOD)
+        self.max_interval = max(max_interval, self.min_interval)
+        self.entries = dict()
+        self.heap = list()
+        self.counter = 0
+        self.wakeup = asyncio.Event()
+
+    def add(self, query_item: QueryItem):
+        entry = ScheduleEntry(query_item)
+        self.entries[query_item.city_id] = entry
+        self.push(entry)
+
+    def remove(self, city_id: str):
+        # stale heap records are skipped when popped
+        self.entries.pop(city_id, None)
+
+    def push(self, entry: ScheduleEntry):
+        self.counter += 1
+        heapq.heappush(self.heap, (entry.next_due, self.counter, entry.query_item.city_id))
+
+    def current_demand(self, entry: ScheduleEntry, now: float) -> float:
+        elapsed = now - entry.demand_updated_at
+        return entry.demand * 0.5 ** (elapsed / RefreshScheduler.DEMAND_HALF_LIFE)
+
+    def refresh_interval(self, entry: ScheduleEntry, now: float) -> float:
+        interval = self.max_interval / (1.0 + self.current_demand(entry, now))
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def compute_next_due(self, entry: ScheduleEntry, now: float) -> float:
+        by_demand = entry.fetched_at + self.refresh_interval(entry, now)
+        by_upstream = entry.last_updated_epoch + RefreshScheduler.UPSTREAM_UPDATE_PERIOD
+        return max(by_demand, by_upstream)
+
+    def record_demand(self, city_id: str):
+        entry: ScheduleEntry = self.entries.get(city_id)
+        if entry is None:
+            return
+
+        now = time()
+        entry.demand = self.current_demand(entry, now) + 1.0
+        entry.demand_updated_at = now
+
+        # the city is being fetched right now, it will be rescheduled afterwards
+        if entry.next_due == float('inf'):
+            return
+
+        # a failing city keeps its backoff, the cached weather is served meanwhile
+        if entry.failures != 0:
+            return
 
-class WeatherFetchThread(Thread):
+        next_due = self.compute_next_due(entry, now)
+        if next_due < entry.next_due:
+            entry.next_due = next_due
+            self.push(entry)
+            self.wakeup.set()
+
+    def mark_fetched(self, query_item: QueryItem, data) -> bool:
+        entry: ScheduleEntry = self.entries.get(query_item.city_id)
+        # the query item was replaced or removed by a data reload while it was being fetched
+        if entry is None or entry.query_item is not query_item:
+            return False
+
+        now = time()
+        entry.fetched_at = now
+
+        if data is None:
+            entry.failures += 1
+            entry.next_due = now + self.retry_delay(entry)
+        else:
+            entry.failures = 0
+            entry.last_updated_epoch = data.updated_epoch
+            entry.next_due = self.compute_next_due(entry, now)
+
+        self.push(entry)
+        return True
+
+    def retry_delay(self, entry: ScheduleEntry) -> float:
+        # up to the refresh interval of cities nobody views
+        return backoff_delay(entry.failures, RefreshScheduler.RETRY_DELAY, self.max_interval)
+
+    def recover_in_flight(self):
+        # cities popped by a sweep which failed before they were marked as fetched
+        now = time()
+        for entry in self.entries.values():
+            if entry.next_due == float('inf'):
+                entry.failures += 1
+                entry.next_due = now + self.retry_delay(entry)
+                self.push(entry)
+
+    def postpone(self, query_item: QueryItem, next_due: float):
+        # not fetched at all, so it isn't a failure of the city
+        entry: ScheduleEntry = self.entries.get(query_item.city_id)
+        if entry is None or entry.query_item is not query_item:
+            return
+
+        entry.next_due = next_due
+        self.push(entry)
+
+    def restore(self, city_id: str, data):
+        entry: ScheduleEntry = self.entries.get(city_id)
+        if entry is None:
+            return
+
+        entry.last_updated_epoch = data.updated_epoch
+        entry.fetched_at = entry.last_updated_epoch
+        entry.next_due = self.compute_next_due(entry, time())
+        self.push(entry)
+
+    def pop_due(self, now: float) -> list:
+        due = list()
+        while len(self.heap) != 0 and self.heap[0][0] <= now:
+            next_due, _, city_id = heapq.heappop(self.heap)
+            entry: ScheduleEntry = self.entries.get(city_id)
+            if entry is None or entry.next_due != next_due:
+                continue
+
+            entry.next_due = float('inf')
+            due.append(entry.query_item)
+
+        return due
+
+    def time_until_next(self, now: float) -> float:
+        while len(self.heap) != 0:
+            next_due, _, city_id = self.heap[0]
+            entry: ScheduleEntry = self.entries.get(city_id)
+            if entry is not None and entry.next_due == next_due:
+                return max(0.0, next_due - now)
+            heapq.heappop(self.heap)
+
+        return float(self.max_interval)
+
+
+class WeatherFetcher:
     def __init__(self, service: WeatherService):
-        super().__init__(name="Weather Fetch Thread", daemon=True)
         self.service = service
         self.query_items = list()
+        self.client = None
+        self.task = None
+        self.running = False
 
-        data_loader: DataLoader = service.bot.data_loader
-        for city_model in data_loader.city_models.items():
-            self.query_items.append(QueryItem(city_model[0], city_model[1]))
+        prefs = service.bot.prefs
+        self.max_concurrency: int = prefs.weather_max_concurrency
+        self.batch_size: int = max(1, prefs.weather_bulk_batch_size)
+        self.api_url: str = prefs.weather_api_url
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.budget = RequestBudget(prefs.weather_requests_per_minute)
+        self.breaker = CircuitBreaker(prefs.weather_circuit_failure_threshold, prefs.weather_circuit_reset_timeout)
+        self.timeout = httpx.Timeout(prefs.weather_read_timeout, connect=prefs.weather_connect_timeout)
+        self.scheduler = RefreshScheduler(prefs.weather_min_refresh_interval, prefs.weather_max_refresh_interval)
 
-    def run(self) -> None:
-        while True:
+        self.share_radius_km: float = prefs.weather_share_radius_km
+        self.representatives = dict()
+
+        for query_item in self.build_query_items():
+            self.add_query_item(query_item)
+
+    def build_query_items(self) -> list:
+        data_loader: DataLoader = self.service.bot.data_loader
+
+        if self.share_radius_km > 0:
+            spatial_index: SpatialIndex = data_loader.spatial_index
+            query_items = list()
+            for group in spatial_index.cluster(self.share_radius_km):
+                lat, lon = spatial_index.location_of(group[0])
+                query_items.append(QueryItem(group[0], lat, lon, group))
+            return query_items
+
+        return [QueryItem(city_id, lat, lon) for city_id, lat, lon in data_loader.get_city_locations()]
+
+    def add_query_item(self, query_item: QueryItem):
+        self.query_items.append(query_item)
+        self.scheduler.add(query_item)
+
+        for city_id in query_item.city_ids:
+            self.representatives[city_id] = query_item.city_id
+
+    def sync_query_items(self) -> list:
+        current_items = {query_item.city_id: query_item for query_item in self.query_items}
+        query_items = list()
+        representatives = dict()
+
+        for query_item in self.build_query_items():
+            current_item = current_items.pop(query_item.city_id, None)
+            if current_item is not None and current_item.same_as(query_item):
+                # keeps its schedule, an in-flight fetch of it completes as usual
+                query_item = current_item
+            else:
+                self.scheduler.add(query_item)
+
+            query_items.append(query_item)
+            for city_id in query_item.city_ids:
+                representatives[city_id] = query_item.city_id
+
+        for city_id in current_items.keys():
+            self.scheduler.remove(city_id)
+
+        self.query_items = query_items
+        self.representatives = representatives
+        self.scheduler.wakeup.set()
+
+        # cities which aren't fetched anymore
+        return [city_id for query_item in current_items.values() for city_id in query_item.city_ids if city_id not in representatives]
+
+    def start(self):
+        headers = dict()
+        headers['User-Agent'] = 'Traveller Conductor Weather Service'
+
+        limits = httpx.Limits(
+            max_connections=self.max_concurrency,
+            max_keepalive_connections=self.max_concurrency
+        )
+
+        # a hung connection would hold a slot of the semaphore and the cities of its batch forever
+        self.client = httpx.AsyncClient(headers=headers, limits=limits, timeout=self.timeout)
+        self.running = True
+        self.task = asyncio.get_running_loop().create_task(self.run(), name='Weather Fetcher')
+
+    async def stop(self):
+        self.running = False
+
+        if self.task is not None:
+            self.scheduler.wakeup.set()
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def run(self):
+        while self.running:
+            scheduler: RefreshScheduler = self.scheduler
+            try:
+                await self.sweep()
+            except Exception as error:
+                print(f"[Weather Service] Refresh sweep failed: {error!r}")
+                scheduler.recover_in_flight()
+
+            scheduler.wakeup.clear()
+            now = time()
+            # due cities wait for the circuit breaker to let a request through
+            timeout = max(scheduler.time_until_next(now), self.breaker.time_until_retry(now))
             try:
-                self.tick()
-            except ConnectionError:
-                print("[Weather Service] Connection error :(")
-            sleep(10)
+                await asyncio.wait_for(scheduler.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def sweep(self):
+        now = time()
+        if self.breaker.time_until_retry(now) > 0:
+            return
+
+        due_items = self.scheduler.pop_due(now)
+
+        batches = list()
+        for i in range(0, len(due_items), self.batch_size):
+            batches.append(due_items[i:i + self.batch_size])
+
+        if self.breaker.state != CircuitBreaker.CLOSED and len(batches) > 1:
+            # only the first batch probes the upstream, the rest follow once it has recovered
+            for batch in batches[1:]:
+                for query_item in batch:
+                    self.scheduler.postpone(query_item, now)
+            batches = batches[:1]
+
+        # every batch completes before the failed ones are recovered
+        results = await asyncio.gather(*[self.refresh(batch) for batch in batches], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if len(errors) != 0:
+            print(f"[Weather Service] {len(errors)} of {len(batches)} refreshes failed: {errors[0]!r}")
+            self.scheduler.recover_in_flight()
+
+    async def refresh(self, batch: list):
+        try:
+            if len(batch) == 1:
+                query_item: QueryItem = batch[0]
+                results = {query_item.city_id: await self.perform_request(query_item.query_string())}
+            else:
+                results = await self.perform_bulk_request(batch)
+        except CircuitOpenError:
+            now = time()
+            retry_at = now + self.breaker.time_until_retry(now)
+            for query_item in batch:
+                self.scheduler.postpone(query_item, retry_at)
+            return
+        except Exception as error:
+            # connection errors, malformed responses and anything unexpected are retried with a backoff alike
+            print(f"[Weather Service] Failed to refresh {len(batch)} cities: {error!r}")
+            for query_item in batch:
+                self.scheduler.mark_fetched(query_item, None)
+            return
+
+        for query_item in batch:
+            data = results.get(query_item.city_id)
+            if not self.scheduler.mark_fetched(query_item, data):
+                continue
+
+            for city_id in query_item.city_ids:
+                self.service.update_weather_data(city_id, data)
 
-    def tick(self):
-        for query_item in self.query_items:
-            data = self.perform_request(query_item.query_string())
-            self.service.update_weather_data(query_item.city_id, data)
-            sleep(10)
+    async def send_request(self, kind: str, method: str, params: dict, body: dict = None,
+                           endpoint: str = 'current.json') -> httpx.Response:
+        breaker: CircuitBreaker = self.breaker
+        # checked before the budget, a request which would be refused doesn't spend it
+        if not breaker.allow_request(time()):
+            WEATHER_API_RESPONSES.inc(kind, 'circuit_open')
+            raise CircuitOpenError()
 
-    def perform_request(self, query: str):
-        url = 'https://api.weatherapi.com/v1/current.json'
+        try:
+            await self.budget.acquire()
+            async with self.semaphore:
+                started_at = perf_counter()
+                try:
+                    response = await self.client.request(method, f'{self.api_url}/{endpoint}', params=params, json=body)
+                except httpx.HTTPError as error:
+                    WEATHER_API_RESPONSES.inc(kind, error.__class__.__name__)
+                    breaker.record_failure(time())
+                    raise
+                finally:
+                    WEATHER_API_DURATION.observe(perf_counter() - started_at, kind)
+        except BaseException:
+            # a probe which failed in any other way or was cancelled mustn't keep the breaker half-open forever
+            breaker.probing = False
+            raise
 
+        WEATHER_API_RESPONSES.inc(kind, response.status_code)
+
+        # rate limiting and server errors mean the upstream is struggling, other errors are about the query
+        if response.status_code == 429 or response.status_code >= 500:
+            breaker.record_failure(time())
+        else:
+            breaker.record_success()
+
+        return response
+
+    async def perform_request(self, query: str):
         params = dict()
         params['key'] = self.service.bot.weather_api_key
         params['q'] = query
 
-        headers = dict()
-        headers['User-Agent'] = 'Traveller Conductor Weather Service'
+        response = await self.send_request('single', 'GET', params)
 
-        response = get(url, params=params, headers=headers)
         if response.status_code != 200:
             print(f"Status code {response.status_code} received when I tried to query weather status for '{query}' :(")
             return None
@@ -103,3 +688,34 @@ class WeatherFetchThread(Thread):
         weather_data = raw['current']
 
         return CityWeatherData().load_from_response(weather_data)
+
+    async def perform_bulk_request(self, batch: list) -> dict:
+        params = dict()
+        params['key'] = self.service.bot.weather_api_key
+        params['q'] = 'bulk'
+
+        body = dict()
+        body['locations'] = [{'q': item.query_string(), 'custom_id': item.city_id} for item in batch]
+
+        response = await self.send_request('bulk', 'POST', params, body)
+
+        results = {item.city_id: None for item in batch}
+
+        if response.status_code != 200:
+            print(f"Status code {response.status_code} received when I tried to query weather status for {len(batch)} cities :(")
+            return results
+
+        for entry in response.json()['bulk']:
+            query: dict = entry['query']
+            city_id = query.get('custom_id')
+            if city_id not in results.keys():
+                continue
+
+            if 'current' not in query.keys():
+                error = query.get('error', dict()).get('message')
+                print(f"Failed to query weather status for '{city_id}': {error}")
+                continue
+
+            results[city_id] = CityWeatherData().load_from_response(query['current'])
+
+        return results
@@ -0,0 +1,174 @@
+import asyncio
+import json
+from urllib.parse import urlsplit, parse_qsl
+
+
+class HttpRequest:
+    def __init__(self, method: str, target: str, headers: dict, body: bytes):
+        url = urlsplit(target)
+
+        self.method: str = method
+        self.path: str = url.path
+        self.query: dict = dict(parse_qsl(url.query))
+        self.headers: dict = headers
+        self.body: bytes = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class HttpResponse:
+    def __init__(self, status: int = 200, body: bytes = b'', content_type: str = 'text/plain; charset=utf-8'):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+
+    @staticmethod
+    def json(data, status: int = 200):
+        body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('UTF-8')
+        return HttpResponse(status, body, 'application/json')
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class HttpServer:
+    # a request line or a header longer than this fails the read
+    MAX_LINE_SIZE = 8192
+    MAX_HEADERS = 100
+    MAX_BODY_SIZE = 1 << 20
+    # seconds a kept-alive connection may wait for the next request
+    IDLE_TIMEOUT = 60
+    # seconds to receive the rest of a request once it has started
+    REQUEST_TIMEOUT = 10
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.routes = dict()
+        self.server = None
+        self.max_body_size = HttpServer.MAX_BODY_SIZE
+
+    def route(self, method: str, path: str, handler):
+        self.routes[(method, path)] = handler
+
+    def url(self, path: str = '') -> str:
+        return f'http://{self.host}:{self.port}{path}'
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port, limit=HttpServer.MAX_LINE_SIZE)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except HttpError as error:
+                    # the rest of the connection can't be parsed anymore, so it's closed after the response
+                    print(f'[HTTP Server] Rejected a request: {error}')
+                    await HttpServer.write_response(writer, HttpResponse(error.status, str(error).encode('UTF-8')), False)
+                    break
+
+                if request is None:
+                    break
+
+                response = await self.dispatch(request)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                await HttpServer.write_response(writer, response, keep_alive)
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def write_response(writer: asyncio.StreamWriter, response: HttpResponse, keep_alive: bool):
+        writer.write(
+            f'HTTP/1.1 {response.status} {"OK" if response.status < 400 else "Error"}\r\n'
+            f'Content-Type: {response.content_type}\r\n'
+            f'Content-Length: {len(response.body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+            '\r\n'.encode('latin-1') + response.body
+        )
+        await writer.drain()
+
+    @staticmethod
+    async def read_line(reader: asyncio.StreamReader) -> bytes:
+        try:
+            return await reader.readline()
+        except ValueError:
+            # raised by the reader when the line is longer than its limit
+            raise HttpError(431, 'Line Too Long')
+
+    async def read_request(self, reader: asyncio.StreamReader):
+        try:
+            request_line = await asyncio.wait_for(HttpServer.read_line(reader), HttpServer.IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+
+        if len(request_line) == 0:
+            return None
+
+        try:
+            return await asyncio.wait_for(self.read_rest(reader, request_line), HttpServer.REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HttpError(408, 'Request Timeout')
+
+    async def read_rest(self, reader: asyncio.StreamReader, request_line: bytes) -> HttpRequest:
+        parts = request_line.decode('latin-1').rstrip('\r\n').split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise HttpError(400, 'Malformed Request Line')
+
+        method, target, _ = parts
+
+        headers = dict()
+        while True:
+            line = (await HttpServer.read_line(reader)).decode('latin-1').rstrip('\r\n')
+            if len(line) == 0:
+                break
+
+            if len(headers) == HttpServer.MAX_HEADERS:
+                raise HttpError(431, 'Too Many Headers')
+
+            name, separator, value = line.partition(':')
+            if len(separator) == 0:
+                raise HttpError(400, 'Malformed Header')
+            headers[name.strip().lower()] = value.strip()
+
+        # chunked bodies aren't supported, Telegram and the fakes always send the length
+        if 'transfer-encoding' in headers.keys():
+            raise HttpError(501, 'Transfer Encoding Not Supported')
+
+        length = headers.get('content-length', '0')
+        if not length.isdigit():
+            raise HttpError(400, 'Malformed Content-Length')
+
+        length = int(length)
+        if length > self.max_body_size:
+            raise HttpError(413, 'Payload Too Large')
+
+        body = await reader.readexactly(length) if length > 0 else b''
+        return HttpRequest(method, target, headers, body)
+
+    async def dispatch(self, request: HttpRequest) -> HttpResponse:
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            return HttpResponse(404, b'Not Found')
+
+        try:
+            return await handler(request)
+        except Exception as error:
+            print(f"[HTTP Server] Failed to handle '{request.method} {request.path}': {error}")
+            return HttpResponse(500, b'Internal Server Error')
@@ -0,0 +1,53 @@
+import hmac
+from urllib.parse import urlsplit
+
+from telegram import Bot, Update
+
+from web import HttpServer, HttpRequest, HttpResponse
+
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+# raised by Update.de_json for updates of an unexpected shape
+MALFORMED_UPDATE_ERRORS = (KeyError, ValueError, TypeError, AttributeError)
+
+
+class WebhookServer(HttpServer):
+    def __init__(self, webhook_url: str, host: str, port: int, secret_token: str, update_handler):
+        super().__init__(host, port)
+        self.webhook_url = webhook_url
+        self.path = urlsplit(webhook_url).path or '/'
+        # Telegram repeats the token in every request, so only it can deliver updates. It has to be
+        # configured, instances behind a load balancer would overwrite each other's random tokens
+        if not secret_token:
+            raise ValueError('webhook_secret_token has to be set in the webhook mode')
+        self.secret_token = secret_token
+        # coroutine function receiving the raw update
+        self.update_handler = update_handler
+        self.route('POST', self.path, self.handle_update)
+
+    async def register(self, bot: Bot):
+        await bot.set_webhook(self.webhook_url, secret_token=self.secret_token, allowed_updates=Update.ALL_TYPES)
+
+    async def handle_update(self, request: HttpRequest) -> HttpResponse:
+        received_token = request.headers.get(SECRET_TOKEN_HEADER, '').encode('UTF-8')
+        if not hmac.compare_digest(received_token, self.secret_token.encode('UTF-8')):
+            return HttpResponse(403, b'Forbidden')
+
+        try:
+            raw = request.json()
+        except ValueError as error:
+            print(f'[Webhook] Received a malformed update: {error}')
+            return HttpResponse(400, b'Bad Request')
+
+        if not isinstance(raw, dict) or 'update_id' not in raw:
+            print('[Webhook] Received a malformed update: no update_id')
+            return HttpResponse(400, b'Bad Request')
+
+        # Telegram only waits for the acknowledgement, the update is processed later
+        try:
+            await self.update_handler(raw)
+        except MALFORMED_UPDATE_ERRORS as error:
+            # Telegram would redeliver it forever after a server error
+            print(f'[Webhook] Received a malformed update: {error!r}')
+            return HttpResponse(400, b'Bad Request')
+
+        return HttpResponse(200, b'')